@@ -0,0 +1,47 @@
+import sys
+import argparse
+import tempfile
+from pathlib import Path
+
+from benchmarks.stages import stages, scales
+from benchmarks.runner import run_benchmarks, compare_results, print_comparison, save_results, load_results
+
+def run(output_path, scale_names=None, stage_filters=None, repeats=5, work_directory=None):
+	default_config_path = (Path(__file__) / '../../config/default.yaml').resolve()
+
+	if work_directory is None:
+		with tempfile.TemporaryDirectory() as work_directory:
+			results = run_benchmarks(work_directory, default_config_path, scale_names, stage_filters, repeats)
+	else:
+		results = run_benchmarks(work_directory, default_config_path, scale_names, stage_filters, repeats)
+
+	save_results(results, output_path)
+	print(f"Results saved to {output_path}")
+
+def compare(baseline_path, current_path, threshold=0.1):
+	rows, regressed = compare_results(load_results(baseline_path), load_results(current_path), threshold)
+	print_comparison(rows)
+
+	return 1 if regressed else 0
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Time the generator hot paths on synthetic vessel trees and meshes.')
+	subparsers = parser.add_subparsers(dest='command', required=True)
+
+	run_parser = subparsers.add_parser('run', help='Run the benchmarks and save the results as JSON.')
+	run_parser.add_argument('-o', '--output', type=str, default='benchmark_results.json', help='Where to save the results.')
+	run_parser.add_argument('-s', '--scales', nargs='+', choices=list(scales.keys()), help='Scales to run at (default: all).')
+	run_parser.add_argument('--stages', nargs='+', help=f'Only run stages starting with these prefixes, from: {", ".join(stages.keys())}.')
+	run_parser.add_argument('-r', '--repeats', type=int, default=5, help='Timed repeats of each stage.')
+	run_parser.add_argument('--work_dir', type=str, help='Keep the synthetic SWC and mesh files here instead of a temporary directory.')
+
+	compare_parser = subparsers.add_parser('compare', help='Compare results against a baseline. Exits with 1 if any stage regressed.')
+	compare_parser.add_argument('baseline', type=str, help='Baseline results JSON.')
+	compare_parser.add_argument('current', type=str, help='Results JSON to check.')
+	compare_parser.add_argument('-t', '--threshold', type=float, default=0.1, help='Slowdown, as a fraction of the baseline, flagged as a regression.')
+	args = parser.parse_args()
+
+	if args.command == 'run':
+		run(args.output, args.scales, args.stages, args.repeats, args.work_dir)
+	else:
+		sys.exit(compare(args.baseline, args.current, args.threshold))
@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+import subprocess
+import numpy as np
+from pathlib import Path
+from datetime import datetime
+
+from .stages import stages, scales, Fixtures
+
+def run_benchmarks(work_directory, default_config_path, scale_names=None, stage_filters=None, repeats=5):
+	'''
+	Time every selected stage at every selected scale. Stages whose optional dependencies (e.g.
+	pyrender, gvxr or the compiled mesh extensions) are missing are recorded as skipped.
+
+	Returns {"meta": {...}, "results": {"<stage>@<scale>": {...}}}
+	'''
+	scale_names = scale_names or list(scales.keys())
+	selected = [name for name in stages if not stage_filters or any(name.startswith(f) for f in stage_filters)]
+
+	results = {}
+	for scale in scale_names:
+		fixtures = Fixtures(scale, work_directory, default_config_path)
+
+		for name in selected:
+			if stages[name].scale_names is not None and scale not in stages[name].scale_names:
+				continue
+
+			key = f"{name}@{scale}"
+			print(f"{key:<40}", end="", flush=True)
+
+			try:
+				run, sizes = stages[name](fixtures)
+				times = time_function(run, repeats)
+			except ImportError as e:
+				results[key] = {"stage": name, "scale": scale, "skipped": str(e)}
+				print(f"skipped ({e})")
+				continue
+
+			results[key] = {
+				"stage": name,
+				"scale": scale,
+				"sizes": sizes,
+				"repeats": repeats,
+				"times": times,
+				"median": statistics.median(times),
+				"min": min(times),
+				"budget": stages[name].budget
+			}
+			over_budget = stages[name].budget is not None and statistics.median(times) > stages[name].budget
+			print(f"{statistics.median(times):10.4f}s (min {min(times):.4f}s){'  OVER BUDGET' if over_budget else ''}")
+
+	return {"meta": get_meta(), "results": results}
+
+def time_function(func, repeats):
+	# One untimed run first, so lazy imports, caches and allocations aren't counted
+	func()
+
+	times = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		func()
+		times.append(time.perf_counter() - start)
+
+	return times
+
+def compare_results(baseline, current, threshold=0.1, min_time=1e-3):
+	'''
+	Compare the fastest times of two result sets, as the minimum is the least affected by other
+	load on the machine. A stage has regressed when it is more than `threshold` (as a fraction)
+	slower than the baseline; stages faster than `min_time` seconds in both are too noisy to
+	judge and are never flagged. Stages with a time budget also fail when their current median is
+	over it, whatever the baseline.
+
+	Returns a list of (key, baseline time, current time, ratio, status) and whether anything regressed
+	'''
+	rows = []
+	regressed = False
+
+	for key in sorted(set(baseline["results"]) | set(current["results"])):
+		before_result = baseline["results"].get(key, {})
+		after_result = current["results"].get(key, {})
+		before, after = before_result.get("min"), after_result.get("min")
+
+		if before is None or after is None:
+			if "skipped" in before_result or "skipped" in after_result:
+				status = "skipped"
+			elif before is None and after is not None:
+				status = "new"
+			else:
+				status = "missing"
+
+			rows.append((key, before, after, None, status))
+			continue
+
+		ratio = after / before if before > 0 else float("inf")
+		budget = after_result.get("budget")
+		if budget is not None and after_result["median"] > budget:
+			status = "OVER BUDGET"
+			regressed = True
+		elif max(before, after) < min_time:
+			status = "ok"
+		elif ratio > 1 + threshold:
+			status = "REGRESSION"
+			regressed = True
+		elif ratio < 1 / (1 + threshold):
+			status = "improved"
+		else:
+			status = "ok"
+
+		rows.append((key, before, after, ratio, status))
+
+	return rows, regressed
+
+def print_comparison(rows):
+	def fmt(value, width, precision):
+		return f"{value:{width}.{precision}f}" if value is not None else f"{'-':>{width}}"
+
+	print(f"{'stage':<40}{'baseline':>12}{'current':>12}{'ratio':>8}  status")
+	for key, before, after, ratio, status in rows:
+		print(f"{key:<40}{fmt(before, 12, 4)}{fmt(after, 12, 4)}{fmt(ratio, 8, 2)}  {status}")
+
+def save_results(results, path):
+	with open(path, "w") as f:
+		json.dump(results, f, indent=4)
+
+def load_results(path):
+	with open(path, "r") as f:
+		return json.load(f)
+
+def get_meta():
+	try:
+		commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent).stdout.strip() or None
+	except OSError:
+		commit = None
+
+	return {
+		"created": datetime.now().isoformat(timespec="seconds"),
+		"commit": commit,
+		"python": sys.version.split()[0],
+		"numpy": np.__version__,
+		"platform": platform.platform(),
+		"processor": platform.processor(),
+		"cpu_count": os.cpu_count()
+	}
@@ -0,0 +1,253 @@
+import sys
+import subprocess
+import numpy as np
+from pathlib import Path
+
+from .synthetic import synthetic_tree, write_swc, tree_to_mesh, synthetic_frames
+
+# Sizes of the synthetic inputs at each scale. Mesh faces are about 48 * tree_nodes.
+scales = {
+	"small": {"tree_nodes": 128, "points": 10000, "pointcloud": 10000, "voxels_res": 32, "image_size": 256, "frames": 8, "seeds": 16},
+	"medium": {"tree_nodes": 1024, "points": 100000, "pointcloud": 100000, "voxels_res": 64, "image_size": 512, "frames": 32, "seeds": 128},
+	"large": {"tree_nodes": 4096, "points": 400000, "pointcloud": 400000, "voxels_res": 128, "image_size": 1024, "frames": 64, "seeds": 1024}
+}
+
+# Seconds a stage script may take to start (e.g. to print --help), as the median over repeats
+startup_budget = 0.5
+
+stages = {}
+
+def stage(name, scale_names=None, budget=None):
+	'''
+	Register a benchmark stage. A stage takes the Fixtures of one scale and returns the function
+	to time (without arguments) and a dict describing the size of its input. Setup done in the
+	stage itself is not timed.
+
+	`scale_names` limits a stage that doesn't depend on input size to some scales. A stage with a
+	`budget` (in seconds) fails the comparison whenever its median time is over it.
+	'''
+	def register(func):
+		func.scale_names = scale_names
+		func.budget = budget
+		stages[name] = func
+		return func
+
+	return register
+
+class Fixtures(object):
+	"""Synthetic inputs for one scale, built on first use and shared between stages"""
+	def __init__(self, scale, work_directory, default_config_path, seed=0):
+		self.scale = scale
+		self.sizes = scales[scale]
+		self.work_directory = Path(work_directory) / scale
+		self.default_config_path = default_config_path
+		self.seed = seed
+
+		self._cache = {}
+
+	def _cached(self, key, build):
+		if key not in self._cache:
+			self._cache[key] = build()
+		return self._cache[key]
+
+	@property
+	def tree(self):
+		return self._cached("tree", lambda: synthetic_tree(self.sizes["tree_nodes"], seed=self.seed))
+
+	@property
+	def mesh(self):
+		return self._cached("mesh", lambda: tree_to_mesh(self.tree))
+
+	@property
+	def frames(self):
+		return self._cached("frames", lambda: synthetic_frames(self.sizes["image_size"], self.sizes["frames"], seed=self.seed))
+
+	@property
+	def config(self):
+		from utils import get_config
+		return self._cached("config", lambda: get_config(self.default_config_path, self.default_config_path))
+
+	@property
+	def sample_directory(self):
+		'''
+		A seed directory as left by the mesh stage, with network.swc, mesh.ply, mesh.stl and mesh.npz
+		'''
+		def build():
+			path = self.work_directory / "00000"
+			path.mkdir(parents=True, exist_ok=True)
+
+			write_swc(self.tree, path / "network.swc")
+			self.mesh.export(path / "mesh.ply")
+			self.mesh.export(path / "mesh.stl")
+			np.savez_compressed(path / "mesh.npz", verts=self.mesh.vertices, faces=self.mesh.faces)
+
+			return path
+
+		return self._cached("sample_directory", build)
+
+@stage("sampler/generate_batch")
+def sampler_generate_batch(fixtures):
+	cfg = fixtures.config
+	seeds = range(fixtures.sizes["seeds"])
+
+	return lambda: cfg.generate_batch(seeds), {"seeds": len(seeds)}
+
+@stage("protocol/compile")
+def protocol_compile(fixtures):
+	from utils.ProtocolPlan import ProtocolPlan
+
+	num_frames = fixtures.sizes["frames"]
+	instructions = [{"centre": None}]
+	for ppa in np.linspace(-45, 45, num_frames):
+		instructions += [{"fluoroscope": {"ppa": float(ppa), "psa": 20.}}, {"capture": None}]
+
+	return lambda: ProtocolPlan.compile(instructions), {"frames": num_frames}
+
+@stage("matrices/dicom_to_pose")
+def matrices_dicom_to_pose(fixtures):
+	from utils.MatrixCalculator import MatrixCalculator
+
+	num_frames = fixtures.sizes["frames"]
+	ppa = np.linspace(-45, 45, num_frames)
+	psa = np.linspace(-30, 30, num_frames)
+	table = np.zeros((num_frames, 3))
+
+	def run():
+		poses = MatrixCalculator.DICOMtoPoseBatch(ppa, psa, 1000, table)
+		MatrixCalculator.poseToExtrinsicsBatch(poses)
+
+	return run, {"frames": num_frames}
+
+@stage("image_ops/crop")
+def image_ops_crop(fixtures):
+	from utils.ImageOps import get_plugin_image_operation
+
+	crop = get_plugin_image_operation("crop")
+	images, depths, matrices = fixtures.frames
+
+	return lambda: crop(images, depths, matrices, aspect_ratio=1, x=images.shape[1] // 2), _frames_size(images)
+
+@stage("image_ops/resize")
+def image_ops_resize(fixtures):
+	from utils.ImageOps import get_plugin_image_operation
+
+	resize = get_plugin_image_operation("resize")
+	images, depths, matrices = fixtures.frames
+
+	return lambda: resize(images, depths, matrices, keep_aspect_ratio=True, x=224), _frames_size(images)
+
+@stage("image_ops/process_images")
+def image_ops_process_images(fixtures):
+	from utils import get_image_operations
+	from two_d.lib.ImageBuilder import ImageBuilder
+
+	image_operations = get_image_operations(fixtures.config)
+	images, depths, matrices = fixtures.frames
+
+	return lambda: ImageBuilder.process_images(images, depths, matrices, image_operations), {**_frames_size(images), "groups": len(image_operations)}
+
+@stage("mesh/contains")
+def mesh_contains(fixtures):
+	from three_d.lib.MeshSampler import MeshSampler
+
+	mesh = fixtures.mesh
+	points = np.random.RandomState(fixtures.seed).random_sample((fixtures.sizes["points"], 3)) - 0.5
+
+	return lambda: MeshSampler.check_mesh_contains(mesh, points), {"faces": len(mesh.faces), "points": len(points)}
+
+@stage("mesh/voxelize")
+def mesh_voxelize(fixtures):
+	from three_d.lib.MeshSampler import MeshSampler
+
+	mesh = fixtures.mesh
+	resolution = fixtures.sizes["voxels_res"]
+
+	return lambda: MeshSampler.voxelize_ray(mesh, resolution), {"faces": len(mesh.faces), "voxels_res": resolution}
+
+@stage("mesh/points")
+def mesh_points(fixtures):
+	from three_d.lib.MeshSampler import MeshSampler
+
+	mesh = fixtures.mesh
+	points_size = fixtures.sizes["points"]
+
+	return lambda: MeshSampler.get_points(mesh, np.zeros(3), 1., points_size=points_size, points_uniform_ratio=0.9), {"faces": len(mesh.faces), "points": points_size}
+
+@stage("mesh/pointcloud")
+def mesh_pointcloud(fixtures):
+	from three_d.lib.MeshSampler import MeshSampler
+
+	mesh = fixtures.mesh
+	pointcloud_size = fixtures.sizes["pointcloud"]
+
+	return lambda: MeshSampler.get_pointcloud(mesh, pointcloud_size), {"faces": len(mesh.faces), "pointcloud": pointcloud_size}
+
+@stage("mesh/sample")
+def mesh_sample(fixtures):
+	'''
+	The whole per-seed sampleset stage, including loading the mesh and saving the outputs
+	'''
+	from three_d.lib.MeshSampler import MeshSampler
+
+	path = fixtures.sample_directory
+	sizes = fixtures.sizes
+
+	def run():
+		MeshSampler.sample(
+			path,
+			points_size=sizes["points"],
+			points_uniform_ratio=0.9,
+			pointcloud_size=sizes["pointcloud"],
+			voxels_res=sizes["voxels_res"],
+			resize=True,
+			overwrite=True
+		)
+
+	return run, {"faces": len(fixtures.mesh.faces), "points": sizes["points"], "pointcloud": sizes["pointcloud"], "voxels_res": sizes["voxels_res"]}
+
+@stage("render/optical")
+def render_optical(fixtures):
+	from two_d.lib.ImageBuilder import ImageBuilder
+	from two_d.lib.Renderer import OpticalRenderer
+
+	path = fixtures.sample_directory
+	image_cfg = fixtures.config.generate(seed=fixtures.seed)
+	mesh = ImageBuilder.load_mesh(path / "mesh.npz")
+
+	def run():
+		OpticalRenderer(image_cfg).generate_data(mesh=mesh, stl_filepath=str((path / "mesh.stl").resolve()))
+
+	return run, {"faces": len(fixtures.mesh.faces), "frames": len(image_cfg.get_config("operation/protocol")), "pixels": _image_pixels(image_cfg)}
+
+@stage("render/xray")
+def render_xray(fixtures):
+	from two_d.lib.ImageBuilder import ImageBuilder
+	from two_d.lib.Renderer import XRayRenderer
+
+	path = fixtures.sample_directory
+	image_cfg = fixtures.config.generate(seed=fixtures.seed)
+	mesh = ImageBuilder.load_mesh(path / "mesh.npz")
+
+	def run():
+		XRayRenderer(image_cfg).generate_data(mesh=mesh, stl_filepath=str((path / "mesh.stl").resolve()))
+
+	return run, {"faces": len(fixtures.mesh.faces), "frames": len(image_cfg.get_config("operation/protocol")), "pixels": _image_pixels(image_cfg)}
+
+def _startup_stage(script):
+	def run_stage(fixtures):
+		# A fresh interpreter each time, so everything the script imports is counted
+		script_path = Path(__file__).parents[1] / script
+		command = [sys.executable, str(script_path), "--help"]
+
+		return lambda: subprocess.run(command, stdout=subprocess.DEVNULL, check=True), {}
+
+	return run_stage
+
+for _script in ("generate.py", "generate_graph.py", "generate_three_d.py", "generate_two_d.py", "generate_shards.py", "benchmark.py"):
+	stage(f"startup/{Path(_script).stem}", scale_names=("small",), budget=startup_budget)(_startup_stage(_script))
+
+def _image_pixels(cfg):
+	return cfg.get_config("equipment/fluoroscope/specifications/image_dimensions/width") * cfg.get_config("equipment/fluoroscope/specifications/image_dimensions/height")
+
+def _frames_size(images):
+	return {"height": images.shape[0], "width": images.shape[1], "frames": images.shape[2]}
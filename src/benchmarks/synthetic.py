@@ -0,0 +1,126 @@
+import numpy as np
+
+from utils.MatrixCalculator import MatrixCalculator
+
+def synthetic_tree(num_nodes, seed=0):
+	'''
+	Deterministic random vessel tree in the SWC layout written by VascuSynth: one row per node
+	of (id, type, x, y, z, radius, parent id), with ids from 1 and a parent of -1 for the root.
+	Branches narrow away from the root and every node has at most two children.
+	'''
+	random_obj = np.random.RandomState(seed)
+
+	positions = np.zeros((num_nodes, 3))
+	directions = np.zeros((num_nodes, 3))
+	radii = np.zeros(num_nodes)
+	parents = np.full(num_nodes, -1)
+	children = np.zeros(num_nodes, dtype=int)
+
+	directions[0] = [0, 0, -1]
+	radii[0] = 1.5
+
+	for i in range(1, num_nodes):
+		# Grow from a node with room for another child, mostly near the tips of the tree
+		candidates = np.flatnonzero(children[:i] < 2)
+		parent = candidates[min(len(candidates) - 1, int(len(candidates) * random_obj.random_sample() ** 0.3))]
+
+		direction = directions[parent] + 0.6 * random_obj.standard_normal(3)
+		direction /= np.linalg.norm(direction)
+
+		positions[i] = positions[parent] + 4 * radii[parent] * direction
+		directions[i] = direction
+		radii[i] = max(0.2, 0.9 * radii[parent])
+		parents[i] = parent
+		children[parent] += 1
+
+	ids = np.arange(1, num_nodes + 1)
+	parent_ids = np.where(parents >= 0, parents + 1, -1)
+
+	return np.column_stack([ids, np.full(num_nodes, 3), positions, radii, parent_ids])
+
+def write_swc(tree, path):
+	with open(path, "w") as f:
+		for node_id, node_type, x, y, z, radius, parent_id in tree:
+			f.write(f"{int(node_id)} {int(node_type)} {x:.6f} {y:.6f} {z:.6f} {radius:.6f} {int(parent_id)}\n")
+
+def tree_to_mesh(tree, sides=12, normalise=True):
+	'''
+	Mesh of the tree with one capped tube per segment, (len(tree) - 1) * 4 * sides faces in
+	total. Tubes overlap at the joints, which doesn't matter for timing. When `normalise` is
+	set, the mesh is centred and scaled into [-0.45, 0.45]^3, as MeshSampler expects.
+	'''
+	positions, radii, parent_ids = tree[:, 2:5], tree[:, 5], tree[:, 6].astype(int)
+	child = np.flatnonzero(parent_ids > 0)
+	parent = parent_ids[child] - 1
+
+	start, end = positions[parent], positions[child]
+	axis = end - start
+	axis /= np.linalg.norm(axis, axis=1, keepdims=True)
+
+	helper = np.where(np.abs(axis[:, :1]) < 0.9, [[1., 0., 0.]], [[0., 1., 0.]])
+	u = np.cross(axis, helper)
+	u /= np.linalg.norm(u, axis=1, keepdims=True)
+	v = np.cross(axis, u)
+
+	theta = 2 * np.pi * np.arange(sides) / sides
+	circle = np.cos(theta)[np.newaxis, :, np.newaxis] * u[:, np.newaxis] + np.sin(theta)[np.newaxis, :, np.newaxis] * v[:, np.newaxis]
+
+	ring_start = start[:, np.newaxis] + radii[parent, np.newaxis, np.newaxis] * circle
+	ring_end = end[:, np.newaxis] + radii[child, np.newaxis, np.newaxis] * circle
+
+	# Per segment: `sides` start ring vertices, `sides` end ring vertices, then both cap centres
+	vertices = np.concatenate([ring_start, ring_end, start[:, np.newaxis], end[:, np.newaxis]], axis=1)
+
+	k = np.arange(sides)
+	k_next = (k + 1) % sides
+	a, b, a_next, b_next = k, sides + k, k_next, sides + k_next
+	centre_start = np.full(sides, 2 * sides)
+	centre_end = np.full(sides, 2 * sides + 1)
+
+	faces = np.concatenate([
+		np.stack([a, b_next, b], axis=1),
+		np.stack([a, a_next, b_next], axis=1),
+		np.stack([centre_start, a_next, a], axis=1),
+		np.stack([centre_end, b, b_next], axis=1)
+	])
+
+	offsets = (2 * sides + 2) * np.arange(len(child))
+	faces = (faces[np.newaxis] + offsets[:, np.newaxis, np.newaxis]).reshape(-1, 3)
+	vertices = vertices.reshape(-1, 3)
+
+	if normalise:
+		bounds_min, bounds_max = vertices.min(axis=0), vertices.max(axis=0)
+		vertices = 0.9 * (vertices - (bounds_min + bounds_max) / 2) / (bounds_max - bounds_min).max()
+
+	import trimesh
+
+	return trimesh.Trimesh(vertices, faces, process=False)
+
+def synthetic_frames(size, num_frames, seed=0):
+	'''
+	A (size, size, num_frames) stack of uint8 images and float32 depths with blocky foreground
+	regions, and the matching frame-last camera matrices, as produced by the renderers
+	'''
+	random_obj = np.random.RandomState(seed)
+
+	block = 16
+	cells = random_obj.random_sample((size // block, size // block, num_frames)) > 0.7
+	mask = np.kron(cells, np.ones((block, block, 1), dtype=bool))
+
+	images = (255 * mask).astype(np.uint8)
+	depths = np.where(mask, 800 + 100 * random_obj.random_sample(mask.shape), 0).astype(np.float32)
+
+	ppa = np.linspace(-45, 45, num_frames)
+	psa = np.linspace(-30, 30, num_frames)
+	poses = MatrixCalculator.DICOMtoPoseBatch(ppa, psa, 1000)
+	extrinsics = MatrixCalculator.poseToExtrinsicsBatch(poses)
+	K = MatrixCalculator.camParamsToIntrinsic(image_dims=(size, size), fx=2 * size)
+
+	matrices = {
+		"K": np.repeat(K[:, :, np.newaxis], num_frames, axis=2),
+		"P": np.moveaxis(poses, 0, -1),
+		"R": np.moveaxis(extrinsics["R"], 0, -1),
+		"t": extrinsics["t"].T[np.newaxis]
+	}
+
+	return images, depths, matrices
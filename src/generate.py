@@ -7,27 +7,79 @@ from pathlib import Path
 def get_conda_python():
 	return Path(sys.exec_prefix) / "bin" / "python"
 
-def main(config_path, overwrite=False):
+def dry_run(config_path, calibration_paths=(), num_samples=32):
+	'''
+	Estimate the cost of generating the dataset without generating anything. The cost model is
+	calibrated on the given telemetry directories and benchmark results, plus any telemetry already
+	in the dataset's own root directory.
+	'''
+	from utils import get_config
+	from utils.CostModel import CostModel
+
+	default_config_path = (Path(__file__) / '../../config/default.yaml').resolve()
+	cfg = get_config(config_path, default_config_path)
+
+	calibration_paths = list(calibration_paths)
+	if Path(cfg.get_config("output/root_directory")).is_dir():
+		calibration_paths.append(cfg.get_config("output/root_directory"))
+
+	observations = []
+	for path in calibration_paths:
+		observations += CostModel.load_observations(path)
+
+	model = CostModel()
+	if observations:
+		model.calibrate(observations)
+
+	CostModel.print_estimate(model.estimate(cfg, num_samples=num_samples))
+
+def main(config_path, overwrite=False, profile=False):
 	root_dir = Path(__file__).parents[0]
 	pyth = get_conda_python()
 
 	overwrite_cmd = "-o" if overwrite else ""
+	profile_cmd = "-p" if profile else ""
 	pyopengl_platform = os.getenv("PYOPENGL_PLATFORM")
 	pyopengl_platform_cmd = f"PYOPENGL_PLATFORM={pyopengl_platform}" if pyopengl_platform else ""
 
 	print("Generating Graph Data")
-	subprocess.run(f"{pyth} {root_dir}/generate_graph.py {config_path} {overwrite_cmd}", shell=True, check=True)
+	subprocess.run(f"{pyth} {root_dir}/generate_graph.py {config_path} {overwrite_cmd} {profile_cmd}", shell=True, check=True)
 
 	print("Generating 3D Data")
-	subprocess.run(f"{pyth} {root_dir}/generate_three_d.py {config_path} {overwrite_cmd}", shell=True, check=True)
+	subprocess.run(f"{pyth} {root_dir}/generate_three_d.py {config_path} {overwrite_cmd} {profile_cmd}", shell=True, check=True)
 
 	print("Generating 2D Data")
-	subprocess.run(f"{pyopengl_platform_cmd} {pyth} {root_dir}/generate_two_d.py {config_path} {overwrite_cmd}", shell=True, check=True)
+	subprocess.run(f"{pyopengl_platform_cmd} {pyth} {root_dir}/generate_two_d.py {config_path} {overwrite_cmd} {profile_cmd}", shell=True, check=True)
+
+	print("Generating Shards")
+	subprocess.run(f"{pyth} {root_dir}/generate_shards.py {config_path} {overwrite_cmd} {profile_cmd}", shell=True, check=True)
+
+	print_failures(config_path)
+
+def print_failures(config_path):
+	'''
+	Every seed that a stage gave up on and that is still missing, across all the stages
+	'''
+	from utils import get_config
+	from utils.RunIndex import RunIndex
+	from utils.FailureLog import FailureLog
+
+	default_config_path = (Path(__file__) / '../../config/default.yaml').resolve()
+	cfg = get_config(config_path, default_config_path)
+
+	FailureLog.from_config(cfg).print_report(RunIndex.from_config(cfg))
 
 if __name__ == "__main__":	
 	parser = argparse.ArgumentParser(description='Generate a dataset of coronary angiograms.')
 	parser.add_argument('config_path', type=str, help='Path to the generator config file.')
 	parser.add_argument('-o','--overwrite', action='store_true', help='Overwrite existing files.')
+	parser.add_argument('-p','--profile', action='store_true', help='Profile every stage with py-spy into <root_directory>/profiles/<stage>.txt.')
+	parser.add_argument('-n','--dry-run', action='store_true', help='Only estimate the CPU time, memory and disk space each stage will need.')
+	parser.add_argument('--calibrate', nargs='+', default=[], help='Dataset root directories (with telemetry) or benchmark results JSON files to calibrate --dry-run with.')
+	parser.add_argument('--dry-run-seeds', type=int, default=32, help='Number of seeds sampled by --dry-run.')
 	args = parser.parse_args()
 
-	main(args.config_path, args.overwrite)
\ No newline at end of file
+	if args.dry_run:
+		dry_run(args.config_path, args.calibrate, args.dry_run_seeds)
+	else:
+		main(args.config_path, args.overwrite, args.profile)
\ No newline at end of file
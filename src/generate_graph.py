@@ -1,13 +1,21 @@
+import sys
 import argparse
 from pathlib import Path
 
-from utils import get_config
+from utils import get_config, write_parameter_index
+from utils.Profiler import run_profiled
 from graph.generator import generate_networks
 
-def main(config_path, overwrite=False):
+def main(config_path, overwrite=False, profile=False):
 	default_config_path = (Path(__file__) / '../../config/default.yaml').resolve()
 	cfg = get_config(config_path, default_config_path)
 
+	if profile:
+		run_profiled(cfg, "graph", sys.argv)
+		return
+
+	write_parameter_index(cfg, overwrite=overwrite)
+
 	if cfg.get_config("patient/use_existing_meshes"):
 		return
 
@@ -17,6 +25,7 @@ if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Generate a set of SWC files representing vascular networks.')
 	parser.add_argument('config_path', type=str, help='Path to the generator config file.')
 	parser.add_argument('-o','--overwrite', action="store_true", help='Overwrite existing files.')
+	parser.add_argument('-p','--profile', action="store_true", help='Profile all processes with py-spy into <root_directory>/profiles/graph.txt.')
 	args = parser.parse_args()
 
-	main(args.config_path, args.overwrite)
\ No newline at end of file
+	main(args.config_path, args.overwrite, args.profile)
\ No newline at end of file
@@ -0,0 +1,29 @@
+import sys
+import argparse
+
+from utils import get_config
+from shards.generator import generate_shards
+from utils.Profiler import run_profiled
+
+def main(config_path, overwrite=False, profile=False):
+	default_config_path = "config/default.yaml"
+	cfg = get_config(config_path, default_config_path)
+
+	if not cfg.get_config("output/save/shards"):
+		print("Skipping shards, as output/save/shards is disabled.")
+		return
+
+	if profile:
+		run_profiled(cfg, "shards", sys.argv)
+		return
+
+	generate_shards(cfg, overwrite=overwrite)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Pack the generated samples into tar shards for training.')
+	parser.add_argument('config_path', type=str, help='Path to the generator config file.')
+	parser.add_argument('-o','--overwrite', action="store_true", help='Overwrite existing shards.')
+	parser.add_argument('-p','--profile', action="store_true", help='Profile all processes with py-spy into <root_directory>/profiles/shards.txt.')
+	args = parser.parse_args()
+
+	main(args.config_path, args.overwrite, args.profile)
@@ -1,6 +1,11 @@
 import os
+import re
 import sys
+import time
+import queue
+import signal
 import argparse
+import threading
 import subprocess
 from pathlib import Path
 
@@ -14,9 +19,64 @@ try:
 	from src.three_d.generator import generate_meshes
 except ImportError:
 	from utils import get_config
+	from utils.RunIndex import RunIndex
+	from utils.FailureLog import FailureLog
+	from utils.Profiler import run_profiled
 	from three_d.generator import generate_samplesets
 
-def run_blender_process(n_meshes, config_path, overwrite=False, debug=False):
+# Progress lines printed by generate_meshes in Blender
+_blender_progress = re.compile(r"^(Building|Export completed|Failed) (\d+)(?:: (.*))?$")
+
+def run_blender_process(cfg, config_path, overwrite=False, debug=False):
+	'''
+	Build the meshes in Blender, killing it when a mesh takes longer than meta/timeouts/meshes.
+	Blender is then run again for the unfinished meshes, without the seeds that have failed more
+	than meta/retries times, which are recorded in the failure log. Seeds without a finished
+	network are skipped.
+	'''
+	seed_start, seed_end = cfg.get_config("meta/random_seeds/start"), cfg.get_config("meta/random_seeds/end")
+	retries = cfg.get_config("meta/retries", 0)
+
+	run_index = RunIndex.from_config(cfg)
+	failures = FailureLog.from_config(cfg)
+
+	if overwrite:
+		# Until they are rebuilt, so a failure isn't hidden by the earlier meshes
+		run_index.forget("meshes", range(seed_start, seed_end + 1))
+
+	# Seeds whose network failed (and is in the failure log) would only fail again here
+	seeds = range(seed_start, seed_end + 1)
+	with_network = set(run_index.completed("networks", seeds))
+	excluded = {seed for seed in seeds if seed not in with_network}
+
+	from tqdm import tqdm
+	progress_bar = tqdm(total=len(with_network))
+
+	finished = set()
+	attempts = {}
+
+	while True:
+		failed = run_blender_once(cfg, config_path, overwrite, debug, excluded, finished, run_index, progress_bar)
+		failed = {seed: reason for seed, reason in failed.items() if seed not in excluded}
+		if not failed:
+			break
+
+		for seed, reason in failed.items():
+			attempts[seed] = attempts.get(seed, 0) + 1
+			if attempts[seed] > retries:
+				failures.record("meshes", seed, reason, attempts[seed])
+				excluded.add(seed)
+				progress_bar.update(1)
+
+		# Meshes finished before Blender was killed are kept
+		overwrite = False
+
+	progress_bar.close()
+
+def run_blender_once(cfg, config_path, overwrite, debug, excluded, finished, run_index, progress_bar):
+	'''
+	Run Blender once, returning {seed: reason} for the meshes that failed or timed out
+	'''
 	# TODO: Make this not hard-coded
 
 	blender_exe = './src/external/blender-2.91.2-linux64/blender'
@@ -28,48 +88,138 @@ def run_blender_process(n_meshes, config_path, overwrite=False, debug=False):
 		config_path,
 		'--blendermode'
 	]
+	if overwrite:
+		blender_process_args.append('--overwrite')
+	if excluded:
+		blender_process_args += ['--exclude', format_seeds(excluded)]
 
 	process_string = " ".join(str(i) for i in [blender_exe] + blender_process_args)
-	
-	from tqdm import tqdm
-	progress_bar = tqdm(total=n_meshes)
 
-	stdout = None if debug else subprocess.PIPE
-	
-	proc = subprocess.Popen(process_string, shell=True, stdout=stdout, stderr=subprocess.STDOUT)
-	
+	timeout = cfg.get_config("meta/timeouts/meshes")
+
+	# A session of its own, so Blender and its pool can be killed together
+	proc = subprocess.Popen(process_string, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+
+	# Read on a thread, so timeouts are noticed while Blender is silent
+	lines = queue.Queue()
+	def read_lines():
+		for line in proc.stdout:
+			lines.put(line.decode("utf-8", errors="replace"))
+		lines.put(None)
+	threading.Thread(target=read_lines, daemon=True).start()
+
+	building = {}
+	failed = {}
+	killed = False
 	while True:
-		line = proc.stdout.readline().decode("utf-8")
-		if not line:
+		try:
+			line = lines.get(timeout=1.)
+		except queue.Empty:
+			line = ""
+
+		if line is None:
 			break
 
-		if "Export completed" in line:
-			progress_bar.update(1)
+		if debug and line:
+			print(line, end="")
+
+		match = _blender_progress.match(line.strip())
+		if match:
+			event, seed, reason = match.group(1), int(match.group(2)), match.group(3)
+			if event == "Building":
+				building[seed] = time.monotonic()
+			elif event == "Failed":
+				building.pop(seed, None)
+				failed[seed] = reason
+			elif seed not in finished:
+				building.pop(seed, None)
+				finished.add(seed)
+				run_index.record("meshes", [seed])
+				progress_bar.update(1)
+
+		if timeout is not None:
+			now = time.monotonic()
+			timed_out = [seed for seed, start in building.items() if now - start > timeout]
+			if timed_out:
+				os.killpg(proc.pid, signal.SIGKILL)
+				killed = True
+
+				for seed in timed_out:
+					failed[seed] = f"timed out after {timeout} s"
+				break
+
+	returncode = proc.wait()
+
+	# Meshes that failed or were being built when Blender stopped are incomplete, and would
+	# otherwise be taken as finished
+	incomplete = set(building) | set(failed)
+	for seed in incomplete:
+		seed_dir = run_index.seed_directory(seed)
+		for filename in ("mesh.ply", "mesh.stl", "mesh.npz"):
+			if (seed_dir / filename).exists():
+				(seed_dir / filename).unlink()
+	run_index.forget("meshes", incomplete)
+
+	for seed in building:
+		# A crash is charged to every mesh in progress, as there is no telling which one caused it
+		if returncode != 0 and not killed and seed not in failed:
+			failed[seed] = f"Blender exited with code {returncode}"
 
-def main(config_path, overwrite=False, blendermode=False, debug=False):
+	return failed
+
+def format_seeds(seeds):
+	'''
+	Seeds as "1-4,7", so the Blender command line stays short when whole ranges are excluded
+	'''
+	runs = []
+	for seed in sorted(seeds):
+		if runs and runs[-1][1] == seed - 1:
+			runs[-1][1] = seed
+		else:
+			runs.append([seed, seed])
+
+	return ",".join(f"{start}-{end}" if end > start else f"{start}" for start, end in runs)
+
+def parse_seeds(text):
+	seeds = set()
+	for part in text.split(","):
+		start, _, end = part.partition("-")
+		seeds.update(range(int(start), int(end or start) + 1))
+
+	return seeds
+
+def main(config_path, overwrite=False, blendermode=False, debug=False, profile=False, exclude=()):
 	default_config_path = "config/default.yaml"
 	cfg = get_config(config_path, default_config_path)
 
+	# The Blender process is a subprocess of this one, so it is profiled along with it
+	if profile and not blendermode:
+		run_profiled(cfg, "three_d", sys.argv)
+		return
+
 	# generate_meshes can only be called via Blender. If this is a user-initiated script, it will be in Python mode,
 	# so we open a subprocess that runs generate_meshes via Blender
 	if blendermode:
-		generate_meshes(cfg, overwrite, debug)
+		generate_meshes(cfg, overwrite, debug, exclude)
 		return
 
 	if not cfg.get_config("patient/use_existing_meshes"):
-		n_meshes = 1 + int(cfg.get_config("meta/random_seeds/end")) - int(cfg.get_config("meta/random_seeds/start"))
 		print("Generating Meshes")
-		run_blender_process(n_meshes, config_path, overwrite, debug)
+		run_blender_process(cfg, config_path, overwrite, debug)
 
 	print("Generating Samples")
 	generate_samplesets(cfg, overwrite, debug)
 
+	FailureLog.from_config(cfg).print_report(RunIndex.from_config(cfg), stages=["meshes", "samples"])
+
 if __name__ == "__main__":	
 	parser = argparse.ArgumentParser(description='Turn a set of SWC files into mesh files.')
 	parser.add_argument('config_path', type=str, help='Path to the generator config file.')
 	parser.add_argument('-o','--overwrite', action='store_true', help='Overwrite existing files.')
 	parser.add_argument('--blendermode', action='store_true', help='Used by the automatic Blender script only.')
+	parser.add_argument('--exclude', type=parse_seeds, default=set(), help='Used by the automatic Blender script only.')
 	parser.add_argument('-d','--debug', action='store_true', help='Show output of script processes.')
+	parser.add_argument('-p','--profile', action='store_true', help='Profile all processes, including Blender, with py-spy into <root_directory>/profiles/three_d.txt.')
 
 	try:
 		python_commands_index = sys.argv.index("--")
@@ -79,4 +229,4 @@ if __name__ == "__main__":
 
 	args, unknown = parser.parse_known_args(parse_arguments)
 
-	main(args.config_path, args.overwrite, args.blendermode, args.debug)
\ No newline at end of file
+	main(args.config_path, args.overwrite, args.blendermode, args.debug, args.profile, args.exclude)
\ No newline at end of file
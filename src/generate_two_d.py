@@ -1,12 +1,20 @@
+import sys
 import argparse
 
-from utils import get_config
+from utils import get_config, write_parameter_index
+from utils.Profiler import run_profiled
 from two_d.generator import generate_images
 
-def main(config_path, overwrite=False, debug=False):
+def main(config_path, overwrite=False, debug=False, profile=False):
 	default_config_path = "config/default.yaml"
 	cfg = get_config(config_path, default_config_path)
 
+	if profile:
+		run_profiled(cfg, "two_d", sys.argv)
+		return
+
+	write_parameter_index(cfg, overwrite=overwrite)
+
 	generate_images(cfg, overwrite=overwrite, debug=debug)
 
 if __name__ == "__main__":
@@ -14,6 +22,7 @@ if __name__ == "__main__":
 	parser.add_argument('config_path', type=str, help='Path to the generator config file.')
 	parser.add_argument('-o','--overwrite', action="store_true", help='Overwrite existing files.')
 	parser.add_argument('-d','--debug', action="store_true", help='Show debug info (XRay only).')
+	parser.add_argument('-p','--profile', action="store_true", help='Profile all processes with py-spy into <root_directory>/profiles/two_d.txt.')
 	args = parser.parse_args()
 
-	main(args.config_path, args.overwrite, args.debug)
\ No newline at end of file
+	main(args.config_path, args.overwrite, args.debug, args.profile)
\ No newline at end of file
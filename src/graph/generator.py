@@ -1,33 +1,62 @@
 import os
 import sys
-import ray
 import time
 from tqdm import tqdm
 from pathlib import Path
 
 from .lib.NetworkBuilder import NetworkBuilder
+from utils import get_parameter_table
+from utils.RunIndex import RunIndex
+from utils.FailureLog import FailureLog
 
 def generate_networks(cfg, overwrite=False):
 	seed_start, seed_end = cfg.get_config("meta/random_seeds/start"), cfg.get_config("meta/random_seeds/end")
 	seeds = range(seed_start, seed_end + 1)
 
+	run_index = RunIndex.from_config(cfg)
+	if not overwrite:
+		existing = set(run_index.completed("networks", seeds))
+		seeds = [seed for seed in seeds if seed not in existing]
+	else:
+		# Until they are rebuilt, so a failure isn't hidden by the earlier networks
+		run_index.forget("networks", seeds)
+
+	if not seeds:
+		return
+
+	# Ray takes seconds to import, so it is only loaded once there are networks to generate
+	import ray
+	from ray.util import ActorPool
+
 	initialise_ray(cfg)
 
+	# Parameters are sampled once here, so each task only carries its seed and its row of parameters
+	parameters = get_parameter_table(cfg, seeds, overwrite=overwrite)
+
+	# The base config is sent once per worker rather than once per task
+	cfg_ref = ray.put(cfg)
+	RemoteNetworkWorker = ray.remote(NetworkWorker)
+	workers = [RemoteNetworkWorker.remote(cfg_ref, overwrite) for _ in range(cfg.get_config("meta/num_cpus"))]
+	pool = ActorPool(workers)
+
 	try:
-		futures = [generate_one_network.remote(cfg, seed, overwrite) for seed in seeds]
-		
-		wait_for_completion(futures, len(seeds))
+		for seed in seeds:
+			submit(pool, seed, parameters)
+
+		wait_for_completion(pool, len(seeds), run_index, parameters, FailureLog.from_config(cfg), cfg.get_config("meta/retries", 0))
 	except Exception as e:
-		[ray.cancel(process) for process in futures]
+		[ray.kill(worker) for worker in workers]
 		print(e)
 	except KeyboardInterrupt as k:
-		[ray.cancel(process) for process in futures]
+		[ray.kill(worker) for worker in workers]
 		try:
 			sys.exit(k)
 		except SystemExit:
 			os._exit(k)
 
 def initialise_ray(cfg):
+	import ray
+
 	ray_config={
 		"num_cpus": cfg.get_config("meta/num_cpus"),
 		"object_store_memory": 10**9
@@ -38,30 +67,63 @@ def initialise_ray(cfg):
 
 	ray.init(**{**ray_config, **additional_ray_config})
 
-@ray.remote
-def generate_one_network(cfg, seed, overwrite=False):
+class NetworkWorker(object):
+	"""Ray actor generating networks (made remote with `ray.remote` in `generate_networks`)"""
+	def __init__(self, cfg, overwrite=False):
+		self.cfg = cfg
+		self.overwrite = overwrite
+
+	def generate_one_network(self, seed, parameters):
+		return (seed, *generate_one_network(self.cfg, seed, parameters, self.overwrite))
+
+def generate_one_network(cfg, seed, parameters=None, overwrite=False):
+	'''
+	(return code, reason), where the reason says why a network wasn't created (None otherwise)
+	'''
 	if not overwrite:
 		pad = cfg.get_config("output/pad_zeros_to")
 		output_path = Path(cfg.get_config('output/root_directory')) / f"{seed:0{pad}}" / "network.swc"
 
-		if output_path.exists(): return NetworkBuilder.return_codes["SKIPPED_EXISTING_NETWORK"]
+		if output_path.exists(): return NetworkBuilder.return_codes["SKIPPED_EXISTING_NETWORK"], None
 	
-	network_cfg = cfg.generate(seed=seed)
+	network_cfg = cfg.generate_from_row(parameters) if parameters is not None else cfg.generate(seed=seed)
 
 	generator = NetworkBuilder(network_cfg, seed)
 	try:
 		result = generator.run()
 	except Exception as e:
-		print(e)
-		return -1
+		return NetworkBuilder.return_codes["FAILED_CREATING_NETWORK"], f"{type(e).__name__}: {e}"
+
+	if result == NetworkBuilder.return_codes["TIMED_OUT"]:
+		return result, f"timed out after {network_cfg.get_config('meta/timeouts/networks')} s"
+	if result == NetworkBuilder.return_codes["FAILED_CREATING_NETWORK"]:
+		return result, "VascuSynth exited with an error"
 
-	return result
+	return result, None
 
-def wait_for_completion(futures, total_seeds):
+def submit(pool, seed, parameters):
+	pool.submit(lambda worker, task: worker.generate_one_network.remote(*task), (seed, parameters.row(seed)))
+
+def wait_for_completion(pool, total_seeds, run_index, parameters, failures, retries=0):
 	progress_bar = tqdm(total=total_seeds)
-	completed_items = 0
 
-	while completed_items < total_seeds:
-		results, _ = ray.wait(futures, num_returns=1+completed_items)
-		completed_items += 1
-		progress_bar.update()
\ No newline at end of file
+	finished = (NetworkBuilder.return_codes["SUCCESSFULLY_CREATED_NETWORK"], NetworkBuilder.return_codes["SKIPPED_EXISTING_NETWORK"])
+	attempts = {}
+	while pool.has_next():
+		seed, result, reason = pool.get_next_unordered()
+		if result in finished:
+			run_index.record("networks", [seed])
+		elif result != NetworkBuilder.return_codes["KEYBOARD_INTERRUPT"]:
+			# The builder has deleted whatever the failed attempt left behind
+			run_index.forget("networks", [seed])
+
+			attempts[seed] = attempts.get(seed, 0) + 1
+			if attempts[seed] <= retries:
+				# Resubmitted with the same parameters, as a timeout or crash may not recur
+				submit(pool, seed, parameters)
+				continue
+
+			failures.record("networks", seed, reason, attempts[seed])
+		progress_bar.update()
+
+	failures.print_report(run_index, stages=["networks"])
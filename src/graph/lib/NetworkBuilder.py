@@ -2,12 +2,15 @@ import time
 import subprocess
 from pathlib import Path
 
+from utils.Telemetry import Telemetry
+
 class NetworkBuilder(object):
 	return_codes = {
 		"SUCCESSFULLY_CREATED_NETWORK": 0b00,
 		"SKIPPED_EXISTING_NETWORK": 0b01,
 		"FAILED_CREATING_NETWORK": 0b10,
-		"KEYBOARD_INTERRUPT": 0b11
+		"KEYBOARD_INTERRUPT": 0b11,
+		"TIMED_OUT": 0b100
 	}
 	
 	def __init__(self, cfg, seed):
@@ -15,13 +18,30 @@ class NetworkBuilder(object):
 		self.seed = seed
 
 	def run(self):
+		telemetry = Telemetry.from_config(self.config)
+
+		with telemetry.measure("networks", self.seed,
+							   nodes=self.config.get_config('patient/blood_vessels/mesh/number_of_nodes'),
+							   axial_refinement=self.config.get_config('patient/blood_vessels/mesh/axial_refinement')) as record:
+			result = self._run()
+
+			if result != self.return_codes["SUCCESSFULLY_CREATED_NETWORK"]:
+				record.status = next(name for name, code in self.return_codes.items() if code == result).lower()
+			record.add_output(self.output_path)
+
+		return result
+
+	@property
+	def output_path(self):
+		pad = self.config.get_config('output/pad_zeros_to')
+		return Path(self.config.get_config('output/root_directory')) / f"{self.seed:0{pad}}" / "network.swc"
+
+	def _run(self):
 		vascusynth_path = (Path(__file__) / '../VascuSynth/bin/VascuSynth').resolve()
 		assert vascusynth_path.exists(), f"{vascusynth_path} is not a valid VascuSynth path"
 
-		pad = self.config.get_config('output/pad_zeros_to')
-		output_path = Path(self.config.get_config('output/root_directory')) / f"{self.seed:0{pad}}"
-		output_path.mkdir(parents=True, exist_ok=True)
-		output_path /= "network.swc"
+		output_path = self.output_path
+		output_path.parent.mkdir(parents=True, exist_ok=True)
 
 		vascusynth_args = [
 			str(vascusynth_path),
@@ -45,6 +65,9 @@ class NetworkBuilder(object):
 			'--rs', self.seed,
 		]
 
+		timeout = self.config.get_config('meta/timeouts/networks')
+		start = time.monotonic()
+
 		process = subprocess.Popen([str(arg) for arg in vascusynth_args], stdout=subprocess.DEVNULL)
 
 		while process.poll() is None:
@@ -54,8 +77,20 @@ class NetworkBuilder(object):
 				process.terminate()
 				return self.return_codes["KEYBOARD_INTERRUPT"]
 
+			if timeout is not None and time.monotonic() - start > timeout:
+				process.kill()
+				process.wait()
+				self._remove_partial_output()
+				return self.return_codes["TIMED_OUT"]
+
 		if process.poll() != 0:
+			self._remove_partial_output()
 			return self.return_codes["FAILED_CREATING_NETWORK"]
 
 		return self.return_codes["SUCCESSFULLY_CREATED_NETWORK"]
+
+	def _remove_partial_output(self):
+		# A later run would otherwise skip the seed, taking the partial network as finished
+		if self.output_path.exists():
+			self.output_path.unlink()
 		
\ No newline at end of file
@@ -0,0 +1,45 @@
+import sys
+import argparse
+from pathlib import Path
+
+from utils import get_config
+from utils.ParameterIndex import ParameterIndex
+
+def main(config_path, conditions, output_path=None, list_columns=False):
+	default_config_path = (Path(__file__) / '../../config/default.yaml').resolve()
+	cfg = get_config(config_path, default_config_path)
+
+	# Read-only: without an index sampled from this config, the parameters are sampled in memory
+	root_dir = cfg.get_config("output/root_directory")
+	seed_start, seed_end = cfg.get_config("meta/random_seeds/start"), cfg.get_config("meta/random_seeds/end")
+
+	index = ParameterIndex.load_current(root_dir, cfg)
+	if index is None or not index.covers(range(seed_start, seed_end + 1)):
+		index = ParameterIndex.build(cfg)
+
+	if list_columns:
+		print("\n".join(index.columns.keys()))
+		return
+
+	pad = cfg.get_config("output/pad_zeros_to")
+	selected = [f"{seed:0{pad}}" for seed in index.select(*conditions)]
+
+	if output_path is None:
+		print("\n".join(selected))
+	else:
+		# Same format as the train/val/test .lst files
+		with open(output_path, 'w') as f:
+			f.write('\n'.join(selected))
+
+	# On stderr, so the seeds printed above can be piped into another tool
+	print(f"{len(selected)} of {len(index.seeds)} samples selected.", file=sys.stderr)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Select samples of a dataset by their sampled parameters.')
+	parser.add_argument('config_path', type=str, help='Path to the generator config file.')
+	parser.add_argument('-w','--where', type=str, action='append', default=[], help='Condition such as "patient/heart/size/width > 70". Can be given several times.')
+	parser.add_argument('--output', type=str, default=None, help='Write the selected sample folders to this .lst file.')
+	parser.add_argument('--columns', action='store_true', help='List the parameters that can be queried.')
+	args = parser.parse_args()
+
+	main(args.config_path, args.where, args.output, args.columns)
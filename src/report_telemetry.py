@@ -0,0 +1,48 @@
+import json
+import argparse
+from pathlib import Path
+
+from utils import get_config
+from utils.Telemetry import Telemetry, summarise
+
+def main(config_path, stage=None, slowest=5, output_path=None):
+	default_config_path = (Path(__file__) / '../../config/default.yaml').resolve()
+	cfg = get_config(config_path, default_config_path)
+
+	records = Telemetry.load(cfg.get_config("output/root_directory"))
+	if stage is not None:
+		records = [r for r in records if r["stage"] == stage]
+
+	if not records:
+		print("No telemetry recorded yet.")
+		return
+
+	summary = summarise(records)
+
+	print(f"{'stage':<10}{'seeds':>7}{'skipped':>9}{'errors':>8}{'wall (s)':>11}{'median':>9}{'p95':>9}{'max':>9}{'cpu/wall':>10}{'peak RSS (MB)':>15}{'output (MB)':>13}")
+	for name, s in summary.items():
+		print(f"{name:<10}{s['count']:>7}{s['skipped']:>9}{s['errors']:>8}{s['wall_total_s']:>11.1f}{s['wall_median_s']:>9.2f}{s['wall_p95_s']:>9.2f}{s['wall_max_s']:>9.2f}{s['cpu_per_wall']:>10.2f}{s['peak_rss_mb']:>15.0f}{s['output_mb']:>13.1f}")
+
+	for name, s in summary.items():
+		if s["phases_total_s"]:
+			phases = ", ".join(f"{phase} {100 * total / s['wall_total_s']:.0f}%" for phase, total in s["phases_total_s"].items())
+			print(f"\n{name} time by phase: {phases}")
+
+		stage_records = sorted((r for r in records if r["stage"] == name), key=lambda r: r["wall_s"], reverse=True)
+		print(f"\nSlowest {name}:")
+		for r in stage_records[:slowest]:
+			print(f"  seed {r['seed']:<8}{r['wall_s']:>9.2f}s  {r['status']:<22}{json.dumps(r['sizes'])}")
+
+	if output_path is not None:
+		with open(output_path, 'w') as f:
+			json.dump(summary, f, indent=4)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Summarise the per-seed timing and resource telemetry of a dataset.')
+	parser.add_argument('config_path', type=str, help='Path to the generator config file.')
+	parser.add_argument('-s', '--stage', type=str, help='Only report this stage (networks, meshes, samples or images).')
+	parser.add_argument('-n', '--slowest', type=int, default=5, help='Number of slowest seeds to list per stage.')
+	parser.add_argument('--output', type=str, help='Also save the summary as JSON.')
+	args = parser.parse_args()
+
+	main(args.config_path, args.stage, args.slowest, args.output)
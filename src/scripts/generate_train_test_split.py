@@ -37,8 +37,10 @@ args = parser.parse_args()
 if args.seed is not None:
     random.seed(args.seed)
 
+# Samples are the zero-padded seed directories. Run artefacts (telemetry, profiles, shards)
+# also live in the output folder, and are not samples.
 all_samples = [name for name in os.listdir(args.in_folder)
-               if os.path.isdir(os.path.join(args.in_folder, name))]
+               if name.isdigit() and os.path.isdir(os.path.join(args.in_folder, name))]
 
 if args.shuffle:
     random.shuffle(all_samples)
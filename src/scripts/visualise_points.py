@@ -4,15 +4,16 @@ import open3d as o3d
 
 parser = argparse.ArgumentParser(description='Visualise the generated points.')
 parser.add_argument('npz_file', type=str, help='Path to the points.npz file you want to visualise.')
-parser.add_argument('--unpack_bits', action="store_true", help='Use this flag if the occupancies are not packed into bits.')
+parser.add_argument('--unpack_bits', action="store_true", help='Force unpacking of the occupancies. Packed occupancies are otherwise detected automatically.')
 args = parser.parse_args()
 
 data = np.load(args.npz_file)
 points = data['points'].astype(np.float32)
 
 occupancies = data['occupancies']
-if args.unpack_bits:
-        occupancies = np.unpackbits(occupancies)[:points.shape[0]]
+# Packed occupancies (output/save/points_packbits) hold one bit per point
+if args.unpack_bits or (occupancies.dtype != bool and occupancies.shape[0] != points.shape[0]):
+        occupancies = np.unpackbits(occupancies, count=points.shape[0])
 occupancies = occupancies.astype(np.uint8)
 
 colors = np.zeros((occupancies.shape[0], 3))
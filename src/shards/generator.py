@@ -0,0 +1,109 @@
+import json
+from tqdm import tqdm
+from pathlib import Path
+
+from .lib.ShardWriter import ShardWriter
+from utils.RunIndex import RunIndex
+from utils.TaskExecutor import TaskExecutor
+
+# Approximate tar overhead per member (header plus padding), used when sizing shards
+_member_overhead = 1024
+
+def generate_shards(cfg, overwrite=False):
+	root_dir = Path(cfg.get_config("output/root_directory"))
+	shards_dir = root_dir / cfg.get_config("output/shards/directory")
+	max_shard_size = cfg.get_config("output/shards/max_size_mb") * 2**20
+	include = cfg.get_config("output/shards/include")
+
+	tasks = []
+	manifests = {}
+	for split, samples in get_splits(cfg).items():
+		shards = plan_shards(root_dir, samples, include, max_shard_size)
+
+		paths = [shards_dir / split / f"{split}-{i:06}.tar" for i in range(len(shards))]
+		tasks += [(path, members, overwrite) for path, members in zip(paths, shards)]
+
+		manifests[split] = {
+			"shards": [f"{split}/{path.name}" for path in paths],
+			"num_samples": sum(len({key for key, _, _, _, _ in members}) for members in shards)
+		}
+
+	with TaskExecutor.from_config(cfg) as executor:
+		for _ in tqdm(executor.starmap(write_one_shard, tasks, cost=shard_cost),
+						   total=len(tasks)):
+			pass
+
+	# Readers list a split's shards from its manifest, so shards left over from earlier runs are ignored
+	for split, manifest in manifests.items():
+		with open(shards_dir / f"{split}.json", "w") as f:
+			json.dump(manifest, f, indent=4)
+
+def get_splits(cfg):
+	'''
+	{split: [sample name, ...]} from the <split>.lst files in the output root directory (see
+	scripts/generate_train_test_split.py). Without any, every sample with a mesh goes into "all".
+	'''
+	root_dir = Path(cfg.get_config("output/root_directory"))
+
+	splits = {}
+	for split in cfg.get_config("output/shards/splits"):
+		split_file = root_dir / f"{split}.lst"
+		if split_file.exists():
+			with open(split_file, "r") as f:
+				splits[split] = [line.strip() for line in f if line.strip()]
+
+	if splits:
+		return splits
+
+	seed_start, seed_end = cfg.get_config("meta/random_seeds/start"), cfg.get_config("meta/random_seeds/end")
+	run_index = RunIndex.from_config(cfg)
+
+	return {"all": [run_index.seed_directory(seed).name for seed in run_index.completed("meshes", range(seed_start, seed_end + 1))]}
+
+def plan_shards(root_dir, samples, include, max_shard_size):
+	'''
+	Group the samples, in order, into shards of at most `max_shard_size` bytes (a shard holds at
+	least one sample). Each shard is a list of (key, name, filepath, size, mtime_ns) members.
+	'''
+	shards = [[]]
+	shard_size = 0
+
+	for sample in samples:
+		sample_dir = root_dir / sample
+
+		members = []
+		for pattern in include:
+			for filepath in sorted(sample_dir.glob(pattern)):
+				stat = filepath.stat()
+				members.append((sample, filepath.relative_to(sample_dir).as_posix(), str(filepath), stat.st_size, stat.st_mtime_ns))
+
+		if not members:
+			print(f"WARNING: Sample {sample} has none of the artefacts {', '.join(include)}. Skipping.")
+			continue
+
+		sample_size = sum(size + _member_overhead for _, _, _, size, _ in members)
+		if shards[-1] and shard_size + sample_size > max_shard_size:
+			shards.append([])
+			shard_size = 0
+
+		shards[-1] += members
+		shard_size += sample_size
+
+	return [shard for shard in shards if shard]
+
+def shard_cost(task):
+	return sum(size for _, _, _, size, _ in task[1])
+
+def write_one_shard(path, members, overwrite=False):
+	# A shard is only kept if it was written with the same members, as the manifest follows this plan
+	plan = ShardWriter.plan_hash(members)
+	if not overwrite and ShardWriter.written_plan(path) == plan:
+		return path
+
+	path.parent.mkdir(parents=True, exist_ok=True)
+
+	with ShardWriter(path, plan=plan) as shard:
+		for key, name, filepath, _, _ in members:
+			shard.add(key, name, filepath)
+
+	return path
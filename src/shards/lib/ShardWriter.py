@@ -0,0 +1,115 @@
+import os
+import json
+import hashlib
+import tarfile
+
+class ShardWriter(object):
+	"""Writes samples into one uncompressed tar shard, in the WebDataset layout: every member of
+	sample "00012" is named "00012.<artefact>", e.g. "00012.points.npz" or
+	"00012.images.normal.images.npy", and a sample's members are stored contiguously.
+
+	Alongside the shard, <shard>.index.json gives each member's data offset and size, so single
+	artefacts can be read back with one seek (see ShardReader). The shard and its index are
+	written under temporary names and renamed when closed, so an index only exists for a
+	complete shard. The index also records a hash of the members the shard was planned with (see
+	`plan_hash`), so a shard left over from a different plan can be told apart and rewritten.
+
+	Usage:
+		with ShardWriter("shards/train/train-000000.tar") as shard:
+			shard.add("00012", "points.npz", "output/00012/points.npz")
+	"""
+	index_suffix = ".index.json"
+
+	def __init__(self, path, plan=None):
+		self.path = str(path)
+		self.index_path = self.path + self.index_suffix
+		self.plan = plan
+
+		self._partial_path = self.path + ".partial"
+		self._tar = tarfile.open(self._partial_path, "w", format=tarfile.USTAR_FORMAT)
+		self._samples = {}
+
+	def add(self, key, name, filepath):
+		'''
+		Add the file at `filepath` as artefact `name` (e.g. "images/normal/images.npy") of sample `key`
+		'''
+		stat = os.stat(filepath)
+
+		info = tarfile.TarInfo(f"{key}.{name.replace('/', '.')}")
+		info.size = stat.st_size
+		info.mtime = int(stat.st_mtime)
+
+		header_offset = self._tar.offset
+		with open(filepath, "rb") as f:
+			self._tar.addfile(info, f)
+
+		data_offset = header_offset + len(info.tobuf(self._tar.format, self._tar.encoding, self._tar.errors))
+		self._samples.setdefault(key, {})[name] = [data_offset, info.size]
+
+	def close(self):
+		self._tar.close()
+
+		with open(self.index_path + ".partial", "w") as f:
+			json.dump({"shard": os.path.basename(self.path), "plan": self.plan, "samples": self._samples}, f)
+
+		os.replace(self._partial_path, self.path)
+		os.replace(self.index_path + ".partial", self.index_path)
+
+	@staticmethod
+	def plan_hash(members):
+		'''
+		Hash of a shard's planned (key, name, filepath, size, mtime_ns) members. The modification
+		time is included, as a re-rendered sample's arrays often keep their size.
+		'''
+		encoded = json.dumps([[key, name, str(filepath), size, mtime_ns] for key, name, filepath, size, mtime_ns in members])
+		return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+	@classmethod
+	def written_plan(cls, path):
+		'''
+		The plan hash of the complete shard at `path`, or None if there isn't one
+		'''
+		try:
+			with open(str(path) + cls.index_suffix, "r") as f:
+				return json.load(f).get("plan")
+		except (OSError, ValueError):
+			return None
+
+	def abort(self):
+		self._tar.close()
+		os.remove(self._partial_path)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
+
+class ShardReader(object):
+	"""Random access to the artefacts of a shard written by ShardWriter, through its index.
+
+	Usage:
+		shard = ShardReader("shards/train/train-000000.tar")
+		points = np.load(io.BytesIO(shard.read("00012", "points.npz")))
+	"""
+	def __init__(self, path):
+		self.path = str(path)
+
+		with open(self.path + ShardWriter.index_suffix, "r") as f:
+			self.samples = json.load(f)["samples"]
+
+	def keys(self):
+		return list(self.samples.keys())
+
+	def names(self, key):
+		return list(self.samples[key].keys())
+
+	def read(self, key, name):
+		offset, size = self.samples[key][name]
+
+		with open(self.path, "rb") as f:
+			f.seek(offset)
+			return f.read(size)
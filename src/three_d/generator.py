@@ -1,11 +1,12 @@
+import os
 import numpy as np
 from pathlib import Path
 from multiprocessing import Pool
-import multiprocessing.pool as mpp
 
 
 try:
 	from src.three_d.lib.MeshBuilder import MeshBuilder
+	from src.utils.Telemetry import Telemetry
 except ImportError:
 	"""
 	It means we are not running in Blender mode and hence don't need
@@ -14,15 +15,25 @@ except ImportError:
 
 
 try:
-	from .lib.MeshSampler import MeshSampler
-	from utils.PoolIStarMap import istarmap
+	from utils.TaskExecutor import TaskExecutor
+	from utils.RunIndex import RunIndex
+	from utils.FailureLog import FailureLog
+	from utils.Telemetry import Telemetry
+	from utils.SharedArrays import share, received, shared_prefix, release_unreceived
 except ImportError:
 	"""
 	It means we are running in Blender mode and hence don't need
 	this module
 	"""
 
-def generate_meshes(cfg, overwrite=False, debug=False):
+# Set once per sampling worker process by `initialise_worker`
+_worker_state = {}
+
+def generate_meshes(cfg, overwrite=False, debug=False, exclude=()):
+	'''
+	Runs in Blender, reporting progress on stdout as "Building <id>", "Export completed <id>" and
+	"Failed <id>: <reason>" lines for `run_blender_process` to follow. Seeds in `exclude` are skipped.
+	'''
 	root_dir = cfg.get_config("output/root_directory")
 	root_dir = Path(root_dir)
 
@@ -32,61 +43,170 @@ def generate_meshes(cfg, overwrite=False, debug=False):
 
 	mesh_resolution = cfg.get_config("patient/blood_vessels/mesh/resolution")
 	num_processes = cfg.get_config("meta/num_cpus")
+	telemetry = Telemetry.from_config(cfg)
 
-	with Pool(num_processes) as p:
-		results = p.starmap(generate_one_mesh, [(root_dir, f"{seed:0{pad}}", 0.8, overwrite) for seed in seeds])
+	with Pool(num_processes, maxtasksperchild=cfg.get_config("meta/max_tasks_per_worker")) as p:
+		# One task per chunk, as maxtasksperchild counts chunks
+		results = p.starmap(generate_one_mesh, [(root_dir, f"{seed:0{pad}}", 0.8, overwrite, telemetry) for seed in seeds if seed not in exclude], chunksize=1)
 
-def generate_one_mesh(path, mesh_id, mesh_resolution, overwrite=False):
+def generate_one_mesh(path, mesh_id, mesh_resolution, overwrite=False, telemetry=None):
+	# Flushed straight away, as the parent process times each mesh from these lines
 	if not overwrite:
 		mesh_path = Path(path / mesh_id / "mesh.ply")
 		if mesh_path.exists():
-			print("Export completed")
+			print(f"Export completed {mesh_id}", flush=True)
 			return
 
 
-	print("Building")
+	print(f"Building {mesh_id}", flush=True)
 
-	builder = MeshBuilder(path, mesh_id, mesh_resolution)
-	obj = builder.get_one_mesh_obj()
-	builder.save_one_mesh(obj)
+	telemetry = telemetry or Telemetry(path, enabled=False)
 
+	try:
+		with telemetry.measure("meshes", int(mesh_id), resolution=mesh_resolution) as record:
+			builder = MeshBuilder(path, mesh_id, mesh_resolution)
+			obj = builder.get_one_mesh_obj()
+			builder.save_one_mesh(obj)
 
-def generate_samplesets(cfg, overwrite=False, debug=False):
-	root_dir = cfg.get_config("output/root_directory")
-	root_dir = Path(root_dir)
+			record.sizes.update(segments=builder.num_segments, faces=builder.num_faces)
+			for filename in ("mesh.ply", "mesh.stl", "mesh.npz"):
+				record.add_output(path / mesh_id / filename)
+	except Exception as e:
+		# One bad network shouldn't stop the pool; the parent process retries it
+		print(f"Failed {mesh_id}: {type(e).__name__}: {e}", flush=True)
+		return
 
-	get_points = cfg.get_config("output/save/points")
-	get_pointcloud = cfg.get_config("output/save/pointcloud")
-	get_voxels = cfg.get_config("output/save/voxels")
-
-	points_size = cfg.get_config("patient/blood_vessels/points/number")
-	points_uniform_ratio = cfg.get_config("patient/blood_vessels/points/uniform_ratio")
-	pointcloud_size = cfg.get_config("patient/blood_vessels/pointcloud/number")
-	voxels_res = cfg.get_config("patient/blood_vessels/voxels/resolution")
+	print(f"Export completed {mesh_id}", flush=True)
 
-	resize = cfg.get_config("patient/blood_vessels/normalise")
 
-	num_processes = cfg.get_config("meta/num_cpus")
-	mpp.Pool.istarmap = istarmap
+def generate_samplesets(cfg, overwrite=False, debug=False, consumer=None):
+	'''
+	`consumer`, if given, is called in this process as consumer(seed, arrays) for every seed, with
+	{points, occupancies, pointcloud, pointcloud_normals, voxels, loc, scale} passed from the
+	workers through shared memory. The memory is freed as soon as the consumer returns.
+	'''
+	seed_start, seed_end = cfg.get_config("meta/random_seeds/start"), cfg.get_config("meta/random_seeds/end")
+	seeds = range(seed_start, seed_end + 1)
 
 	from tqdm import tqdm
 
-	with Pool(num_processes) as p:
-		iterable = [(item.parents[0], get_points, get_pointcloud, get_voxels, points_size, points_uniform_ratio, pointcloud_size, voxels_res, resize, overwrite) for item in root_dir.rglob("**/*.ply")]
-		for _ in tqdm(p.istarmap(generate_one_sampleset, iterable),
-						   total=len(iterable)):
-			pass
-
-def generate_one_sampleset(path, get_points, get_pointcloud, get_voxels, points_size, points_uniform_ratio, pointcloud_size, voxels_res, resize, overwrite=False):
-	MeshSampler.sample(
-		path, 
-		get_points=get_points, 
-		get_pointcloud=get_pointcloud, 
-		get_voxels=get_voxels,
-		points_size=points_size, 
-		points_uniform_ratio=points_uniform_ratio,
-		pointcloud_size=pointcloud_size,
-		voxels_res=voxels_res,
-		resize=resize,
-		overwrite=overwrite
-	)
\ No newline at end of file
+	# Work comes from the seed range and the run index, rather than from scanning the output tree
+	run_index = RunIndex.from_config(cfg)
+	mesh_seeds = run_index.completed("meshes", seeds)
+	if overwrite:
+		# Until they are resampled, so a failure isn't hidden by the earlier samples
+		run_index.forget("samples", mesh_seeds)
+
+	failures = FailureLog.from_config(cfg)
+	def on_failure(task, reason, attempts):
+		failures.record("samples", task[0], reason, attempts)
+
+	share_prefix = shared_prefix() if consumer is not None else None
+	try:
+		with TaskExecutor.from_config(cfg, stage="samples", initializer=initialise_worker, initargs=(cfg, overwrite, share_prefix)) as executor:
+			tasks = ((seed,) for seed in mesh_seeds)
+			# Sampling time grows with mesh size, so start with the biggest meshes
+			for seed, result in tqdm(executor.starmap(generate_one_sampleset, tasks, cost=sampleset_cost_estimator(run_index), memory=sampleset_memory_estimator(cfg, run_index), on_failure=on_failure),
+							   total=len(mesh_seeds)):
+				if consumer is not None:
+					with received(result) as arrays:
+						consumer(seed, arrays)
+
+				run_index.record("samples", [seed])
+	finally:
+		# Results shared by the workers but never received, e.g. when the consumer raised
+		if share_prefix is not None:
+			release_unreceived(share_prefix)
+
+def sampleset_options(cfg):
+	'''
+	The MeshSampler.sample arguments set by the config
+	'''
+	get_pointcloud = cfg.get_config("output/save/pointcloud")
+
+	return {
+		"get_points": cfg.get_config("output/save/points"),
+		"get_pointcloud": get_pointcloud,
+		"get_pointcloud_normals": get_pointcloud and cfg.get_config("output/save/pointcloud_normals", False),
+		"get_voxels": cfg.get_config("output/save/voxels"),
+		"points_size": cfg.get_config("patient/blood_vessels/points/number"),
+		"points_uniform_ratio": cfg.get_config("patient/blood_vessels/points/uniform_ratio"),
+		"pointcloud_size": cfg.get_config("patient/blood_vessels/pointcloud/number"),
+		"voxels_res": cfg.get_config("patient/blood_vessels/voxels/resolution"),
+		"resize": cfg.get_config("patient/blood_vessels/normalise"),
+		"points_packbits": cfg.get_config("output/save/points_packbits", False),
+		"points_float16": cfg.get_config("output/save/points_float16", False),
+		"points_compressed": cfg.get_config("output/save/points_compressed", False)
+	}
+
+def sampleset_cost_estimator(run_index):
+	def cost(task):
+		return os.path.getsize(run_index.seed_directory(task[0]) / "mesh.ply")
+
+	return cost
+
+# Rough peak bytes held by MeshSampler per mesh face (trimesh caches and the triangle hash), per
+# voxel (float64 grid points and their noisy, normalised copies) and per sampled point
+_sampleset_bytes_per_face = 500
+_sampleset_bytes_per_voxel = 200
+_sampleset_bytes_per_point = 150
+
+def sampleset_memory_estimator(cfg, run_index):
+	'''
+	Function estimating the peak memory of sampling one seed's mesh, from its face count and the
+	number of points, pointcloud points and voxels sampled
+	'''
+	options = sampleset_options(cfg)
+
+	fixed = 0
+	if options["get_voxels"]:
+		fixed += _sampleset_bytes_per_voxel * options["voxels_res"]**3
+	if options["get_points"]:
+		fixed += _sampleset_bytes_per_point * options["points_size"]
+	if options["get_pointcloud"]:
+		fixed += _sampleset_bytes_per_point * options["pointcloud_size"]
+
+	def estimate(task):
+		return fixed + _sampleset_bytes_per_face * read_ply_face_count(run_index.seed_directory(task[0]) / "mesh.ply")
+
+	return estimate
+
+def read_ply_face_count(path):
+	'''
+	Number of faces declared in a PLY header, without reading the mesh
+	'''
+	with open(path, "rb") as f:
+		for line in f:
+			if line.startswith(b"element face"):
+				return int(line.split()[2])
+			if line.startswith(b"end_header"):
+				break
+
+	return 0
+
+def initialise_worker(cfg, overwrite=False, share_prefix=None):
+	'''
+	Receives the base config once per worker and reads the sampling options and telemetry
+	settings from it once per worker
+	'''
+	_worker_state["root_directory"] = Path(cfg.get_config("output/root_directory"))
+	_worker_state["pad"] = cfg.get_config("output/pad_zeros_to")
+	_worker_state["options"] = sampleset_options(cfg)
+	_worker_state["telemetry"] = Telemetry.from_config(cfg)
+	_worker_state["overwrite"] = overwrite
+	_worker_state["share_prefix"] = share_prefix
+
+def generate_one_sampleset(seed):
+	# Imported in the worker, as trimesh and the compiled mesh extensions are slow to load
+	from .lib.MeshSampler import MeshSampler
+
+	share_prefix = _worker_state["share_prefix"]
+	result = MeshSampler.sample(
+		_worker_state["root_directory"] / f"{seed:0{_worker_state['pad']}}",
+		**_worker_state["options"],
+		overwrite=_worker_state["overwrite"],
+		telemetry=_worker_state["telemetry"],
+		return_arrays=share_prefix is not None
+	)
+
+	return seed, share(result, prefix=share_prefix) if share_prefix is not None else None
@@ -14,6 +14,10 @@ class MeshBuilder(object):
 		self.id = id
 		self.mesh_resolution = mesh_resolution
 
+		# Sizes of the last mesh built, for telemetry
+		self.num_segments = None
+		self.num_faces = None
+
 		if 'bpy' not in sys.modules:
 			raise ImportError("This class cannot be used using Python. It must be run inside Blender as a script. Exiting.")
 
@@ -150,6 +154,7 @@ class MeshBuilder(object):
 	def get_one_mesh_obj(self):
 		swc_filepath = self.path / f"{self.id}" / "network.swc"
 		swc_data = self.read_segments_from_file(swc_filepath)
+		self.num_segments = swc_data["num_segments"]
 
 		return self.build_vessel_from_segments(swc_data)
 
@@ -179,6 +184,7 @@ class MeshBuilder(object):
 
 		verts = np.array([v.co for v in bm.verts])
 		faces = np.array([[me.loops[loop_index].vertex_index for loop_index in poly.loop_indices] for poly in me.polygons])
+		self.num_faces = len(faces)
 
 		np.savez_compressed(
 			output_npz_path,
@@ -16,39 +16,82 @@ from scipy import ndimage
 
 from .triangle_hasher.triangle_hash import TriangleHash as _TriangleHash
 from .libvoxelize.voxelize import voxelize_mesh_
+from utils import atomic_path
+from utils.PointsFile import PointsFile
+from utils.Telemetry import Telemetry
+from utils.SharedArrays import MappedArray
 
 
 class MeshSampler(object):
 	@classmethod
-	def sample(cls, path, get_points=True, get_pointcloud=True, get_voxels=True, points_size=100000, points_uniform_ratio=0.9, pointcloud_size=2048, voxels_res=32, resize=True, overwrite=False):
-		points, occupancies, pointcloud, voxels, normalised_mesh, loc, scale = cls.get_data(
-			path, 
-			get_points=get_points,
-			get_pointcloud=get_pointcloud,
-			get_voxels=get_voxels,
-			points_size=points_size, 
-			points_uniform_ratio=points_uniform_ratio,
-			pointcloud_size=pointcloud_size,
-			voxels_res=voxels_res, 
-			resize=resize, 
-			overwrite=overwrite
-		)
-
-		cls.save_data(path, points, occupancies, pointcloud, voxels, normalised_mesh, loc, scale)
+	def sample(cls, path, get_points=True, get_pointcloud=True, get_voxels=True, points_size=100000, points_uniform_ratio=0.9, pointcloud_size=2048, voxels_res=32, resize=True,
+						points_packbits=False, points_float16=False, points_compressed=False, overwrite=False, telemetry=None, return_arrays=False, get_pointcloud_normals=False):
+		'''
+		With `return_arrays`, returns {points, occupancies, pointcloud, pointcloud_normals, voxels, loc,
+		scale}. Points and pointclouds that already existed are read from disk (the pointcloud and its
+		normals as MappedArray handles); existing voxels are not read back and are None.
+		'''
+		telemetry = telemetry or Telemetry(path.parent, enabled=False)
+
+		with telemetry.measure("samples", int(path.name), points=points_size, pointcloud=pointcloud_size, voxels_res=voxels_res) as record:
+			points, occupancies, pointcloud, pointcloud_normals, voxels, normalised_mesh, loc, scale = cls.get_data(
+				path, 
+				get_points=get_points,
+				get_pointcloud=get_pointcloud,
+				get_pointcloud_normals=get_pointcloud_normals,
+				get_voxels=get_voxels,
+				points_size=points_size, 
+				points_uniform_ratio=points_uniform_ratio,
+				pointcloud_size=pointcloud_size,
+				voxels_res=voxels_res, 
+				resize=resize, 
+				overwrite=overwrite
+			)
+
+			cls.save_data(path, points, occupancies, pointcloud, voxels, normalised_mesh, loc, scale,
+				points_packbits=points_packbits, points_float16=points_float16, points_compressed=points_compressed, pointcloud_normals=pointcloud_normals)
+
+			if normalised_mesh is None:
+				record.status = "skipped"
+			else:
+				record.sizes["faces"] = len(normalised_mesh.faces)
+
+			for filename in ("points.npz", "pointcloud.npy", "pointcloud_normals.npy", "model.binvox", "normalised_mesh.ply", "normalised_mesh.stl"):
+				record.add_output(path / filename)
+
+		if not return_arrays:
+			return
+
+		if points is None and get_points and (path / "points.npz").exists():
+			points, occupancies, loc, scale = PointsFile.load(path / "points.npz")
+		if pointcloud is None and get_pointcloud and (path / "pointcloud.npy").exists():
+			pointcloud = MappedArray(path / "pointcloud.npy")
+		if pointcloud_normals is None and get_pointcloud_normals and (path / "pointcloud_normals.npy").exists():
+			pointcloud_normals = MappedArray(path / "pointcloud_normals.npy")
+
+		return {
+			"points": points,
+			"occupancies": occupancies,
+			"pointcloud": pointcloud,
+			"pointcloud_normals": pointcloud_normals,
+			"voxels": voxels.data if voxels is not None else None,
+			"loc": loc,
+			"scale": scale
+		}
 
 	@classmethod
 	def get_data(cls, path, get_points=True, get_pointcloud=True, get_voxels=True,resize=False,bbox_padding=0,
-						rotate_xz=0, voxels_res=32, points_size=100000, points_uniform_ratio=1., pointcloud_size=2048, overwrite=False):
+						rotate_xz=0, voxels_res=32, points_size=100000, points_uniform_ratio=1., pointcloud_size=2048, overwrite=False, get_pointcloud_normals=False):
 		if not overwrite and (path / "points.npz").exists():
 			get_points = False
 		
-		if not overwrite and (path / "pointcloud.npy").exists():
+		if not overwrite and (path / "pointcloud.npy").exists() and (not get_pointcloud_normals or (path / "pointcloud_normals.npy").exists()):
 			get_pointcloud = False
 
 		if not overwrite and (path / "model.binvox").exists():
 			get_voxels = False
 
-		if not get_points and not get_pointcloud and not get_voxels: return (None,) * 7
+		if not get_points and not get_pointcloud and not get_voxels: return (None,) * 8
 
 		mesh = trimesh.load(path / "mesh.ply",process=False)
 		if not mesh.is_watertight:
@@ -77,26 +120,43 @@ class MeshSampler(object):
 
 		try:
 			voxels = cls.get_voxels(mesh,loc,scale,voxels_res=voxels_res) if get_voxels else None
-			points, occupancies = cls.get_points(mesh,loc,scale,points_size=points_size,points_uniform_ratio=points_uniform_ratio) if get_points else (None, None)
-			pointcloud = cls.get_pointcloud(mesh, pointcloud_size) if get_pointcloud else None
+
+			# The near-surface points and the pointcloud are drawn from the surface in one pass
+			n_points_surface = points_size - int(points_size * points_uniform_ratio) if get_points else 0
+			surface_samples, pointcloud_samples = SurfaceSampler(mesh, seed=1).sample_many(n_points_surface, pointcloud_size if get_pointcloud else 0)
+
+			points, occupancies = cls.get_points(mesh,loc,scale,points_size=points_size,points_uniform_ratio=points_uniform_ratio,surface_points=surface_samples[0]) if get_points else (None, None)
+			pointcloud, _, pointcloud_normals = pointcloud_samples if get_pointcloud else (None, None, None)
 		except Exception as e:
-			print(f"Error with item {ply_file}: {e}")
-			return (None,) * 7
+			# Raised rather than skipped, so the seed is retried and then recorded as failed
+			raise RuntimeError(f"Error sampling {path / 'mesh.ply'}: {e}") from e
 
-		return points, occupancies, pointcloud, voxels, mesh, loc, scale
+		if not get_pointcloud_normals:
+			pointcloud_normals = None
+
+		return points, occupancies, pointcloud, pointcloud_normals, voxels, mesh, loc, scale
 
 	@classmethod
-	def save_data(cls, path, points=None, occupancies=None, pointcloud=None, voxels=None, normalised_mesh=None, loc=None, scale=None):
+	def save_data(cls, path, points=None, occupancies=None, pointcloud=None, voxels=None, normalised_mesh=None, loc=None, scale=None,
+						points_packbits=False, points_float16=False, points_compressed=False, pointcloud_normals=None):
 
+		# Written under temporary names, as get_data skips any of these files that exist
 		if voxels is not None:
-			with open(path / "model.binvox","wb") as f:
+			with atomic_path(path / "model.binvox") as partial_path, open(partial_path,"wb") as f:
 				voxels.write(f)
 
 		if points is not None:
-			np.savez(path / "points.npz", points=points, occupancies=occupancies, loc=loc, scale=scale)
+			with atomic_path(path / "points.npz") as partial_path:
+				PointsFile.save(partial_path, points, occupancies, loc=loc, scale=scale,
+					packbits=points_packbits, float16=points_float16, compressed=points_compressed)
 		
+		if pointcloud_normals is not None:
+			with atomic_path(path / "pointcloud_normals.npy") as partial_path:
+				np.save(partial_path, pointcloud_normals)
+
 		if pointcloud is not None:
-			np.save(path / "pointcloud.npy", pointcloud)
+			with atomic_path(path / "pointcloud.npy") as partial_path:
+				np.save(partial_path, pointcloud)
 
 		if normalised_mesh is not None:
 			normalised_mesh.export(path / "normalised_mesh.ply")
@@ -115,7 +175,11 @@ class MeshSampler(object):
 
 	@classmethod
 	def get_points(cls, mesh, loc, scale, points_size=100000, points_uniform_ratio=1.,
-							points_padding=0.1, points_sigma=0.01):
+							points_padding=0.1, points_sigma=0.01, surface_points=None):
+		'''
+		`surface_points`, if given, are the points_size * (1 - points_uniform_ratio) surface points to
+		perturb, e.g. drawn along with the pointcloud by a SurfaceSampler
+		'''
 
 		n_points_uniform = int(points_size * points_uniform_ratio)
 		n_points_surface = points_size - n_points_uniform
@@ -124,8 +188,9 @@ class MeshSampler(object):
 		np.random.seed(1)
 		points_uniform = np.random.rand(n_points_uniform, 3)
 		points_uniform = boxsize * (points_uniform - 0.5)
-		points_surface = mesh.sample(n_points_surface)
-		points_surface += points_sigma * np.random.randn(n_points_surface, 3)
+		if surface_points is None:
+			surface_points, _, _ = SurfaceSampler(mesh, seed=1).sample(n_points_surface)
+		points_surface = surface_points + points_sigma * np.random.randn(n_points_surface, 3)
 		points = np.concatenate([points_uniform, points_surface], axis=0)
 
 		occupancies = cls.check_mesh_contains(mesh, points)
@@ -135,7 +200,8 @@ class MeshSampler(object):
 
 	@classmethod
 	def get_pointcloud(cls, mesh, pointcloud_size=2048):
-		return mesh.sample(pointcloud_size)
+		pointcloud, _, _ = SurfaceSampler(mesh, seed=1).sample(pointcloud_size)
+		return pointcloud
 
 	@classmethod
 	def check_mesh_contains(cls, mesh, points, hash_resolution=512):
@@ -212,6 +278,57 @@ class MeshSampler(object):
 		return p
 
 
+class SurfaceSampler(object):
+	"""Draws points uniformly over the surface of a mesh. The face areas and their cumulative
+	distribution are computed once, so several sets of points (e.g. the near-surface occupancy
+	points and the pointcloud) are drawn with a single lookup. Every point comes with the index
+	and unit normal of the face it lies on, so oriented pointclouds cost nothing extra.
+
+	Usage:
+		sampler = SurfaceSampler(mesh, seed=1)
+		(surface_points, _, _), (pointcloud, face_index, normals) = sampler.sample_many(10000, 100000)
+	"""
+	def __init__(self, mesh, seed=None):
+		triangles = np.asarray(mesh.vertices)[np.asarray(mesh.faces)]
+
+		self.origins = triangles[:, 0]
+		self.edges = triangles[:, 1:] - triangles[:, :1]
+
+		cross = np.cross(self.edges[:, 0], self.edges[:, 1])
+		double_areas = np.linalg.norm(cross, axis=1)
+
+		# Degenerate faces have no area, so are never drawn and keep a zero normal
+		self.face_normals = np.divide(cross, double_areas[:, None], out=np.zeros_like(cross), where=double_areas[:, None] > 0)
+		self.cdf = np.cumsum(double_areas)
+
+		self._random_obj = np.random.RandomState(seed)
+
+	def sample(self, count):
+		'''
+		(points, face_index, normals) for `count` points
+		'''
+		face_index = np.searchsorted(self.cdf, self._random_obj.random_sample(count) * self.cdf[-1], side="right")
+		face_index = np.minimum(face_index, len(self.cdf) - 1)
+
+		# Barycentric coordinates, with those outside the triangle reflected back into it
+		uv = self._random_obj.random_sample((count, 2))
+		outside = uv.sum(axis=1) > 1
+		uv[outside] = 1 - uv[outside]
+
+		edges = self.edges[face_index]
+		points = self.origins[face_index] + uv[:, :1] * edges[:, 0] + uv[:, 1:] * edges[:, 1]
+
+		return points, face_index, self.face_normals[face_index]
+
+	def sample_many(self, *counts):
+		'''
+		One (points, face_index, normals) per count, all drawn in a single pass
+		'''
+		points, face_index, normals = self.sample(sum(counts))
+		splits = np.cumsum(counts)[:-1]
+
+		return list(zip(np.split(points, splits), np.split(face_index, splits), np.split(normals, splits)))
+
 class MeshIntersector:
 	def __init__(self, mesh, resolution=512):
 		triangles = mesh.vertices[mesh.faces].astype(np.float64)
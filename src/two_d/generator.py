@@ -1,24 +1,138 @@
 import io
 import numpy as np
+from multiprocessing import util
 from tqdm import tqdm
-from multiprocessing import Pool
-import multiprocessing.pool as mpp
+from pathlib import Path
 
 from .lib.ImageBuilder import ImageBuilder
-from utils.PoolIStarMap import istarmap
+from utils import get_image_operations, get_parameter_table
+from utils.TaskExecutor import TaskExecutor
+from utils.RunIndex import RunIndex
+from utils.FailureLog import FailureLog
+from utils.SharedArrays import share, received, shared_prefix, release_unreceived
 
-def generate_images(cfg, overwrite=False, debug=False):
+# Set once per worker process by `initialise_worker`
+_worker_state = {}
+
+def generate_images(cfg, overwrite=False, debug=False, consumer=None):
+	'''
+	`consumer`, if given, is called in this process as consumer(seed, imagesets) for every seed,
+	with {group: (images, depths, matrices)}. Workers pass the arrays through shared memory rather
+	than pickling them, and the memory is freed as soon as the consumer returns, so the consumer
+	must copy anything it keeps.
+	'''
 	seed_start, seed_end = cfg.get_config("meta/random_seeds/start"), cfg.get_config("meta/random_seeds/end")
 	seeds = range(seed_start, seed_end + 1)
 
-	num_processes = cfg.get_config("meta/num_cpus")
-	mpp.Pool.istarmap = istarmap
+	# Parameters are sampled once here, so each task only carries its seed and its row of parameters
+	parameters = get_parameter_table(cfg, seeds, overwrite=overwrite)
+
+	run_index = RunIndex.from_config(cfg)
+
+	# Seeds without a mesh (e.g. recorded as failed by the meshes stage) would only fail again here
+	seeds = run_index.completed("meshes", seeds)
+	if overwrite:
+		# Until they are rendered again, so a failure isn't hidden by the earlier images
+		run_index.forget("images", seeds)
+
+	failures = FailureLog.from_config(cfg)
+	def on_failure(task, reason, attempts):
+		failures.record("images", task[0], reason, attempts)
+
+	# Workers return while their seed's files are still being written, so a seed only goes into
+	# the run index once its imagesets are all on disk
+	image_operations = list(get_image_operations(cfg))
+	unwritten = set()
+	def record_written():
+		written = [seed for seed in sorted(unwritten) if ImageBuilder.imagesets_written(run_index.seed_directory(seed) / "images", image_operations)]
+		run_index.record("images", written)
+		unwritten.difference_update(written)
 
-	with Pool(num_processes) as p:
-		iterable = [(cfg, seed, overwrite, debug) for seed in seeds]
-		for _ in tqdm(p.istarmap(ImageBuilder.generate_one_imageset, iterable),
-						   total=len(iterable)):
-			pass
+	share_prefix = shared_prefix() if consumer is not None else None
+	try:
+		with TaskExecutor.from_config(cfg, stage="images", initializer=initialise_worker, initargs=(cfg, overwrite, debug, share_prefix)) as executor:
+			tasks = ((seed, parameters.row(seed)) for seed in seeds)
+			for seed, result in tqdm(executor.starmap(generate_one_imageset, tasks, memory=imageset_memory_estimator(cfg), on_failure=on_failure),
+							   total=len(seeds)):
+				if consumer is not None:
+					with received(result) as imagesets:
+						consumer(seed, imagesets)
+
+				if result:
+					unwritten.add(seed)
+				record_written()
+	finally:
+		# Results shared by the workers but never received, e.g. when the consumer raised
+		if share_prefix is not None:
+			release_unreceived(share_prefix)
+
+	# The workers have finished their writes by the time they exit
+	record_written()
+	for seed in sorted(unwritten):
+		failures.record("images", seed, "image files were not all written (see the worker's telemetry)")
+
+	failures.print_report(run_index, stages=["images"])
 
 	# for seed in seeds:
-	# 	ImageBuilder.generate_one_imageset(cfg, seed, overwrite)
\ No newline at end of file
+	# 	ImageBuilder.generate_one_imageset(cfg, seed, overwrite)
+
+# Rough peak bytes per pixel of every frame: the rendered image and depth (up to float64 each),
+# held once raw and once more per image processing group
+_imageset_bytes_per_pixel = 16
+
+def imageset_memory_estimator(cfg):
+	'''
+	Function estimating the peak memory of rendering and processing one seed's images, from the
+	image size, the number of image processing groups and the seed's number of frames. When
+	streaming, at most a chunk of frames per group is held at once. Otherwise, the previous seed's
+	processed groups may still be waiting on the worker's writer.
+	'''
+	width = cfg.get_config("equipment/fluoroscope/specifications/image_dimensions/width")
+	height = cfg.get_config("equipment/fluoroscope/specifications/image_dimensions/height")
+	num_groups = len(cfg.get_config("operation/image_processing"))
+
+	streaming = cfg.get_config("output/save/streaming", False)
+	frames_held = cfg.get_config("output/save/frames_chunk_size", 16) + cfg.get_config("output/save/writer_queue_size", 16)
+
+	def estimate(task):
+		_, parameters = task
+		num_frames = len(parameters["operation/protocol"])
+		if streaming:
+			return _imageset_bytes_per_pixel * width * height * min(num_frames, frames_held) * (1 + num_groups)
+
+		return _imageset_bytes_per_pixel * width * height * num_frames * (1 + 2 * num_groups)
+
+	return estimate
+
+def initialise_worker(cfg, overwrite=False, debug=False, share_prefix=None):
+	'''
+	Receives the base config once per worker and resolves the image operations once per worker
+	'''
+	_worker_state["cfg"] = cfg
+	_worker_state["image_operations"] = get_image_operations(cfg)
+	_worker_state["overwrite"] = overwrite
+	_worker_state["debug"] = debug
+	_worker_state["share_prefix"] = share_prefix
+
+	# One writer per worker, so a seed's files are encoded while the next seed renders. It is
+	# drained when the worker exits, including when it is replaced after max_tasks_per_worker.
+	writer = ImageBuilder.background_writer(cfg)
+	_worker_state["writer"] = writer
+	util.Finalize(writer, writer.close, exitpriority=10)
+
+def generate_one_imageset(seed, parameters):
+	result = ImageBuilder.generate_one_imageset(
+		_worker_state["cfg"],
+		seed,
+		overwrite=_worker_state["overwrite"],
+		debug=_worker_state["debug"],
+		image_operations=_worker_state["image_operations"],
+		parameters=parameters,
+		return_arrays=_worker_state["share_prefix"] is not None,
+		writer=_worker_state["writer"]
+	)
+
+	if _worker_state["share_prefix"] is not None:
+		result = share(result, prefix=_worker_state["share_prefix"])
+
+	return seed, result
@@ -1,22 +1,22 @@
-import trimesh
-import pyrender
+import sys
+import itertools
 import numpy as np
-from PIL import Image
 from pathlib import Path
-from copy import deepcopy
+from collections.abc import Mapping
 
 from .Renderer import OpticalRenderer, XRayRenderer
-from utils import get_image_operations
+from utils import get_image_operations, atomic_path
+from utils.BackgroundWriter import BackgroundWriter
+from utils.FrameStore import FrameStore, FrameStoreWriter
+from utils.SharedArrays import MappedArray
+from utils.Telemetry import Telemetry
 
 
 def save_np_to_pfm(np_array,filepath):
-	np_array = np_array.astype(np.float32)
+	np_array = np.ascontiguousarray(np_array, dtype=np.float32)
 
 	color = None
 
-	if np_array.dtype.name != 'float32':
-		raise Exception('Image dtype must be float32.')
-
 	if len(np_array.shape) == 3 and np_array.shape[2] == 3: # color image
 		color = True
 	elif len(np_array.shape) == 2 or len(np_array.shape) == 3 and np_array.shape[2] == 1: # greyscale
@@ -24,96 +24,224 @@ def save_np_to_pfm(np_array,filepath):
 	else:
 		raise Exception('Image must have H x W x 3, H x W x 1 or H x W dimensions.')
 
-	with open(filepath, "w") as file:
-		file.write('PF\n' if color else 'Pf\n')
-		file.write('%d %d\n' % (np_array.shape[1], np_array.shape[0]))
+	# PFM stores the byte order in the sign of the scale: negative means little-endian
+	endian = np_array.dtype.byteorder
+	little_endian = endian == '<' or (endian == '=' and sys.byteorder == 'little')
+
+	with open(filepath, "wb") as file:
+		file.write(b'PF\n' if color else b'Pf\n')
+		file.write(b'%d %d\n' % (np_array.shape[1], np_array.shape[0]))
+		file.write(b'%f\n' % (-1 if little_endian else 1))
+		file.write(np_array.tobytes())
 
-		endian = np_array.dtype.byteorder
+def save_np_to_png(np_array, filepath):
+	from PIL import Image
 
-		file.write('%f\n' % 1)
+	if np_array.dtype != np.uint8:
+		np_array = np_array.astype(np.uint8)
 
-		np_array.tofile(file)
+	Image.fromarray(np.ascontiguousarray(np_array)).save(filepath)
 
 class ImageBuilder(object):
 	@classmethod
-	def generate_one_imageset(cls, cfg, seed, overwrite=False, debug=False):
+	def generate_one_imageset(cls, cfg, seed, overwrite=False, debug=False, image_operations=None, parameters=None, return_arrays=False, writer=None):
+		'''
+		`image_operations` and `parameters` (this seed's row of a ParameterTable) can be passed in
+		when they have already been resolved, otherwise they are derived from `cfg`.
+
+		Given a long-lived `writer` (a BackgroundWriter, e.g. one per worker), the imagesets are
+		queued on it and this returns without waiting for them, so the next seed renders while they
+		are encoded. Their matrices.npz files are written last, so `imagesets_written` tells when the
+		seed is finished.
+
+		With `return_arrays`, returns {group: (images, depths, matrices)} rather than True. Imagesets
+		that are only on disk (already generated, or streamed) give MappedArray handles to their
+		images.npy and depths.npy.
+		'''
 		root_dir = cfg.get_config("output/root_directory")
 		root_dir = Path(root_dir)
 		pad = cfg.get_config("output/pad_zeros_to")
 		out_dir = Path(cfg.get_config('output/root_directory')) / f"{seed:0{pad}}" / "images"
 		pad = cfg.get_config('output/pad_zeros_to')
 
-		image_operations = get_image_operations(cfg)
+		if image_operations is None:
+			image_operations = get_image_operations(cfg)
 		mesh_npz_filepath = root_dir / f"{seed:0{pad}}" / "mesh.npz"
 		mesh_stl_filepath = root_dir / f"{seed:0{pad}}" / "mesh.stl"
 		mesh_ply_filepath = root_dir / f"{seed:0{pad}}" / "mesh.ply"
-		mesh = cls.load_mesh(mesh_npz_filepath)
+
+		save_as_numpy = cfg.get_config("output/save/images_as_numpy", True)
+		save_as_frames = cfg.get_config("output/save/images_as_frames", False)
 
 		if not overwrite:
+			expected_outputs = ["matrices.npz"]
+			if save_as_numpy:
+				expected_outputs += ["images.npy", "depths.npy"]
+			if save_as_frames:
+				expected_outputs += [f"image_frames/{FrameStore.index_filename}", f"depth_frames/{FrameStore.index_filename}"]
+
 			everything_exists = True
 			for item in image_operations:
-				for sub_item in ["images.npy", "depths.npy", "matrices.npz"]:
+				for sub_item in expected_outputs:
 					if not (out_dir / item / sub_item).exists():
 						everything_exists = False
 
 			if everything_exists:
-				return True
-
-		image_cfg = cfg.generate(seed=seed)
-
-		render_type = cfg.get_config("meta/renderer")
+				return cls.load_imagesets(out_dir, image_operations) if return_arrays else True
 
-		if render_type == "optical":
-			renderer = OpticalRenderer(image_cfg)
-		elif render_type == "xray":
-			renderer = XRayRenderer(image_cfg, debug=debug)
-		else:
-			raise NotImplementedError(f"Value '{render_type}' for config 'meta/renderer' is not valid. Must be one of: 'optical', 'xray'")
+		telemetry = Telemetry.from_config(cfg)
 
-		raw_images, raw_depths, raw_matrices = renderer.generate_data(mesh=mesh, stl_filepath=str(mesh_stl_filepath.resolve()))
+		with telemetry.measure("images", seed) as record:
+			mesh = cls.load_mesh(mesh_npz_filepath)
 
-		processed_images = cls.process_images(raw_images, raw_depths, raw_matrices, image_operations)
+			image_cfg = cfg.generate_from_row(parameters) if parameters is not None else cfg.generate(seed=seed)
 
-		save_as_png = cfg.get_config("output/save/images_as_png")
-		save_as_pfm = cfg.get_config("output/save/depths_as_pfm")
+			render_type = cfg.get_config("meta/renderer")
 
-		for imageset_name, imageset_data in processed_images.items():
-			imageset_images, imageset_depths, imageset_matrices = imageset_data
+			if render_type == "optical":
+				renderer = OpticalRenderer(image_cfg)
+			elif render_type == "xray":
+				renderer = XRayRenderer(image_cfg, debug=debug)
+			else:
+				raise NotImplementedError(f"Value '{render_type}' for config 'meta/renderer' is not valid. Must be one of: 'optical', 'xray'")
 
-			save_to = out_dir / imageset_name
-			save_to.mkdir(parents=True, exist_ok=True)
+			protocol_plan = image_cfg.get_config("operation/protocol")
+			save_as_png = cfg.get_config("output/save/images_as_png")
+			save_as_pfm = cfg.get_config("output/save/depths_as_pfm")
 
-			np.save(save_to / "images.npy", imageset_images)
-			np.save(save_to / "depths.npy", imageset_depths)
-			np.savez_compressed(save_to / "matrices.npz", **imageset_matrices)
-
-			if save_as_png:
-				png_folder = save_to / "images"
-				png_folder.mkdir(parents=True, exist_ok=True)
+			record.sizes.update(
+				faces=cls.mesh_num_faces(mesh), frames=len(protocol_plan), groups=len(image_operations),
+				pixels=renderer.image_size[0] * renderer.image_size[1],
+				stored_copies=int(bool(save_as_numpy)) + int(bool(save_as_frames)), png=int(bool(save_as_png)), pfm=int(bool(save_as_pfm))
+			)
+			frames_chunk_size = cfg.get_config("output/save/frames_chunk_size", 16)
+			frames_compression = cfg.get_config("output/save/frames_compression")
+
+			if cfg.get_config("output/save/streaming", False):
+				# Streaming already overlaps rendering and writing, one frame at a time, on its own writer
+				stream_writer = cls.background_writer(cfg)
+				streams = {
+					imageset_name: ImagesetStream(
+						out_dir / imageset_name, stream_writer, len(protocol_plan),
+						save_as_numpy=save_as_numpy, save_as_frames=save_as_frames, save_as_png=save_as_png, save_as_pfm=save_as_pfm,
+						frames_chunk_size=frames_chunk_size, frames_compression=frames_compression
+					)
+					for imageset_name in image_operations
+				}
+
+				with stream_writer:
+					cls.stream_imagesets(renderer, mesh, mesh_stl_filepath, image_operations, streams, record)
+
+				# After the writer has finished, so matrices.npz only exists once everything else does
+				with record.phase("write"):
+					for stream in streams.values():
+						stream.close(protocol_plan)
+
+				record.add_output(out_dir)
+				return cls.load_imagesets(out_dir, image_operations) if return_arrays else True
+
+			with record.phase("render"):
+				raw_images, raw_depths, raw_matrices = renderer.generate_data(mesh=mesh, stl_filepath=str(mesh_stl_filepath.resolve()))
+
+			with record.phase("process"):
+				processed_images = cls.process_images(raw_images, raw_depths, raw_matrices, image_operations)
+			record.sizes["output_pixels"] = cls.output_pixels(processed_images)
+
+			jobs = []
+			markers = []
+			for imageset_name, imageset_data in processed_images.items():
+				imageset_images, imageset_depths, imageset_matrices = imageset_data
+
+				save_to = out_dir / imageset_name
+				save_to.mkdir(parents=True, exist_ok=True)
+
+				# A matrices.npz from an earlier run would mark the imageset as written before it is
+				if (save_to / "matrices.npz").exists():
+					(save_to / "matrices.npz").unlink()
+				markers.append((save_to / "matrices.npz", {**imageset_matrices, **protocol_plan.to_dict()}))
+
+				if save_as_numpy:
+					jobs.append((np.save, (save_to / "images.npy", imageset_images), {}))
+					jobs.append((np.save, (save_to / "depths.npy", imageset_depths), {}))
+
+				if save_as_frames:
+					jobs.append((FrameStore.write, (save_to / "image_frames", imageset_images), {"chunk_size": frames_chunk_size, "compression": frames_compression}))
+					jobs.append((FrameStore.write, (save_to / "depth_frames", imageset_depths), {"chunk_size": frames_chunk_size, "compression": frames_compression}))
+
+				if save_as_png:
+					png_folder = save_to / "images"
+					png_folder.mkdir(parents=True, exist_ok=True)
+
+					for i in range(imageset_images.shape[2]):
+						jobs.append((save_np_to_png, (imageset_images[:,:,i], png_folder / f"image_{i}.png"), {}))
+
+				if save_as_pfm:
+					pfm_folder = save_to / "depths"
+					pfm_folder.mkdir(parents=True, exist_ok=True)
+
+					for i in range(imageset_depths.shape[2]):
+						jobs.append((save_np_to_pfm, (imageset_depths[:,:,i], pfm_folder / f"depth_{i}.pfm"), {}))
+
+			# Run on a writer thread once every other file is written. Output bytes are only known then,
+			# so the telemetry record is held back until this point.
+			def written():
+				for path, matrices in markers:
+					with atomic_path(path) as partial_path:
+						np.savez_compressed(partial_path, **matrices)
+				record.add_output(out_dir)
+				record.finish()
+
+			def failed(error):
+				record.status = f"error: {type(error).__name__}"
+				record.finish()
+
+			record.defer()
+
+			if writer is not None:
+				with record.phase("write"):
+					writer.submit_all(jobs, then=written, on_error=failed)
+			else:
+				with record.phase("write"), cls.background_writer(cfg) as own_writer:
+					own_writer.submit_all(jobs, then=written, on_error=failed)
+
+		return processed_images if return_arrays else True
 
-				for i in range(imageset_images.shape[2]):
-					arr = imageset_images[:,:,i]
-					rgb_image = np.zeros((arr.shape[0], arr.shape[1], 3))
-					rgb_image[:, :, 0] = arr
-					rgb_image[:, :, 1] = arr
-					rgb_image[:, :, 2] = arr
+	@staticmethod
+	def background_writer(cfg):
+		return BackgroundWriter(
+			max_queue_size=cfg.get_config("output/save/writer_queue_size", 16),
+			num_threads=cfg.get_config("output/save/writer_threads", 2)
+		)
 
-					im = Image.fromarray(rgb_image.astype(np.uint8))
+	@staticmethod
+	def imagesets_written(out_dir, image_operations):
+		'''
+		Whether every imageset of a seed is on disk, as marked by its matrices.npz, which is written last
+		'''
+		return all((Path(out_dir) / imageset_name / "matrices.npz").exists() for imageset_name in image_operations)
 
-					im.save(png_folder / f"image_{i}.png")
-			if save_as_pfm:
-				pfm_folder = save_to / "depths"
-				pfm_folder.mkdir(parents=True, exist_ok=True)
+	@staticmethod
+	def load_imagesets(out_dir, image_operations):
+		'''
+		{group: (images, depths, matrices)} of imagesets already on disk, with the images and depths
+		as MappedArray handles
+		'''
+		imagesets = {}
+		for imageset_name in image_operations:
+			path = Path(out_dir) / imageset_name
+			assert (path / "images.npy").exists(), f"{path} has no images.npy to return. Enable output/save/images_as_numpy."
 
-				for i in range(imageset_depths.shape[2]):
-					arr = imageset_depths[:,:,i]
+			with np.load(path / "matrices.npz") as data:
+				matrices = {name: data[name] for name in ("K", "P", "R", "t")}
 
-					save_np_to_pfm(arr, pfm_folder / f"depth_{i}.pfm")
+			imagesets[imageset_name] = (MappedArray(path / "images.npy"), MappedArray(path / "depths.npy"), matrices)
 
-		return True
+		return imagesets
 
 	@staticmethod
 	def load_mesh(path):
+		import pyrender
+
 		dat = np.load(path)
 
 		verts = dat["verts"]
@@ -121,23 +249,199 @@ class ImageBuilder(object):
 
 		return pyrender.Mesh([pyrender.Primitive(positions=verts, indices=faces)])
 
+	@classmethod
+	def stream_imagesets(cls, renderer, mesh, mesh_stl_filepath, image_operations, streams, record):
+		'''
+		Render, process and write one frame at a time, so memory no longer grows with the number of
+		frames. Each frame goes through the same shared-stage processing as a whole sequence would.
+
+		Note that `resize` renormalises each frame against its own range, rather than against the
+		range of the whole sequence.
+		'''
+		matrices, frames = renderer.stream_data(mesh=mesh, stl_filepath=str(mesh_stl_filepath.resolve()))
+		frames = iter(frames)
+
+		for i in itertools.count():
+			with record.phase("render"):
+				frame = next(frames, None)
+			if frame is None:
+				break
+
+			image, depth = frame
+			frame_matrices = {name: matrix[..., i:i + 1] for name, matrix in matrices.items()}
+
+			with record.phase("process"):
+				processed_images = cls.process_images(np.dstack([image]), np.dstack([depth]), frame_matrices, image_operations)
+			if i == 0:
+				record.sizes["output_pixels"] = cls.output_pixels(processed_images)
+
+			with record.phase("write"):
+				for imageset_name, imageset_data in processed_images.items():
+					streams[imageset_name].append(*imageset_data)
+
+	@staticmethod
+	def output_pixels(processed_images):
+		'''
+		Pixels in one frame of every image processing group together
+		'''
+		return sum(images.shape[0] * images.shape[1] for images, _, _ in processed_images.values())
+
+	@staticmethod
+	def mesh_num_faces(mesh):
+		return sum(len(primitive.indices) for primitive in mesh.primitives if primitive.indices is not None)
+
 	@staticmethod
 	def process_images(images, depths, matrices, process_groups_cfg):
+		'''
+		Groups that start with the same operations (e.g. several resizes after the same crop) share
+		those stages, which are run only once. Image operations never modify their inputs, so stages
+		are passed between groups without copying and intermediate results are released as soon as
+		no remaining group needs them.
+		'''
+		stage_keys = {}
+		for process_group_name, (funcs, cfgs) in process_groups_cfg.items():
+			keys = [()]
+			for func, cfg in zip(funcs, cfgs):
+				keys.append(keys[-1] + ((func, _freeze(cfg)),))
+			stage_keys[process_group_name] = keys
+
+		last_use = {}
+		for group_index, keys in enumerate(stage_keys.values()):
+			for key in keys:
+				last_use[key] = group_index
+
+		stages = {(): (images, depths, matrices)}
 		processed_images = {}
-		for process_group_name, process_group_ops in process_groups_cfg.items():
-			processed_data = (
-				deepcopy(images),
-				deepcopy(depths),
-				deepcopy(matrices)
+		for group_index, (process_group_name, (funcs, cfgs)) in enumerate(process_groups_cfg.items()):
+			keys = stage_keys[process_group_name]
+
+			for i, (func, cfg) in enumerate(zip(funcs, cfgs)):
+				if keys[i + 1] not in stages:
+					stages[keys[i + 1]] = func(*stages[keys[i]], **cfg)
+
+			processed_images[process_group_name] = stages[keys[-1]]
+
+			for key in [key for key in stages if last_use.get(key) == group_index]:
+				del stages[key]
+
+		return processed_images
+
+class ImagesetStream(object):
+	"""Writes the outputs of one image processing group as its frames arrive.
+
+	images.npy and depths.npy are allocated on disk for the whole sequence when the first frame
+	arrives and filled `frames_chunk_size` frames at a time. Frame stores are appended to directly,
+	PNG and PFM files go through the background writer, and matrices.npz (which marks the
+	imageset as complete) is written last, by `close`.
+	"""
+	def __init__(self, path, writer, num_frames, save_as_numpy=True, save_as_frames=False, save_as_png=False,
+				 save_as_pfm=False, frames_chunk_size=16, frames_compression=None):
+		self.path = Path(path)
+		self.writer = writer
+		self.num_frames = num_frames
+		self.save_as_numpy = save_as_numpy
+		self.save_as_png = save_as_png
+		self.save_as_pfm = save_as_pfm
+		self.chunk_size = frames_chunk_size
+
+		self.path.mkdir(parents=True, exist_ok=True)
+
+		# A matrices.npz from an earlier run would mark the imageset as complete while it is rewritten
+		if (self.path / "matrices.npz").exists():
+			(self.path / "matrices.npz").unlink()
+
+		self._counts = [0, 0]
+		self._written = [0, 0]
+		self._arrays = None
+		self._pending = []
+		self._matrices = []
+
+		self._frame_stores = None
+		if save_as_frames:
+			self._frame_stores = (
+				FrameStoreWriter(self.path / "image_frames", chunk_size=frames_chunk_size, compression=frames_compression),
+				FrameStoreWriter(self.path / "depth_frames", chunk_size=frames_chunk_size, compression=frames_compression)
 			)
 
-			funcs, cfgs = process_group_ops
-			while funcs:
-				func = funcs.pop(0)
-				cfg = cfgs.pop(0)
-
-				processed_data = func(*processed_data, **cfg)
-
-			processed_images[process_group_name] = processed_data
+		if save_as_png:
+			(self.path / "images").mkdir(parents=True, exist_ok=True)
+		if save_as_pfm:
+			(self.path / "depths").mkdir(parents=True, exist_ok=True)
+
+	def append(self, images, depths, matrices):
+		'''
+		Add the (H, W, n) processed images and depths of one rendered frame, and its matrices
+		'''
+		self._matrices.append(matrices)
+
+		if self.save_as_numpy:
+			self._pending.append((images, depths))
+			if len(self._pending) == self.chunk_size:
+				self._flush()
+
+		if self._frame_stores is not None:
+			self._frame_stores[0].extend(images)
+			self._frame_stores[1].extend(depths)
+
+		if self.save_as_png:
+			for i in range(images.shape[2]):
+				self.writer.submit(save_np_to_png, images[:,:,i], self.path / "images" / f"image_{self._counts[0] + i}.png")
+
+		if self.save_as_pfm:
+			for i in range(depths.shape[2]):
+				self.writer.submit(save_np_to_pfm, depths[:,:,i], self.path / "depths" / f"depth_{self._counts[1] + i}.pfm")
+
+		self._counts[0] += images.shape[2]
+		self._counts[1] += depths.shape[2]
+
+	def close(self, protocol_plan):
+		self._flush()
+
+		if self._arrays is not None:
+			for array in self._arrays:
+				array.flush()
+			self._arrays = None
+
+		if self._frame_stores is not None:
+			for store in self._frame_stores:
+				store.close()
+
+		matrices = {name: np.concatenate([m[name] for m in self._matrices], axis=-1) for name in self._matrices[0]} if self._matrices else {}
+		with atomic_path(self.path / "matrices.npz") as partial_path:
+			np.savez_compressed(partial_path, **matrices, **protocol_plan.to_dict())
+
+	def _flush(self):
+		if not self._pending:
+			return
+
+		chunks = (
+			np.concatenate([images for images, _ in self._pending], axis=2),
+			np.concatenate([depths for _, depths in self._pending], axis=2)
+		)
+
+		if self._arrays is None:
+			# A rendered frame can have several channels, which are stacked along the frame axis
+			self._arrays = tuple(
+				np.lib.format.open_memmap(
+					self.path / filename, mode="w+", dtype=chunk.dtype,
+					shape=(*chunk.shape[:2], self.num_frames * chunk.shape[2] // len(self._pending))
+				)
+				for filename, chunk in zip(("images.npy", "depths.npy"), chunks)
+			)
 
-		return processed_images
\ No newline at end of file
+		for array, chunk, start in zip(self._arrays, chunks, self._written):
+			array[:, :, start:start + chunk.shape[2]] = chunk
+
+		self._written = [start + chunk.shape[2] for start, chunk in zip(self._written, chunks)]
+		self._pending = []
+
+def _freeze(value):
+	'''
+	Turn a (possibly nested) operation config into something hashable, so identical
+	operations can be recognised across groups.
+	'''
+	if isinstance(value, Mapping):
+		return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+	if isinstance(value, (list, tuple)):
+		return tuple(_freeze(v) for v in value)
+	return value
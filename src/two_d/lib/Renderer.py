@@ -1,6 +1,5 @@
 import os
 import sys
-import pyrender
 import importlib
 import numpy as np
 
@@ -12,6 +11,8 @@ class _Renderer(object):
 			"angle": [0, 0],        #(Positioner Primary Angle, Positioner Secondary Angle)
 			"position": [0, 0, 0]   #(TableX, TableY, TableZ)
 		}
+		self._pose_cache = (None, None)
+		self._camera_matrix = None
 
 	@property
 	def SID(self):
@@ -37,67 +38,102 @@ class _Renderer(object):
 
 	@property
 	def pose(self):
-		return MatrixCalculator.DICOMtoPose(
-			self.configuration["angle"][0],
-			self.configuration["angle"][1],
-			self.SID,
-			self.configuration["position"]
-		)
+		# Only recompute when the C-arm or table has actually moved
+		key = (*self.configuration["angle"], *self.configuration["position"])
+		if self._pose_cache[0] != key:
+			self._pose_cache = (key, MatrixCalculator.DICOMtoPose(
+				self.configuration["angle"][0],
+				self.configuration["angle"][1],
+				self.SID,
+				self.configuration["position"]
+			))
+
+		return self._pose_cache[1]
 
 	@property
 	def cameraMatrix(self):
-		return MatrixCalculator.camParamsToIntrinsic(
-			fx=self.SID/self.pixel_size[0],
-			fy=self.SID/self.pixel_size[1],
-			image_dims=self.image_size
-		)
+		if self._camera_matrix is None:
+			self._camera_matrix = MatrixCalculator.camParamsToIntrinsic(
+				fx=self.SID/self.pixel_size[0],
+				fy=self.SID/self.pixel_size[1],
+				image_dims=self.image_size
+			)
 
-	def perform_protocol(self, protocol,**kwargs):
-		images = []
-		depths = []
-		matrices = {"K": [], "P": [], "R": [], "t": []}
+		return self._camera_matrix
+
+	def perform_protocol(self, plan, mesh, **kwargs):
+		'''
+		Render every frame of a compiled ProtocolPlan, stacked frame-last
+		'''
+		return self.collect(*self.stream_protocol(plan, mesh, **kwargs))
 
-		for item in protocol:
-			if "capture" in item:
-				im, dp = self.get_image(**kwargs)
+	def stream_protocol(self, plan, mesh, **kwargs):
+		'''
+		Render the frames of a compiled ProtocolPlan one at a time. All camera matrices are computed
+		up front, so the loop only moves the equipment and renders.
 
-				images += [im]
-				depths += [dp]
+		Returns the matrices of every frame and a generator of (image, depth) per frame.
+		'''
+		angles = np.stack([-plan.ppa, plan.psa], axis=1)
+		positions = plan.positions(mesh.centroid)
+		centred = plan.centred.any(axis=1)
 
-				mats = MatrixCalculator.poseToExtrinsics(self.pose)
-				matrices["K"] += [self.cameraMatrix]
-				matrices["P"] += [self.pose]
-				matrices["R"] += [mats["R"]]
-				matrices["t"] += [mats["t"]]
+		matrices = self.get_matrices(angles, positions)
+		poses = np.moveaxis(matrices["P"], -1, 0)
 
-			if "centre" in item:
-				self.centre_table(protocol_item=item, **kwargs)
-			
-			if "fluoroscope" in item:
-				self.orient_fluoroscope(protocol_item=item, **kwargs)
+		def frames():
+			for i in range(len(plan)):
+				self.set_frame(angles[i], positions[i], poses[i], centred=centred[i], mesh=mesh)
 
-			if "table" in item:
-				self.move_table(protocol_item=item, **kwargs)
+				yield self.get_image(mesh=mesh, **kwargs)
 
-		for matrix in matrices:
-			matrices[matrix] = np.dstack(matrices[matrix])
+		return matrices, frames()
+
+	@staticmethod
+	def collect(matrices, frames):
+		'''
+		Gather streamed frames into (H, W, N) stacks, as returned by `generate_data`
+		'''
+		images = []
+		depths = []
+
+		for im, dp in frames:
+			images += [im]
+			depths += [dp]
 
 		return np.dstack(images), np.dstack(depths), matrices
 
-	def generate_data(self, mesh):
-		raise NotImplementedError("Renderer must implement a `generate_data` method")
+	def get_matrices(self, angles, positions):
+		'''
+		Camera matrices for every captured frame, computed in one batch and stacked frame-last
+		'''
+		angles = np.asarray(angles, dtype=np.float64).reshape(-1, 2)
+		poses = MatrixCalculator.DICOMtoPoseBatch(angles[:, 0], angles[:, 1], self.SID, positions)
+		extrinsics = MatrixCalculator.poseToExtrinsicsBatch(poses)
+
+		return {
+			"K": np.repeat(self.cameraMatrix[:, :, np.newaxis], len(poses), axis=2),
+			"P": np.moveaxis(poses, 0, -1),
+			"R": np.moveaxis(extrinsics["R"], 0, -1),
+			"t": extrinsics["t"].T[np.newaxis]
+		}
 
-	def get_image(self, **kwargs):
-		raise NotImplementedError("Renderer must implement a `get_image` method")
+	def set_frame(self, angle, position, pose, **kwargs):
+		'''
+		Move the fluoroscope and table to the state of one captured frame, whose pose is already known
+		'''
+		self.configuration["angle"] = [angle[0], angle[1]]
+		self.configuration["position"] = [position[0], position[1], position[2]]
+		self._pose_cache = ((*self.configuration["angle"], *self.configuration["position"]), pose)
 
-	def centre_table(self, **kwargs):
-		raise NotImplementedError("Renderer must implement a `centre_table` method")
+	def generate_data(self, mesh, **kwargs):
+		return self.collect(*self.stream_data(mesh, **kwargs))
 
-	def orient_fluoroscope(self, **kwargs):
-		raise NotImplementedError("Renderer must implement a `orient_fluoroscope` method")
+	def stream_data(self, mesh, **kwargs):
+		raise NotImplementedError("Renderer must implement a `stream_data` method")
 
-	def move_table(self, **kwargs):
-		raise NotImplementedError("Renderer must implement a `move_table` method")
+	def get_image(self, **kwargs):
+		raise NotImplementedError("Renderer must implement a `get_image` method")
 
 class OpticalRenderer(_Renderer):
 	def __init__(self, cfg):
@@ -118,6 +154,9 @@ class OpticalRenderer(_Renderer):
 		self._init_pyrender()
 
 	def _init_pyrender(self):
+		# Imported here so only processes that actually render load pyrender and OpenGL
+		import pyrender
+
 		self.scene = pyrender.Scene()
 		self.light = self.scene.add(pyrender.DirectionalLight(color=np.ones(3), intensity=1.0), self.pose)
 		self.renderer = pyrender.OffscreenRenderer(*self.image_size)
@@ -147,35 +186,27 @@ class OpticalRenderer(_Renderer):
 
 		return image.astype(np.uint8), depth
 
-	def centre_table(self, mesh, **kwargs):
-		cx, cy, cz = mesh.centroid
-		self.configuration["position"] = [-cx, -cy, -cz]
-
-	def orient_fluoroscope(self, protocol_item, **kwargs):
-		self.configuration["angle"][0] = -protocol_item["fluoroscope"].get("ppa", self.configuration["angle"][0])
-		self.configuration["angle"][1] = protocol_item["fluoroscope"].get("psa", self.configuration["angle"][1])
-
-	def move_table(self, protocol_item, **kwargs):
-		self.configuration["position"][0] = protocol_item["table"].get("x", self.configuration["position"][0])
-		self.configuration["position"][1] = protocol_item["table"].get("y", self.configuration["position"][1])
-		self.configuration["position"][2] = protocol_item["table"].get("z", self.configuration["position"][2])
-
-	def generate_data(self, mesh, **kwargs):
+	def stream_data(self, mesh, **kwargs):
 		mesh_obj = self.scene.add(mesh)
 
-		protocol = self.config.get_config("operation/protocol")
+		plan = self.config.get_config("operation/protocol")
 
-		images, depths, matrices = self.perform_protocol(protocol, mesh=mesh)
+		matrices, frames = self.stream_protocol(plan, mesh=mesh)
 
-		self.scene.remove_node(mesh_obj)
+		def frames_in_scene():
+			try:
+				yield from frames
+			finally:
+				self.scene.remove_node(mesh_obj)
 
-		return images, depths, matrices
+		return matrices, frames_in_scene()
 
 class XRayRenderer(_Renderer):
 	def __init__(self, cfg, debug=False):
 		super().__init__()
 		self.config = cfg
 		self.debug = debug
+		self._centred = False
 		if not self.debug:
 			self._redirect_output()
 
@@ -230,59 +261,40 @@ class XRayRenderer(_Renderer):
 	
 		return image.astype(np.uint8), depth
 
-	def centre_table(self, mesh, **kwargs):
-		cx, cy, cz = mesh.centroid
-		self.configuration["position"] = [-cx, -cy, -cz]
+	def set_frame(self, angle, position, pose, centred=False, mesh=None, **kwargs):
+		if centred and not self._centred:
+			cx, cy, cz = mesh.centroid
+			self.configuration["position"] = [-cx, -cy, -cz]
+			self._centred = True
 
-		self.gvxr.moveToCenter("Exported")
+			self.gvxr.moveToCenter("Exported")
 
-	def orient_fluoroscope(self, protocol_item, **kwargs):
-		old_ppa_angle = self.configuration["angle"][0]
-		old_psa_angle = self.configuration["angle"][1]
+		old_ppa_angle, old_psa_angle = self.configuration["angle"]
+		new_ppa_angle, new_psa_angle = angle
 
-		new_ppa_angle = -protocol_item["fluoroscope"].get("ppa", self.configuration["angle"][0])
-		new_psa_angle = protocol_item["fluoroscope"].get("psa", self.configuration["angle"][1])
+		if (old_ppa_angle, old_psa_angle) != (new_ppa_angle, new_psa_angle):
+			# Rotation is not commutative, so first undo any existing move in reverse order 
+			self.gvxr.rotateNode("Exported", -old_psa_angle, 1, 0, 0)
+			self.gvxr.rotateNode("Exported", -old_ppa_angle, 0, 0, 1)
 
-		self.configuration["angle"][0] = new_ppa_angle
-		self.configuration["angle"][1] = new_psa_angle
+			self.gvxr.rotateNode("Exported", new_ppa_angle, 0, 0, 1)
+			self.gvxr.rotateNode("Exported", new_psa_angle, 1, 0, 0)
 
-		# Rotation is not commutative, so first undo any existing move in reverse order 
-		self.gvxr.rotateNode("Exported", -old_psa_angle, 1, 0, 0)
-		self.gvxr.rotateNode("Exported", -old_ppa_angle, 0, 0, 1)
+		delta_table = np.subtract(position, self.configuration["position"])
+		if delta_table.any():
+			self.gvxr.translateScene(delta_table[0], delta_table[1], delta_table[2], "mm")
 
-		self.gvxr.rotateNode("Exported", new_ppa_angle, 0, 0, 1)
-		self.gvxr.rotateNode("Exported", new_psa_angle, 1, 0, 0)
+		super().set_frame(angle, position, pose)
 
 		# self.gvxr.displayScene()
 		# self.gvxr.renderLoop()
 
-	def move_table(self, protocol_item, **kwargs):
-		old_table_x = self.configuration["position"][0]
-		old_table_y = self.configuration["position"][1]
-		old_table_z = self.configuration["position"][2]
-
-		new_table_x = protocol_item["table"].get("x", self.configuration["position"][0])
-		new_table_y = protocol_item["table"].get("y", self.configuration["position"][1])
-		new_table_z = protocol_item["table"].get("z", self.configuration["position"][2])
-
-		self.configuration["position"][0] = new_table_x
-		self.configuration["position"][1] = new_table_y
-		self.configuration["position"][2] = new_table_z
-
-		delta_table_x = new_table_x - old_table_x
-		delta_table_y = new_table_y - old_table_y
-		delta_table_z = new_table_z - old_table_z
-
-		self.gvxr.translateScene(delta_table_x, delta_table_y, delta_table_z, "mm")
-
-	def generate_data(self, stl_filepath, mesh, **kwargs):
+	def stream_data(self, mesh, stl_filepath, **kwargs):
 		self.gvxr.loadSceneGraph(stl_filepath, "mm")
 		# self.gvxr.loadMeshFile("Exported", stl_filepath, "mm")
 		self.gvxr.setElement("Exported", "I")
 		# self.gvxr.setHU("Exported", 1000)
 
-		protocol = self.config.get_config("operation/protocol")
-
-		images, depths, matrices = self.perform_protocol(protocol, mesh=mesh)
+		plan = self.config.get_config("operation/protocol")
 
-		return images, depths, matrices
\ No newline at end of file
+		return self.stream_protocol(plan, mesh=mesh)
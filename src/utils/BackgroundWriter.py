@@ -0,0 +1,109 @@
+import queue
+import threading
+from warnings import warn
+
+class BackgroundWriter(object):
+	"""Runs file writes on background threads fed by a bounded queue, so the caller can
+	carry on rendering/processing while output is encoded. When the queue is full, `submit`
+	blocks, which keeps memory bounded if the disk falls behind.
+
+	Usage:
+		with BackgroundWriter() as writer:
+			writer.submit(np.save, path, array)
+	"""
+	def __init__(self, max_queue_size=16, num_threads=1):
+		self._queue = queue.Queue(maxsize=max(1, max_queue_size))
+		self._errors = []
+		self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(max(1, num_threads))]
+
+		for thread in self._threads:
+			thread.start()
+
+	def submit(self, func, *args, **kwargs):
+		'''
+		Queue `func(*args, **kwargs)` to be run on a writer thread. Arrays passed in must not be
+		modified by the caller afterwards.
+		'''
+		self._raise_errors()
+		self._queue.put((func, args, kwargs))
+
+	def submit_all(self, jobs, then=None, on_error=None):
+		'''
+		Queue every (func, args, kwargs) in `jobs`, and run `then()` once they have all succeeded
+		(e.g. to write a completion marker). If any fails, or `then()` raises, `on_error(error)` is
+		run instead. Errors of these jobs and callbacks are not re-raised by `submit` or `close`, so
+		one seed's failed writes don't fail whatever is submitted next; an error raised by
+		`on_error` itself is only warned about.
+		'''
+		lock = threading.Lock()
+		state = {"remaining": len(jobs), "error": None}
+
+		def finish(error=None):
+			with lock:
+				state["error"] = state["error"] or error
+				state["remaining"] -= 1
+				if state["remaining"] > 0:
+					return
+
+			error = state["error"]
+			if error is None and then is not None:
+				try:
+					then()
+				except Exception as e:
+					error = e
+
+			if error is not None and on_error is not None:
+				try:
+					on_error(error)
+				except Exception as e:
+					warn(f"Handling a failed write ({type(error).__name__}: {error}) raised {type(e).__name__}: {e}", RuntimeWarning)
+
+		def run(func, args, kwargs):
+			try:
+				func(*args, **kwargs)
+			except Exception as e:
+				finish(e)
+				return
+			finish()
+
+		if not jobs:
+			state["remaining"] = 1
+			self.submit(finish)
+			return
+
+		for func, args, kwargs in jobs:
+			self.submit(run, func, args, kwargs)
+
+	def close(self):
+		'''
+		Wait for all queued writes to finish, then re-raise the first error encountered (if any).
+		'''
+		for _ in self._threads:
+			self._queue.put(None)
+
+		for thread in self._threads:
+			thread.join()
+
+		self._raise_errors()
+
+	def _run(self):
+		while True:
+			item = self._queue.get()
+			if item is None:
+				break
+
+			func, args, kwargs = item
+			try:
+				func(*args, **kwargs)
+			except Exception as e:
+				self._errors.append(e)
+
+	def _raise_errors(self):
+		if self._errors:
+			raise self._errors[0]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
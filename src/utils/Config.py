@@ -1,29 +1,52 @@
-import copy
-import yaml
-from pathlib import Path
+from types import MappingProxyType
+from collections.abc import Mapping
 
-class Config(object):  
+class Config(object):
     """Simple dict wrapper that adds a thin API allowing for slash-based retrieval of
     nested elements, e.g. cfg.get_config("meta/dataset_name")
-    """      
+
+    The config is frozen when created: every slash path is flattened into a lookup table
+    once, and values are returned as shared, read-only objects (dicts become mapping
+    proxies, lists become tuples) rather than deep copies.
+    """
     def __init__(self, raw_config_dict):
         self._data = raw_config_dict
+        self._build_lookup()
 
     def get_config(self, path=None, default=None):
-        recursive_dict = copy.deepcopy(self._data)
-
         if path is None:
-            return recursive_dict
+            return self._frozen
+
+        return self._lookup.get(path, default)
+
+    def _build_lookup(self):
+        self._frozen = _freeze(self._data)
+        self._lookup = {}
+
+        pending = [("", self._frozen)]
+        while pending:
+            prefix, mapping = pending.pop()
+            for k, v in mapping.items():
+                path = f"{prefix}{k}"
+                self._lookup[path] = v
 
-        path_items = path.split("/")[:-1]
-        data_item = path.split("/")[-1]
+                if isinstance(v, Mapping):
+                    pending.append((f"{path}/", v))
 
-        try:
-            for path_item in path_items:
-                recursive_dict = recursive_dict.get(path_item)
+    def __getstate__(self):
+        # Mapping proxies can't be pickled, so rebuild the lookup on the other side
+        state = self.__dict__.copy()
+        del state["_frozen"]
+        del state["_lookup"]
+        return state
 
-            value = recursive_dict.get(data_item, default)
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_lookup()
 
-            return value
-        except (TypeError, AttributeError):
-            return default
+def _freeze(value):
+    if isinstance(value, Mapping):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
@@ -0,0 +1,324 @@
+import json
+import numpy as np
+from pathlib import Path
+from warnings import catch_warnings, simplefilter
+
+from .Telemetry import Telemetry
+
+quantities = ("cpu_s", "peak_rss_mb", "output_bytes")
+
+def _product(*names):
+	def feature(sizes):
+		values = [sizes.get(name) for name in names]
+		return None if any(value is None for value in values) else float(np.prod(values))
+	return feature
+
+# The terms of each stage's linear model, as functions of the sizes recorded in its telemetry.
+# A term is None when its sizes are unknown (e.g. benchmark results only time rendering).
+stage_features = {
+	"networks": {
+		"const": lambda sizes: 1.,
+		"nodes": _product("nodes"),
+		"refined_nodes": _product("nodes", "axial_refinement")
+	},
+	"meshes": {
+		"const": lambda sizes: 1.,
+		"segments": _product("segments"),
+		"faces": _product("faces")
+	},
+	"samples": {
+		"const": lambda sizes: 1.,
+		"faces": _product("faces"),
+		"points": _product("points"),
+		"pointcloud": _product("pointcloud"),
+		"voxels": lambda sizes: None if sizes.get("voxels_res") is None else float(sizes["voxels_res"])**3
+	},
+	"images": {
+		"const": lambda sizes: 1.,
+		"faces_frames": _product("faces", "frames"),
+		"pixels_frames": _product("pixels", "frames"),
+		"stored_pixels_frames": _product("output_pixels", "frames", "stored_copies"),
+		"png_pixels_frames": _product("output_pixels", "frames", "png"),
+		"pfm_pixels_frames": _product("output_pixels", "frames", "pfm")
+	}
+}
+
+# Uncalibrated coefficients: rough guesses, good to an order of magnitude at best. Calibrating
+# against telemetry from a previous run (or benchmark results) replaces them with fitted values.
+default_coefficients = {
+	"networks": {
+		"cpu_s": {"const": 1., "nodes": 0., "refined_nodes": 0.05},
+		"peak_rss_mb": {"const": 100., "nodes": 0., "refined_nodes": 0.},
+		"output_bytes": {"const": 0., "nodes": 0., "refined_nodes": 60.}
+	},
+	"meshes": {
+		"cpu_s": {"const": 2., "segments": 0.01, "faces": 2e-5},
+		"peak_rss_mb": {"const": 300., "segments": 0., "faces": 5e-4},
+		"output_bytes": {"const": 0., "segments": 0., "faces": 150.}
+	},
+	"samples": {
+		"cpu_s": {"const": 0.5, "faces": 2e-5, "points": 2e-6, "pointcloud": 1e-7, "voxels": 2e-6},
+		"peak_rss_mb": {"const": 200., "faces": 5e-4, "points": 1.5e-4, "pointcloud": 1.5e-4, "voxels": 2e-4},
+		"output_bytes": {"const": 0., "faces": 100., "points": 13., "pointcloud": 24., "voxels": 0.02}
+	},
+	"images": {
+		"cpu_s": {"const": 0.5, "faces_frames": 1e-7, "pixels_frames": 2e-8, "stored_pixels_frames": 1e-8, "png_pixels_frames": 3e-8, "pfm_pixels_frames": 5e-9},
+		"peak_rss_mb": {"const": 300., "faces_frames": 0., "pixels_frames": 3.2e-5, "stored_pixels_frames": 1e-5, "png_pixels_frames": 0., "pfm_pixels_frames": 0.},
+		"output_bytes": {"const": 0., "faces_frames": 0., "pixels_frames": 0., "stored_pixels_frames": 5., "png_pixels_frames": 0.3, "pfm_pixels_frames": 4.}
+	}
+}
+
+# Sizes only known once an earlier stage has run, predicted as a ratio of another size
+default_size_ratios = {
+	"segments": ("refined_nodes", 1.),
+	"faces": ("segments", 1000.)
+}
+
+# Benchmark stages whose results calibrate a pipeline stage's CPU time
+benchmark_stages = {
+	"mesh/sample": "samples",
+	"render/optical": "images",
+	"render/xray": "images"
+}
+
+class CostModel(object):
+	"""Estimates the CPU time, peak memory and bytes written by each stage of a dataset before it
+	is generated.
+
+	Every quantity of every stage is a linear model of that stage's sizes (nodes, faces, points,
+	pixels, frames, etc.; see `stage_features`). `estimate` draws the parameters of a sample of
+	seeds, predicts their sizes and extrapolates to the whole seed range. `calibrate` fits the
+	coefficients to observations: telemetry records of earlier runs, or benchmark results, which
+	only calibrate CPU time. Terms an observation can't tell anything about keep their coefficient.
+
+	Usage:
+		model = CostModel().calibrate(CostModel.load_observations("output/previous_run"))
+		CostModel.print_estimate(model.estimate(cfg))
+	"""
+	def __init__(self, coefficients=None, size_ratios=None):
+		self.coefficients = json.loads(json.dumps(coefficients or default_coefficients))
+		self.size_ratios = dict(size_ratios or default_size_ratios)
+		self.calibration = {}
+
+	@staticmethod
+	def load_observations(path):
+		'''
+		Observations from a dataset root directory (its telemetry) or a benchmark results JSON file,
+		as records with a stage, sizes and the measured quantities
+		'''
+		path = Path(path)
+		if path.is_dir():
+			return [r for r in Telemetry.load(path) if r.get("status") == "ok"]
+
+		with open(path, "r") as f:
+			results = json.load(f)["results"]
+
+		records = []
+		for result in results.values():
+			stage = benchmark_stages.get(result.get("stage"))
+			if stage is not None and "min" in result:
+				records.append({"stage": stage, "sizes": result["sizes"], "cpu_s": result["min"]})
+
+		return records
+
+	def calibrate(self, records):
+		'''
+		Fit the coefficients (kept non-negative) to observed records. With fewer records than
+		unknown terms, the existing coefficients are only scaled to match the records on average.
+		'''
+		from scipy.optimize import nnls
+
+		self._calibrate_size_ratios(records)
+
+		for stage, features in stage_features.items():
+			stage_records = [r for r in records if r["stage"] == stage]
+
+			for quantity in quantities:
+				rows = [(self._features(stage, r["sizes"]), r[quantity]) for r in stage_records if _observed(r, quantity)]
+				if not rows:
+					continue
+
+				coefficients = self.coefficients[stage][quantity]
+				known = [name for name in features if all(x[name] is not None for x, _ in rows) and any(x[name] for x, _ in rows)]
+				unknown_sum = np.array([sum(coefficients[name] * (x[name] or 0.) for name in features if name not in known) for x, _ in rows])
+
+				X = np.array([[x[name] for name in known] for x, _ in rows])
+				y = np.array([value for _, value in rows], dtype=np.float64) - unknown_sum
+
+				if len(rows) >= len(known):
+					# Scale columns so the fit isn't dominated by the terms with the largest values
+					scale = np.abs(X).max(axis=0)
+					scale[scale == 0] = 1
+					fitted, _ = nnls(X / scale, np.clip(y, 0, None))
+					coefficients.update(zip(known, (fitted / scale).tolist()))
+				else:
+					predicted = X @ np.array([coefficients[name] for name in known])
+					if predicted.sum() > 0:
+						ratio = max(y.sum(), 0.) / predicted.sum()
+						coefficients.update({name: float(coefficients[name] * ratio) for name in known})
+
+				self.calibration.setdefault(stage, {})[quantity] = len(rows)
+
+		return self
+
+	def _calibrate_size_ratios(self, records):
+		# Predicted sizes are fitted from seeds that have both sizes recorded, across stages
+		sizes_by_seed = {}
+		for record in records:
+			if "seed" in record:
+				seed_sizes = sizes_by_seed.setdefault(record["seed"], {})
+				seed_sizes.update(record["sizes"])
+				if "nodes" in record["sizes"] and "axial_refinement" in record["sizes"]:
+					seed_sizes["refined_nodes"] = record["sizes"]["nodes"] * record["sizes"]["axial_refinement"]
+
+		for size, (source, _) in self.size_ratios.items():
+			pairs = np.array([(s[source], s[size]) for s in sizes_by_seed.values() if s.get(source) and s.get(size)], dtype=np.float64).reshape(-1, 2)
+			if len(pairs):
+				# Least-squares ratio through the origin
+				self.size_ratios[size] = (source, float((pairs[:, 0] * pairs[:, 1]).sum() / (pairs[:, 0]**2).sum()))
+
+	def _features(self, stage, sizes):
+		return {name: feature(sizes) for name, feature in stage_features[stage].items()}
+
+	def predict(self, stage, sizes):
+		'''
+		{quantity: value} for one seed of a stage
+		'''
+		features = self._features(stage, sizes)
+
+		return {
+			quantity: sum(coefficient * (features[name] or 0.) for name, coefficient in self.coefficients[stage][quantity].items())
+			for quantity in quantities
+		}
+
+	def seed_sizes(self, cfg, seed_cfg, output_pixels):
+		'''
+		{stage: sizes} predicted for one seed, from its sampled config, as telemetry would record them
+		'''
+		nodes = seed_cfg.get_config("patient/blood_vessels/mesh/number_of_nodes")
+		axial_refinement = seed_cfg.get_config("patient/blood_vessels/mesh/axial_refinement")
+
+		predicted = {"refined_nodes": nodes * axial_refinement}
+		for size in ("segments", "faces"):
+			source, ratio = self.size_ratios[size]
+			predicted[size] = predicted[source] * ratio
+
+		width = cfg.get_config("equipment/fluoroscope/specifications/image_dimensions/width")
+		height = cfg.get_config("equipment/fluoroscope/specifications/image_dimensions/height")
+		protocol = seed_cfg.get_config("operation/protocol")
+
+		return {
+			"networks": {"nodes": nodes, "axial_refinement": axial_refinement},
+			"meshes": {"segments": predicted["segments"], "faces": predicted["faces"]},
+			"samples": {
+				"faces": predicted["faces"],
+				"points": cfg.get_config("patient/blood_vessels/points/number") if cfg.get_config("output/save/points") else 0,
+				"pointcloud": cfg.get_config("patient/blood_vessels/pointcloud/number") if cfg.get_config("output/save/pointcloud") else 0,
+				"voxels_res": cfg.get_config("patient/blood_vessels/voxels/resolution") if cfg.get_config("output/save/voxels") else 0
+			},
+			"images": {
+				"faces": predicted["faces"],
+				"frames": len(protocol) if protocol is not None else 0,
+				"pixels": width * height,
+				"output_pixels": output_pixels,
+				"stored_copies": int(bool(cfg.get_config("output/save/images_as_numpy", True))) + int(bool(cfg.get_config("output/save/images_as_frames", False))),
+				"png": int(bool(cfg.get_config("output/save/images_as_png"))),
+				"pfm": int(bool(cfg.get_config("output/save/depths_as_pfm")))
+			}
+		}
+
+	def estimate(self, cfg, num_samples=32):
+		'''
+		Per-stage totals for the config's whole seed range, extrapolated from `num_samples` seeds
+		spread evenly over it. Nothing is generated.
+		'''
+		seed_start, seed_end = cfg.get_config("meta/random_seeds/start"), cfg.get_config("meta/random_seeds/end")
+		num_seeds = seed_end - seed_start + 1
+		seeds = np.unique(np.linspace(seed_start, seed_end, min(num_samples, num_seeds)).astype(int)).tolist()
+
+		table = cfg.generate_batch(seeds)
+		output_pixels = image_output_pixels(cfg)
+
+		stages = ["samples", "images"]
+		if not cfg.get_config("patient/use_existing_meshes"):
+			stages = ["networks", "meshes"] + stages
+
+		predictions = {stage: [] for stage in stages}
+		for seed in seeds:
+			sizes = self.seed_sizes(cfg, cfg.generate_from_row(table.row(seed)), output_pixels)
+			for stage in stages:
+				predictions[stage].append(self.predict(stage, sizes[stage]))
+
+		num_cpus = cfg.get_config("meta/num_cpus")
+		memory_budget_gb = cfg.get_config("meta/memory_budget_gb")
+
+		estimate = {"num_seeds": num_seeds, "num_samples": len(seeds), "num_cpus": num_cpus, "calibrated": bool(self.calibration), "stages": {}}
+		for stage, stage_predictions in predictions.items():
+			cpu_s = np.array([p["cpu_s"] for p in stage_predictions])
+			peak_rss_mb = max(p["peak_rss_mb"] for p in stage_predictions)
+			concurrent_mb = peak_rss_mb * num_cpus
+			if memory_budget_gb:
+				concurrent_mb = min(concurrent_mb, max(peak_rss_mb, memory_budget_gb * 1024))
+
+			estimate["stages"][stage] = {
+				"cpu_hours": float(cpu_s.mean() * num_seeds / 3600),
+				"wall_hours": float(cpu_s.mean() * num_seeds / 3600 / num_cpus),
+				"seed_cpu_s_max": float(cpu_s.max()),
+				"peak_rss_mb": float(peak_rss_mb),
+				"concurrent_rss_mb": float(concurrent_mb),
+				"output_gb": float(np.mean([p["output_bytes"] for p in stage_predictions]) * num_seeds / 2**30),
+				"calibrated_from": self.calibration.get(stage, {})
+			}
+
+		return estimate
+
+	@staticmethod
+	def print_estimate(estimate):
+		print(f"Estimate for {estimate['num_seeds']} seeds on {estimate['num_cpus']} CPUs, from {estimate['num_samples']} sampled seeds:")
+		print(f"{'stage':<10}{'CPU (h)':>10}{'wall (h)':>10}{'max/seed (s)':>14}{'peak/task (MB)':>16}{'peak all (MB)':>15}{'output (GB)':>13}  calibrated on")
+
+		for name, s in estimate["stages"].items():
+			calibrated = ", ".join(f"{quantity} ({n})" for quantity, n in s["calibrated_from"].items()) or "-"
+			print(f"{name:<10}{s['cpu_hours']:>10.2f}{s['wall_hours']:>10.2f}{s['seed_cpu_s_max']:>14.1f}{s['peak_rss_mb']:>16.0f}{s['concurrent_rss_mb']:>15.0f}{s['output_gb']:>13.2f}  {calibrated}")
+
+		total = {key: sum(s[key] for s in estimate["stages"].values()) for key in ("cpu_hours", "wall_hours", "output_gb")}
+		print(f"{'total':<10}{total['cpu_hours']:>10.2f}{total['wall_hours']:>10.2f}{'':>14}{'':>16}{'':>15}{total['output_gb']:>13.2f}")
+
+		if not estimate["calibrated"]:
+			print("\nWARNING: The cost model is not calibrated, so these are rough guesses. Calibrate it with the telemetry of an earlier run or with benchmark results.")
+
+def _observed(record, quantity):
+	if record.get(quantity) is None:
+		return False
+
+	# A lifetime peak would carry a worker's largest seed over to its later ones
+	return quantity != "peak_rss_mb" or record.get("peak_rss_per_seed", False)
+
+def image_output_pixels(cfg):
+	'''
+	Pixels in one frame of every image processing group together, found by processing a single
+	blank frame
+	'''
+	from . import get_image_operations
+
+	width = cfg.get_config("equipment/fluoroscope/specifications/image_dimensions/width")
+	height = cfg.get_config("equipment/fluoroscope/specifications/image_dimensions/height")
+	blank = (
+		np.zeros((height, width, 1), dtype=np.uint8),
+		np.zeros((height, width, 1), dtype=np.float32),
+		{"K": np.eye(3)[:, :, np.newaxis], "P": np.eye(4)[:, :, np.newaxis], "R": np.eye(3)[:, :, np.newaxis], "t": np.zeros((1, 3, 1))}
+	)
+
+	output_pixels = 0
+	for funcs, func_cfgs in get_image_operations(cfg).values():
+		images, depths, matrices = blank
+
+		with catch_warnings():
+			# A blank frame is reported as an empty image
+			simplefilter("ignore")
+			for func, func_cfg in zip(funcs, func_cfgs):
+				images, depths, matrices = func(images, depths, matrices, **func_cfg)
+
+		output_pixels += images.shape[0] * images.shape[1]
+
+	return output_pixels
@@ -0,0 +1,73 @@
+import json
+import time
+from pathlib import Path
+
+class FailureLog(object):
+	"""Seeds a stage gave up on after its retries, with the reason, appended as JSON lines to
+	failures.jsonl in the output root directory. Like the run index, it is only written by
+	parent processes.
+
+	A failure stops counting once the seed has since finished that stage (e.g. on a later run),
+	so the report only lists what is still missing.
+
+	Usage:
+		failures = FailureLog.from_config(cfg)
+		failures.record("samples", seed, "timed out after 600 s", attempts=3)
+		failures.print_report(RunIndex.from_config(cfg))
+	"""
+	filename = "failures.jsonl"
+
+	def __init__(self, root_directory):
+		self.root_directory = Path(root_directory)
+		self.path = self.root_directory / self.filename
+
+	@classmethod
+	def from_config(cls, cfg):
+		return cls(cfg.get_config("output/root_directory"))
+
+	def record(self, stage, seed, reason, attempts=1):
+		self.root_directory.mkdir(parents=True, exist_ok=True)
+
+		with open(self.path, "a") as f:
+			f.write(json.dumps({"stage": stage, "seed": int(seed), "reason": str(reason), "attempts": attempts, "time": time.time()}) + "\n")
+
+	def load(self):
+		if not self.path.exists():
+			return []
+
+		failures = []
+		with open(self.path, "r") as f:
+			for line in f:
+				try:
+					failures.append(json.loads(line))
+				except ValueError:
+					# A run killed mid-write can leave a partial last line
+					continue
+
+		return failures
+
+	def outstanding(self, run_index, stages=None):
+		'''
+		The latest failure of every (stage, seed) that still hasn't finished that stage, in order
+		'''
+		latest = {}
+		for failure in self.load():
+			if stages is None or failure["stage"] in stages:
+				latest[(failure["stage"], failure["seed"])] = failure
+
+		failures = []
+		for stage in dict.fromkeys(stage for stage, _ in latest):
+			seeds = sorted(seed for s, seed in latest if s == stage)
+			done = set(run_index.completed(stage, seeds))
+			failures += [latest[(stage, seed)] for seed in seeds if seed not in done]
+
+		return failures
+
+	def print_report(self, run_index, stages=None):
+		failures = self.outstanding(run_index, stages)
+		if not failures:
+			return
+
+		print(f"\n{len(failures)} seed(s) failed (see {self.path}):")
+		for failure in failures:
+			print(f"  {failure['stage']:<10}seed {failure['seed']:<8}after {failure['attempts']} attempt(s): {failure['reason']}")
@@ -0,0 +1,196 @@
+import os
+import json
+import collections
+import numpy as np
+from pathlib import Path
+
+class FrameStoreWriter(object):
+	"""Writes frames into a frame-major (N, H, W) store made of fixed-size chunk files plus an
+	`index.json`, so that single frames can later be read without touching the rest of the sequence.
+
+	Uncompressed chunks are plain `.npy` files (memory-mappable), compressed chunks are `.npz`.
+	"""
+	index_filename = "index.json"
+
+	def __init__(self, path, chunk_size=16, compression=None):
+		assert chunk_size > 0, f"Frame store chunk size must be greater than 0 (got {chunk_size})"
+		assert compression in (None, "zip"), f"Frame store compression must be one of: None, 'zip' (got {compression})"
+
+		self.path = Path(path)
+		self.chunk_size = int(chunk_size)
+		self.compression = compression
+
+		self._pending = []
+		self._chunks = []
+		self._num_frames = 0
+		self._frame_shape = None
+		self._dtype = None
+
+		self.path.mkdir(parents=True, exist_ok=True)
+
+	def append(self, frame):
+		'''
+		Add a single (H, W) frame to the end of the store.
+		'''
+		frame = np.asarray(frame)
+
+		if self._frame_shape is None:
+			self._frame_shape = frame.shape
+			self._dtype = frame.dtype
+		assert frame.shape == self._frame_shape, f"All frames must have the same shape ({frame.shape} vs {self._frame_shape})"
+
+		self._pending.append(frame)
+		if len(self._pending) == self.chunk_size:
+			self._flush()
+
+	def extend(self, frames, frame_axis=-1):
+		'''
+		Add a stack of frames. By default the stack is frame-last, i.e. (H, W, N), as produced by the renderers.
+		'''
+		frames = np.asarray(frames)
+		frame_axis = frame_axis % frames.ndim
+
+		for i in range(frames.shape[frame_axis]):
+			self.append(np.take(frames, i, axis=frame_axis))
+
+	def close(self):
+		self._flush()
+
+		index = {
+			"num_frames": self._num_frames,
+			"frame_shape": list(self._frame_shape) if self._frame_shape is not None else None,
+			"dtype": np.dtype(self._dtype).str if self._dtype is not None else None,
+			"chunk_size": self.chunk_size,
+			"compression": self.compression,
+			"chunks": self._chunks
+		}
+
+		# The index marks the store as complete, so it must never be left half-written
+		partial_path = self.path / (self.index_filename + ".partial")
+		with open(partial_path, "w") as f:
+			json.dump(index, f)
+		os.replace(partial_path, self.path / self.index_filename)
+
+	def _flush(self):
+		if not self._pending:
+			return
+
+		chunk = np.stack(self._pending, axis=0)
+		chunk_id = len(self._chunks)
+
+		if self.compression == "zip":
+			filename = f"chunk_{chunk_id:05}.npz"
+			np.savez_compressed(self.path / filename, frames=chunk)
+		else:
+			filename = f"chunk_{chunk_id:05}.npy"
+			np.save(self.path / filename, chunk)
+
+		self._chunks.append({
+			"file": filename,
+			"start": self._num_frames,
+			"stop": self._num_frames + chunk.shape[0]
+		})
+		self._num_frames += chunk.shape[0]
+		self._pending = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+
+
+class FrameStore(object):
+	"""Random-access reader for a store written by `FrameStoreWriter`.
+
+	Usage:
+		store = FrameStore("output/00001/images/onet/image_frames")
+		frame = store[3]          # (H, W)
+		frames = store.read(2, 6) # (4, H, W)
+
+	Only the `cached_chunks` most recently used chunks are kept loaded, so iterating over a long
+	compressed store holds a chunk or two of frames in memory rather than all of them.
+	"""
+	index_filename = FrameStoreWriter.index_filename
+
+	def __init__(self, path, mmap_mode="r", cached_chunks=2):
+		self.path = Path(path)
+		self.mmap_mode = mmap_mode
+		self.cached_chunks = max(1, cached_chunks)
+
+		with open(self.path / self.index_filename, "r") as f:
+			self.index = json.load(f)
+
+		self._chunk_starts = np.array([chunk["start"] for chunk in self.index["chunks"]], dtype=np.int64)
+		self._loaded_chunks = collections.OrderedDict()
+
+	@classmethod
+	def write(cls, path, frames, chunk_size=16, compression=None, frame_axis=-1):
+		'''
+		Write a whole stack of frames (frame-last by default) to a new store at `path`.
+		'''
+		with FrameStoreWriter(path, chunk_size=chunk_size, compression=compression) as writer:
+			writer.extend(frames, frame_axis=frame_axis)
+
+	@classmethod
+	def exists(cls, path):
+		return (Path(path) / cls.index_filename).exists()
+
+	@property
+	def shape(self):
+		return (self.index["num_frames"], *self.index["frame_shape"])
+
+	@property
+	def dtype(self):
+		return np.dtype(self.index["dtype"])
+
+	def __len__(self):
+		return self.index["num_frames"]
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += len(self)
+		if not 0 <= i < len(self):
+			raise IndexError(f"Frame {i} is out of range for a store of {len(self)} frames")
+
+		chunk_id = int(np.searchsorted(self._chunk_starts, i, side="right")) - 1
+		chunk = self._get_chunk(chunk_id)
+
+		return chunk[i - self.index["chunks"][chunk_id]["start"]]
+
+	def read(self, start=0, stop=None):
+		'''
+		Read frames [start, stop) as a (N, H, W) array.
+		'''
+		stop = len(self) if stop is None else min(stop, len(self))
+		out = np.empty((max(0, stop - start), *self.index["frame_shape"]), dtype=self.dtype)
+
+		for chunk_id, chunk_info in enumerate(self.index["chunks"]):
+			lo, hi = max(start, chunk_info["start"]), min(stop, chunk_info["stop"])
+			if lo >= hi:
+				continue
+
+			chunk = self._get_chunk(chunk_id)
+			out[lo - start:hi - start] = chunk[lo - chunk_info["start"]:hi - chunk_info["start"]]
+
+		return out
+
+	def _get_chunk(self, chunk_id):
+		chunk = self._loaded_chunks.get(chunk_id)
+
+		if chunk is not None:
+			self._loaded_chunks.move_to_end(chunk_id)
+		else:
+			chunk_path = self.path / self.index["chunks"][chunk_id]["file"]
+			if self.index["compression"] == "zip":
+				with np.load(chunk_path) as data:
+					chunk = data["frames"]
+			else:
+				chunk = np.load(chunk_path, mmap_mode=self.mmap_mode)
+
+			self._loaded_chunks[chunk_id] = chunk
+			if len(self._loaded_chunks) > self.cached_chunks:
+				self._loaded_chunks.popitem(last=False)
+
+		return chunk
@@ -1,11 +1,10 @@
-import copy
+import os
 import numpy as np
-import skimage.transform
+import multiprocessing
 
 from warnings import warn
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 
-from ..MatrixCalculator import MatrixCalculator
 
 def crop(image, depth, matrix, **config):
 	aspect_ratio = config.get("aspect_ratio")
@@ -63,49 +62,39 @@ def crop(image, depth, matrix, **config):
 	to_y = from_y + y
 
 	'''Image'''
+	# Slicing only, so the result is a view onto the input
 	im_was_flat = len(image.shape) == 2
 
 	# Make sure it is 3D
 	if im_was_flat:
-		image = image.reshape(initial_image_width,initial_image_height,-1)
+		image = image[:, :, np.newaxis]
 
 	image = image[from_y:to_y,from_x:to_x,:]
 
 	if im_was_flat:
-		image = np.squeeze(image)
+		image = np.squeeze(image, axis=2)
 
 
 	'''Depth'''
-	dpt_was_flat = len(image.shape) == 2
+	dpt_was_flat = len(depth.shape) == 2
 
 	# Make sure it is 3D
 	if dpt_was_flat:
-		depth = depth.reshape(initial_image_width,initial_image_height,-1)
+		depth = depth[:, :, np.newaxis]
 
 	depth = depth[from_y:to_y,from_x:to_x,:]
 
-	depth_non_zero = depth[np.nonzero(depth)]
-
-	if depth_non_zero.size == 0:
+	# Stops at the first frame with any content
+	if not any(depth[:, :, i].any() for i in range(depth.shape[2])):
 		warn("Image is empty. Continuing anyway...", RuntimeWarning)
 
-	if im_was_flat:
-		depth = np.squeeze(depth)
+	if dpt_was_flat:
+		depth = np.squeeze(depth, axis=2)
 
 
 	'''Matrix'''
-	# Speed things up if all intrinsic matrices are the same (i.e. the camera hasn't e.g. changed zoom during sequence)
-	if np.all(matrix["K"].T == matrix["K"][:,:,0].T):
-		intrinsic_params = MatrixCalculator.intrinsicToParams(matrix["K"][:,:,0])
-		new_K = MatrixCalculator.camParamsToIntrinsic(fx=intrinsic_params["fx"],fy=intrinsic_params["fy"],image_dims=(x,y))
-		matrix["K"] = np.dstack([new_K]*matrix["K"].shape[2])
-	else:
-		new_K_stack = []
-		for i in range(matrix["K"].shape[2]):
-			intrinsic_params = MatrixCalculator.intrinsicToParams(matrix["K"][:,:,i])
-			new_K = MatrixCalculator.camParamsToIntrinsic(fx=intrinsic_params["fx"],fy=intrinsic_params["fy"],image_dims=(x,y))
-			new_K_stack.append(new_K)
-		matrix["K"] = np.dstack(new_K_stack)
+	matrix = dict(matrix)
+	matrix["K"] = _intrinsics_for_image_dims(matrix["K"], x, y)
 
 	return image, depth, matrix
 
@@ -116,7 +105,7 @@ def resize(image, depth, matrix, **config):
 	scale = config.get("scale")
 	scale_x = config.get("scale_x")
 	scale_y = config.get("scale_y")
-	interpolation_order = config.get("interpolation_order", 1)
+	interpolation_order = config.get("interpolation_order")
 
 	initial_image_width, initial_image_height = image.shape[1], image.shape[0]
 	initial_aspect_ratio = initial_image_width/initial_image_height
@@ -154,23 +143,25 @@ def resize(image, depth, matrix, **config):
 	if y is None: y = initial_image_height
 
 
+	x, y = int(round(x)), int(round(y))
+
+	resize_config = {
+		"interpolation_order": interpolation_order,
+		"method": config.get("method", "auto"),
+		"num_threads": config.get("num_threads")
+	}
+
 	'''Image'''
 	im_was_flat = len(image.shape) == 2
 
 	# Make sure it is 3D
 	if im_was_flat:
-		image = image.reshape(initial_image_data_width,initial_image_data_height,-1)
+		image = image[:, :, np.newaxis]
 
-	min_before = image[np.nonzero(image)].min()
-	image_max_before = image.max()
-	image = skimage.transform.resize(image, (y,x,image.shape[2]), order=interpolation_order)
-	image_max_after = image.max()
-	image *= image_max_before/image_max_after
-
-	image[image < min_before] = 0
+	image, _ = _resize_stack(image, y, x, **resize_config)
 
 	if im_was_flat:
-		image = np.squeeze(image)
+		image = np.squeeze(image, axis=2)
 
 
 	'''Depth'''
@@ -178,39 +169,133 @@ def resize(image, depth, matrix, **config):
 
 	# Make sure it is 3D
 	if dpt_was_flat:
-		depth = depth.reshape(initial_image_data_width,initial_image_data_height,-1)
+		depth = depth[:, :, np.newaxis]
 
-	depth_non_zero = depth[np.nonzero(depth)]
+	depth, depth_was_empty = _resize_stack(depth, y, x, output_dtype=np.float32, **resize_config)
 
-	if depth_non_zero.size == 0:
+	if depth_was_empty:
 		warn("Image is empty. Continuing anyway...", RuntimeWarning)
 
-	min_before = 0 if depth_non_zero.size == 0 else depth[np.nonzero(depth)].min()
-	image_max_before = depth.max()
-	depth = skimage.transform.resize(depth, (y,x,depth.shape[2]), order=interpolation_order)
-	image_max_after = depth.max()
-
-	if image_max_after != 0:
-		depth *= image_max_before/image_max_after
-
-	depth[depth < min_before] = 0
-
 	if dpt_was_flat:
-		depth = np.squeeze(depth)
+		depth = np.squeeze(depth, axis=2)
 
 
 	'''Matrix'''
-	# Speed things up if all intrinsic matrices are the same (i.e. the camera hasn't e.g. changed zoom during sequence)
-	if np.all(matrix["K"].T == matrix["K"][:,:,0].T):
-		intrinsic_params = MatrixCalculator.intrinsicToParams(matrix["K"][:,:,0])
-		new_K = MatrixCalculator.camParamsToIntrinsic(fx=intrinsic_params["fx"],fy=intrinsic_params["fy"],image_dims=(x,y))
-		matrix["K"] = np.dstack([new_K]*matrix["K"].shape[2])
-	else:
-		new_K_stack = []
-		for i in range(matrix["K"].shape[2]):
-			intrinsic_params = MatrixCalculator.intrinsicToParams(matrix["K"][:,:,i])
-			new_K = MatrixCalculator.camParamsToIntrinsic(fx=intrinsic_params["fx"],fy=intrinsic_params["fy"],image_dims=(x,y))
-			new_K_stack.append(new_K)
-		matrix["K"] = np.dstack(new_K_stack)
+	matrix = dict(matrix)
+	matrix["K"] = _intrinsics_for_image_dims(matrix["K"], x, y)
 
 	return image, depth, matrix
+
+def _resize_stack(stack, y, x, interpolation_order=None, method="auto", num_threads=None, output_dtype=None):
+	'''
+	Resize a (H, W, N) stack to (y, x, N), one frame per thread-pool task, in float32.
+
+	As before, the result is rescaled so that its maximum matches the input maximum, and values
+	below the smallest non-zero input value are zeroed. The statistics needed for this are gathered
+	per frame while each frame is resized, so the renormalisation is a single extra pass.
+
+	Method "area" averages the input pixels covered by each output pixel (separably along each axis,
+	with a plain block mean for integer factors); "interpolate" uses skimage with `interpolation_order`
+	(1 if not given). "auto" picks "area" when downscaling in both directions, unless an
+	`interpolation_order` was given.
+
+	`num_threads` defaults to 1 in worker processes, which already run one per CPU, and to up to 4
+	otherwise.
+
+	Returns the resized stack (in `output_dtype`, defaulting to the input dtype) and whether the input was empty.
+	'''
+	height, width, num_frames = stack.shape
+	output_dtype = np.dtype(stack.dtype if output_dtype is None else output_dtype)
+
+	if method == "auto":
+		method = "area" if interpolation_order is None and y <= height and x <= width else "interpolate"
+	if interpolation_order is None:
+		interpolation_order = 1
+	assert method in ("area", "interpolate"), f"Resize 'method' must be one of: 'auto', 'area', 'interpolate' (got {method})"
+
+	block_mean = method == "area" and height % y == 0 and width % x == 0
+	if method == "interpolate":
+		import skimage.transform
+	elif not block_mean:
+		weights_y = _area_weights(height, y)
+		weights_x = _area_weights(width, x).T
+
+	resized = np.empty((num_frames, y, x), dtype=np.float32)
+	input_min = np.full(num_frames, np.inf)
+	input_max = np.full(num_frames, -np.inf)
+	output_max = np.full(num_frames, -np.inf)
+
+	def resize_frame(i):
+		frame = stack[:, :, i]
+
+		non_zero = frame[frame != 0]
+		if non_zero.size > 0:
+			input_min[i] = non_zero.min()
+		input_max[i] = frame.max()
+
+		frame = frame.astype(np.float32)
+		if block_mean:
+			frame = frame.reshape(y, height // y, x, width // x).mean(axis=(1, 3))
+		elif method == "area":
+			frame = weights_y @ frame @ weights_x
+		else:
+			frame = skimage.transform.resize(frame, (y, x), order=interpolation_order, preserve_range=True)
+
+		resized[i] = frame
+		output_max[i] = frame.max()
+
+	if num_threads is None:
+		num_threads = 1 if multiprocessing.parent_process() is not None else min(4, os.cpu_count() or 1)
+
+	with ThreadPoolExecutor(max_workers=num_threads) as executor:
+		list(executor.map(resize_frame, range(num_frames)))
+
+	was_empty = not np.isfinite(input_min).any()
+	min_before = 0 if was_empty else input_min.min()
+	max_before, max_after = input_max.max(), output_max.max()
+	ratio = max_before/max_after if max_after != 0 else 1
+
+	if np.issubdtype(output_dtype, np.integer):
+		limits = np.iinfo(output_dtype)
+	output = np.empty((y, x, num_frames), dtype=output_dtype)
+
+	def renormalise_frame(i):
+		frame = resized[i]
+		frame *= ratio
+		frame[frame < min_before] = 0
+
+		if np.issubdtype(output_dtype, np.integer):
+			frame = np.clip(np.rint(frame), limits.min, limits.max)
+
+		output[:, :, i] = frame
+
+	with ThreadPoolExecutor(max_workers=num_threads) as executor:
+		list(executor.map(renormalise_frame, range(num_frames)))
+
+	return output, was_empty
+
+def _area_weights(size_in, size_out):
+	'''
+	(size_out, size_in) matrix whose rows give the fraction of each input pixel covered by an output pixel.
+	'''
+	step = size_in / size_out
+	lower = np.arange(size_out)[:, np.newaxis] * step
+	upper = lower + step
+	pixels = np.arange(size_in)[np.newaxis, :]
+
+	overlap = np.minimum(upper, pixels + 1) - np.maximum(lower, pixels)
+	return (np.clip(overlap, 0, None) / step).astype(np.float32)
+
+def _intrinsics_for_image_dims(K, x, y):
+	'''
+	Rebuild a (3, 3, N) stack of intrinsic matrices for new image dimensions in one go,
+	keeping the focal lengths and centring the principal point (as camParamsToIntrinsic does).
+	'''
+	new_K = np.zeros(K.shape, dtype=np.float64)
+	new_K[0, 0] = K[0, 0]
+	new_K[1, 1] = K[1, 1]
+	new_K[0, 2] = x/2
+	new_K[1, 2] = y/2
+	new_K[2, 2] = 1
+
+	return new_K
@@ -1,36 +1,69 @@
 import numpy as np
 
 class MatrixCalculator(object):
+	# Maps anatomical (patient) axes onto camera axes
+	anatomical_to_camera_transform = np.array([
+		[1,0,0],
+		[0,0,-1],
+		[0,1,0]
+	])
+
+	# Flips between the OpenCV-style extrinsic convention and the OpenGL-style pose convention
+	rot = np.array([
+		[ 1, 0, 0],
+		[ 0,-1, 0],
+		[ 0, 0,-1],
+	])
+
 	@classmethod
 	def DICOMtoExtrinsics(cls, positioner_primary_angle, positioner_secondary_angle, source_to_image_distance, table_displacement=None):
 		'''
 		positioner_primary_angle is primary positioner angle, positioner_secondary_angle is secondary
 		'''
-		anatomical_to_camera_transform = np.array([
-			[1,0,0],
-			[0,0,-1],
-			[0,1,0]
-		])
-		R1 = np.array([
-			[np.cos(np.deg2rad(positioner_primary_angle)), -np.sin(np.deg2rad(positioner_primary_angle)), 0],
-			[np.sin(np.deg2rad(positioner_primary_angle)), np.cos(np.deg2rad(positioner_primary_angle)), 0],
-			[0, 0, 1]
-		])
+		table_displacements = None if table_displacement is None else [table_displacement]
+		extrinsics = cls.DICOMtoExtrinsicsBatch(
+			[positioner_primary_angle],
+			[positioner_secondary_angle],
+			source_to_image_distance,
+			table_displacements
+		)
+
+		return {"R": extrinsics["R"][0], "t": extrinsics["t"][0]}
+
+	@classmethod
+	def DICOMtoExtrinsicsBatch(cls, positioner_primary_angles, positioner_secondary_angles, source_to_image_distance, table_displacements=None):
+		'''
+		Vectorised DICOMtoExtrinsics for a whole sequence: takes N primary and secondary angles
+		(and optionally (N, 3) table displacements) and returns {"R": (N, 3, 3), "t": (N, 3)}
+		'''
+		ppa, psa = np.broadcast_arrays(
+			np.deg2rad(np.asarray(positioner_primary_angles, dtype=np.float64).reshape(-1)),
+			np.deg2rad(np.asarray(positioner_secondary_angles, dtype=np.float64).reshape(-1))
+		)
+		n = ppa.shape[0]
+		cos_ppa, sin_ppa = np.cos(ppa), np.sin(ppa)
+		cos_psa, sin_psa = np.cos(psa), np.sin(psa)
+
+		R1 = np.zeros((n, 3, 3))
+		R1[:, 0, 0], R1[:, 0, 1] = cos_ppa, -sin_ppa
+		R1[:, 1, 0], R1[:, 1, 1] = sin_ppa, cos_ppa
+		R1[:, 2, 2] = 1
+
 		# secondary (C/C): CHECK
-		R2 = np.array([
-			[1, 0, 0],
-			[0, np.cos(np.deg2rad(positioner_secondary_angle)), -np.sin(np.deg2rad(positioner_secondary_angle))],
-			[0, np.sin(np.deg2rad(positioner_secondary_angle)), np.cos(np.deg2rad(positioner_secondary_angle))]
-		])
+		R2 = np.zeros((n, 3, 3))
+		R2[:, 0, 0] = 1
+		R2[:, 1, 1], R2[:, 1, 2] = cos_psa, -sin_psa
+		R2[:, 2, 1], R2[:, 2, 2] = sin_psa, cos_psa
 
 		params = {}
-		params["R"] = anatomical_to_camera_transform @ R1 @ R2
+		params["R"] = cls.anatomical_to_camera_transform @ R1 @ R2
 
-		params["t"] = np.array([0, 0.5*source_to_image_distance, 0])
-		if table_displacement is not None:
-			params["t"] = np.add(params["t"],np.array([table_displacement[0],table_displacement[1],table_displacement[2]]))
+		t = np.zeros((n, 3))
+		t[:, 1] = 0.5*source_to_image_distance
+		if table_displacements is not None:
+			t += np.asarray(table_displacements, dtype=np.float64).reshape(-1, 3)
 
-		params["t"] = anatomical_to_camera_transform @ params["t"]
+		params["t"] = t @ cls.anatomical_to_camera_transform.T
 
 		return params
 
@@ -48,24 +81,40 @@ class MatrixCalculator(object):
 		)
 		return pose
 
+	@classmethod
+	def DICOMtoPoseBatch(cls, positioner_primary_angles, positioner_secondary_angles, source_to_image_distance, table_displacements=None):
+		'''
+		Vectorised DICOMtoPose, returning (N, 4, 4) poses
+		'''
+		extrinsics = cls.DICOMtoExtrinsicsBatch(
+			positioner_primary_angles,
+			positioner_secondary_angles,
+			source_to_image_distance,
+			table_displacements
+		)
+		return cls.extrinsicsToPoseBatch(extrinsics["R"], extrinsics["t"])
+
 	@classmethod
 	def poseToExtrinsics(cls, P):
 		'''
 		Generate, set and return R and t (extrinsic and translation) given known pose
 		'''
-		rot = np.array([
-			[ 1, 0, 0],
-			[ 0,-1, 0],
-			[ 0, 0,-1],
-		])
-		params = {}
+		extrinsics = cls.poseToExtrinsicsBatch(np.asarray(P)[np.newaxis])
+
+		return {"R": extrinsics["R"][0], "t": extrinsics["t"][0]}
 
-		R_cam = P[:3,:3]
-		R_cam_T = R_cam.transpose()
-		params["R"] = np.matmul(np.linalg.inv(rot), R_cam_T)
+	@classmethod
+	def poseToExtrinsicsBatch(cls, P):
+		'''
+		Vectorised poseToExtrinsics: takes (N, 4, 4) poses and returns {"R": (N, 3, 3), "t": (N, 3)}.
+		Rotations are orthonormal, so they are inverted by transposing.
+		'''
+		R_cam = P[:, :3, :3]
+		T_cam = P[:, :3, 3]
 
-		T_cam = P[:3,3]
-		params["t"] = np.linalg.inv(np.matmul(np.linalg.inv(R_cam_T), -rot)).dot(T_cam)
+		params = {}
+		params["R"] = cls.rot @ np.swapaxes(R_cam, 1, 2)
+		params["t"] = -np.einsum("nij,nj->ni", params["R"], T_cam)
 
 		return params
 
@@ -74,19 +123,20 @@ class MatrixCalculator(object):
 		'''
 		Generate, set and return pose given known R and t (extrinsic and translation)
 		'''
-		rot = np.array([
-			[ 1, 0, 0],
-			[ 0,-1, 0],
-			[ 0, 0,-1],
-		])
+		return cls.extrinsicsToPoseBatch(np.asarray(R)[np.newaxis], np.asarray(t).reshape(1, 3))[0]
 
-		R_cam_T = np.matmul(rot,R)
-		T_cam = np.matmul(np.linalg.inv(R_cam_T), -rot).dot(t)
+	@classmethod
+	def extrinsicsToPoseBatch(cls, R, t):
+		'''
+		Vectorised extrinsicsToPose: takes (N, 3, 3) R and (N, 3) t and returns (N, 4, 4) poses.
+		Rotations are orthonormal, so they are inverted by transposing.
+		'''
+		R_T = np.swapaxes(R, 1, 2)
 
-		P = np.zeros((4,4))
-		P[:3,:3] = R_cam_T.transpose()
-		P[:3,3] = T_cam.flatten()
-		P[3,3]  = 1
+		P = np.zeros((R.shape[0], 4, 4))
+		P[:, :3, :3] = R_T @ cls.rot
+		P[:, :3, 3] = -np.einsum("nij,nj->ni", R_T, t)
+		P[:, 3, 3] = 1
 
 		return P
 
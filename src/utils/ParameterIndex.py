@@ -0,0 +1,137 @@
+import re
+import json
+import hashlib
+import operator
+import numpy as np
+from pathlib import Path
+from collections.abc import Mapping
+
+from .ParameterTable import ParameterTable
+
+class ParameterIndex(object):
+	"""Per-dataset index of the parameters sampled for every seed, stored next to the output
+	so sub-datasets can be selected without regenerating or opening any meshes or images.
+
+	Besides every sampled config value (e.g. "patient/heart/size/width"), each protocol gets
+	summary columns such as "operation/protocol/num_frames" and "operation/protocol/ppa_range".
+
+	The index stores a hash of the config it was sampled from, so an index left over from an
+	earlier config is never mistaken for the current one (see `load_current`).
+
+	Usage:
+		index = ParameterIndex.load("output/testing")
+		seeds = index.select("patient/heart/size/width > 70", "operation/protocol/ppa_range > 120")
+	"""
+	filename = "parameters.npz"
+
+	operators = {
+		"<=": operator.le,
+		">=": operator.ge,
+		"==": operator.eq,
+		"!=": operator.ne,
+		"<": operator.lt,
+		">": operator.gt
+	}
+	condition_pattern = re.compile(r"^\s*(\S+?)\s*(<=|>=|==|!=|<|>)\s*(\S+)\s*$")
+
+	def __init__(self, table):
+		self.table = table
+		self.seeds = table.seeds
+
+		self.columns = dict(table.columns)
+		for path, plans in table.protocols.items():
+			self.columns.update(self._summarise_protocol(path, plans))
+
+	@classmethod
+	def build(cls, cfg):
+		seed_start, seed_end = cfg.get_config("meta/random_seeds/start"), cfg.get_config("meta/random_seeds/end")
+
+		return cls(cfg.generate_batch(range(seed_start, seed_end + 1)))
+
+	@classmethod
+	def load(cls, root_directory):
+		return cls(ParameterTable.load(Path(root_directory) / cls.filename))
+
+	@classmethod
+	def load_current(cls, root_directory, cfg):
+		'''
+		The dataset's index if it was sampled from this config, otherwise None
+		'''
+		path = Path(root_directory) / cls.filename
+		if not path.exists():
+			return None
+
+		with np.load(path) as data:
+			if "attribute:config_hash" not in data or str(data["attribute:config_hash"]) != cls.config_hash(cfg):
+				return None
+
+		return cls.load(root_directory)
+
+	@classmethod
+	def exists(cls, root_directory):
+		return (Path(root_directory) / cls.filename).exists()
+
+	@staticmethod
+	def config_hash(cfg):
+		'''
+		Hash of every config value the parameters are sampled from, i.e. all but meta and output
+		'''
+		sampled = {key: value for key, value in cfg.get_config().items() if key not in ("meta", "output")}
+		encoded = json.dumps(sampled, sort_keys=True, default=lambda value: dict(value) if isinstance(value, Mapping) else str(value))
+
+		return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+	def covers(self, seeds):
+		return all(seed in self.table for seed in seeds)
+
+	def save(self, root_directory, cfg=None):
+		'''
+		Save to the output root directory, along with the hash of `cfg` it was sampled from
+		'''
+		root_directory = Path(root_directory)
+		root_directory.mkdir(parents=True, exist_ok=True)
+
+		attributes = {"config_hash": self.config_hash(cfg)} if cfg is not None else {}
+		self.table.save(root_directory / self.filename, **attributes)
+
+	def column(self, name):
+		if name not in self.columns:
+			raise KeyError(f"{name} is not an indexed parameter. Choose from {', '.join(self.columns.keys())}")
+
+		return self.columns[name]
+
+	def where(self, condition):
+		'''
+		Boolean mask over seeds for a condition such as "patient/heart/size/width > 70"
+		'''
+		match = self.condition_pattern.match(condition)
+		if match is None:
+			raise ValueError(f"'{condition}' is not a valid condition. It must look like '<parameter> <op> <value>', with op one of {', '.join(self.operators.keys())}")
+
+		name, op, value = match.groups()
+
+		return self.operators[op](self.column(name), float(value))
+
+	def select(self, *conditions):
+		'''
+		Seeds satisfying every condition
+		'''
+		mask = np.ones(len(self.seeds), dtype=bool)
+		for condition in conditions:
+			mask &= self.where(condition)
+
+		return self.seeds[mask]
+
+	@staticmethod
+	def _summarise_protocol(path, plans):
+		summary = {f"{path}/num_frames": np.array([len(plan) for plan in plans])}
+
+		for angle in ("ppa", "psa"):
+			angle_min = np.array([getattr(plan, angle).min() if len(plan) else np.nan for plan in plans])
+			angle_max = np.array([getattr(plan, angle).max() if len(plan) else np.nan for plan in plans])
+
+			summary[f"{path}/{angle}_min"] = angle_min
+			summary[f"{path}/{angle}_max"] = angle_max
+			summary[f"{path}/{angle}_range"] = angle_max - angle_min
+
+		return summary
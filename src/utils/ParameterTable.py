@@ -0,0 +1,75 @@
+import numpy as np
+
+from .ProtocolPlan import ProtocolPlan
+
+class ParameterTable(object):
+	"""Columnar table of sampled config values, with one row per seed.
+
+	columns: {"patient/heart/size/width": (N,) array, ...}, one per sampled distribution
+	protocols: {"operation/protocol": [ProtocolPlan, ...]}, one plan per seed
+	"""
+	def __init__(self, seeds, columns, protocols=None):
+		self.seeds = np.asarray(seeds, dtype=np.int64).reshape(-1)
+		self.columns = {path: np.asarray(values) for path, values in columns.items()}
+		self.protocols = protocols or {}
+
+		self._rows = {int(seed): i for i, seed in enumerate(self.seeds)}
+
+	def __len__(self):
+		return self.seeds.shape[0]
+
+	def __contains__(self, seed):
+		return int(seed) in self._rows
+
+	def row(self, seed):
+		'''
+		All sampled values for one seed as a small {path: value} dict
+		'''
+		i = self._rows[int(seed)]
+
+		row = {path: values[i].item() for path, values in self.columns.items()}
+		row.update({path: plans[i] for path, plans in self.protocols.items()})
+
+		return row
+
+	def save(self, path, **attributes):
+		'''
+		Save as an .npz archive of plain arrays. Protocol plans are stored concatenated, with
+		`<protocol path>:offsets` giving each seed's range of frames. `attributes` (e.g. a config
+		hash) are stored as `attribute:<name>` and ignored by `load`.
+		'''
+		data = {
+			"seeds": self.seeds,
+			"column_names": np.array(list(self.columns.keys()), dtype=str),
+			"protocol_names": np.array(list(self.protocols.keys()), dtype=str)
+		}
+
+		for i, values in enumerate(self.columns.values()):
+			data[f"column_{i}"] = values
+
+		for i, plans in enumerate(self.protocols.values()):
+			data[f"protocol_{i}:offsets"] = np.cumsum([0] + [len(plan) for plan in plans])
+			for key in ProtocolPlan.keys:
+				data[f"protocol_{i}:{key}"] = np.concatenate([getattr(plan, key) for plan in plans]) if plans else np.zeros(0)
+
+		for name, value in attributes.items():
+			data[f"attribute:{name}"] = np.array(value)
+
+		np.savez_compressed(path, **data)
+
+	@classmethod
+	def load(cls, path):
+		with np.load(path) as data:
+			columns = {str(name): data[f"column_{i}"] for i, name in enumerate(data["column_names"])}
+
+			protocols = {}
+			for i, name in enumerate(data["protocol_names"]):
+				offsets = data[f"protocol_{i}:offsets"]
+				arrays = {key: data[f"protocol_{i}:{key}"] for key in ProtocolPlan.keys}
+
+				protocols[str(name)] = [
+					ProtocolPlan(*(arrays[key][start:stop] for key in ProtocolPlan.keys))
+					for start, stop in zip(offsets[:-1], offsets[1:])
+				]
+
+			return cls(data["seeds"], columns, protocols)
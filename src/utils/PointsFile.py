@@ -0,0 +1,38 @@
+import numpy as np
+
+class PointsFile(object):
+	"""Reads and writes points.npz, holding occupancy samples of a mesh:
+
+	points: (N, 3) float32, or float16 when saved with `float16=True`
+	occupancies: (N,) bool, or (ceil(N/8),) uint8 when saved with `packbits=True`
+	loc, scale: the normalisation applied to the mesh
+
+	`load` decodes every variant back to float32 points and bool occupancies, so readers
+	don't need to know which options the dataset was generated with.
+	"""
+	@classmethod
+	def save(cls, path, points, occupancies, loc=None, scale=None, packbits=False, float16=False, compressed=False):
+		points = points.astype(np.float16 if float16 else np.float32, copy=False)
+		occupancies = np.packbits(occupancies) if packbits else occupancies.astype(bool, copy=False)
+
+		save = np.savez_compressed if compressed else np.savez
+		save(path, points=points, occupancies=occupancies, loc=loc, scale=scale)
+
+	@classmethod
+	def load(cls, path):
+		'''
+		Returns points (N, 3) float32, occupancies (N,) bool, loc and scale
+		'''
+		with np.load(path) as data:
+			points = data["points"].astype(np.float32, copy=False)
+			occupancies = cls.unpack_occupancies(data["occupancies"], points.shape[0])
+
+			return points, occupancies, data["loc"], data["scale"]
+
+	@staticmethod
+	def unpack_occupancies(occupancies, num_points):
+		# Packed occupancies are uint8 with one bit per point, so they are the only ones not one per point
+		if occupancies.dtype != bool and occupancies.shape[0] != num_points:
+			return np.unpackbits(occupancies, count=num_points).view(bool)
+
+		return occupancies.astype(bool, copy=False)
@@ -1,22 +0,0 @@
-import multiprocessing.pool as mpp
-
-# This function is purely to allow a tqdm progress bar
-def istarmap(self, func, iterable, chunksize=1):
-	"""starmap-version of imap
-	"""
-	self._check_running()
-	if chunksize < 1:
-		raise ValueError(
-			"Chunksize must be 1+, not {0:n}".format(
-				chunksize))
-
-	task_batches = mpp.Pool._get_tasks(func, iterable, chunksize)
-	result = mpp.IMapIterator(self)
-	self._taskqueue.put(
-		(
-			self._guarded_task_generation(result._job,
-										  mpp.starmapstar,
-										  task_batches),
-			result._set_length
-		))
-	return (item for chunk in result for item in chunk)
\ No newline at end of file
@@ -0,0 +1,66 @@
+import sys
+import subprocess
+from pathlib import Path
+
+profile_flags = ("-p", "--profile")
+
+def run_profiled(cfg, stage, argv):
+	'''
+	Re-run a stage script (`argv` as in sys.argv, including --profile) under py-spy, sampling
+	the script and every process it starts: pool workers, ray workers and the Blender process
+	with its own workers.
+
+	py-spy writes collapsed stacks with each process as its own root frame to
+	<root_directory>/profiles/<stage>.raw.txt. These are then merged across processes into
+	<stage>.txt, which can be opened in speedscope or passed to flamegraph.pl.
+	'''
+	directory = Path(cfg.get_config("output/root_directory")) / "profiles"
+	directory.mkdir(parents=True, exist_ok=True)
+
+	raw_path = directory / f"{stage}.raw.txt"
+	merged_path = directory / f"{stage}.txt"
+
+	command = [
+		"py-spy", "record",
+		"--subprocesses",
+		"--format", "raw",
+		"--rate", str(cfg.get_config("meta/profile_rate", 100)),
+		"--output", str(raw_path),
+		"--",
+		sys.executable,
+		*[arg for arg in argv if arg not in profile_flags]
+	]
+
+	try:
+		subprocess.run(command, check=True)
+	except FileNotFoundError:
+		raise FileNotFoundError("--profile needs py-spy on the PATH (pip install py-spy).")
+
+	merge_collapsed(raw_path, merged_path)
+	print(f"Profile of stage '{stage}' saved to {merged_path}")
+
+def merge_collapsed(input_path, output_path):
+	'''
+	Merge collapsed stacks ("frame;frame;frame count" per line) across processes by dropping
+	py-spy's per-process root frame, so the same code path in different workers adds up
+	'''
+	counts = {}
+	with open(input_path, "r") as f:
+		for line in f:
+			line = line.rstrip("\n")
+			if not line:
+				continue
+
+			stack, count = line.rsplit(" ", 1)
+			frames = stack.split(";")
+			if frames[0].startswith("process "):
+				frames = frames[1:]
+			if not frames:
+				continue
+
+			stack = ";".join(frames)
+			counts[stack] = counts.get(stack, 0) + int(count)
+
+	with open(output_path, "w") as f:
+		for stack, count in sorted(counts.items()):
+			f.write(f"{stack} {count}\n")
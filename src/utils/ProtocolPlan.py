@@ -0,0 +1,74 @@
+import numpy as np
+
+class ProtocolPlan(object):
+	"""Compiled form of an operation protocol, with one entry per captured frame:
+
+	ppa, psa: (N,) fluoroscope angles, as written in the protocol
+	table: (N, 3) table position set by "table" instructions
+	centred: (N, 3) bool, True where the table position on that axis instead comes from
+		centring on the mesh (i.e. is -centroid), as set by a "centre" instruction
+
+	Renderers consume the plan directly rather than interpreting the list of instructions.
+	"""
+	keys = ("ppa", "psa", "table", "centred")
+
+	def __init__(self, ppa, psa, table, centred):
+		self.ppa = np.asarray(ppa, dtype=np.float64).reshape(-1)
+		self.psa = np.asarray(psa, dtype=np.float64).reshape(-1)
+		self.table = np.asarray(table, dtype=np.float64).reshape(-1, 3)
+		self.centred = np.asarray(centred, dtype=bool).reshape(-1, 3)
+
+	@classmethod
+	def compile(cls, instructions):
+		'''
+		Compile a list of protocol instructions (e.g. {"centre"}, {"fluoroscope": {"ppa": 0, "psa": 0}},
+		{"capture"}) into a plan
+		'''
+		ppa, psa = 0., 0.
+		table = np.zeros(3)
+		centred = np.zeros(3, dtype=bool)
+
+		captures = {key: [] for key in cls.keys}
+
+		for item in instructions:
+			if "capture" in item:
+				captures["ppa"].append(ppa)
+				captures["psa"].append(psa)
+				captures["table"].append(table.copy())
+				captures["centred"].append(centred.copy())
+
+			if "centre" in item:
+				centred[:] = True
+
+			if "fluoroscope" in item:
+				ppa = item["fluoroscope"].get("ppa", ppa)
+				psa = item["fluoroscope"].get("psa", psa)
+
+			if "table" in item:
+				for axis, axis_name in enumerate("xyz"):
+					if axis_name in item["table"]:
+						table[axis] = item["table"][axis_name]
+						centred[axis] = False
+
+		return cls(
+			captures["ppa"],
+			captures["psa"],
+			np.reshape(captures["table"], (-1, 3)),
+			np.reshape(captures["centred"], (-1, 3))
+		)
+
+	def __len__(self):
+		return self.ppa.shape[0]
+
+	def positions(self, centroid):
+		'''
+		(N, 3) table positions, given the centroid of the mesh being imaged
+		'''
+		return np.where(self.centred, -np.asarray(centroid, dtype=np.float64), self.table)
+
+	def to_dict(self, prefix="protocol_"):
+		return {f"{prefix}{key}": getattr(self, key) for key in self.keys}
+
+	@classmethod
+	def from_dict(cls, data, prefix="protocol_"):
+		return cls(*(data[f"{prefix}{key}"] for key in cls.keys))
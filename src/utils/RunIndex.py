@@ -0,0 +1,138 @@
+import os
+import json
+from pathlib import Path
+
+class RunIndex(object):
+	"""Append-only record of the seeds each stage has finished, kept as run_index.jsonl in the
+	output root directory, with one {"stage": "meshes", "seed": 3} line per finished seed.
+	A {"stage": "meshes", "seed": 3, "forget": true} line undoes it, for when a seed's outputs
+	are deleted or are about to be overwritten.
+
+	Stages enumerate their work from the seed range and this index rather than scanning the
+	output tree. Seeds the index does not know about (e.g. from runs made before it existed,
+	or meshes written by Blender) are looked up at their expected per-seed path only, and are
+	then added to the index. Forgotten seeds are not looked up until they are recorded again.
+
+	Only parent processes write to the index, so appends never interleave.
+
+	Usage:
+		run_index = RunIndex.from_config(cfg)
+		for seed in run_index.completed("meshes", seeds):
+			...
+		run_index.record("samples", [seed])
+		run_index.forget("samples", seeds) # e.g. before overwriting them
+	"""
+	filename = "run_index.jsonl"
+
+	# The file each stage leaves in a seed's directory once that seed is done
+	stage_outputs = {
+		"networks": "network.swc",
+		"meshes": "mesh.ply"
+	}
+
+	def __init__(self, root_directory, pad):
+		self.root_directory = Path(root_directory)
+		self.pad = pad
+		self.path = self.root_directory / self.filename
+
+		self._partial_line = False
+		self._forgotten = {}
+		self._completed = self._read()
+
+	@classmethod
+	def from_config(cls, cfg):
+		return cls(cfg.get_config("output/root_directory"), cfg.get_config("output/pad_zeros_to"))
+
+	def seed_directory(self, seed):
+		return self.root_directory / f"{seed:0{self.pad}}"
+
+	def record(self, stage, seeds):
+		done = self._completed.setdefault(stage, set())
+		seeds = [seed for seed in dict.fromkeys(int(seed) for seed in seeds) if seed not in done]
+		if not seeds:
+			return
+
+		self._append({"stage": stage, "seed": seed} for seed in seeds)
+
+		self._completed[stage].update(seeds)
+		self._forgotten.get(stage, set()).difference_update(seeds)
+
+	def forget(self, stage, seeds):
+		'''
+		Mark `seeds` as not having finished `stage`, e.g. when their outputs have been deleted
+		'''
+		forgotten = self._forgotten.setdefault(stage, set())
+		seeds = [seed for seed in dict.fromkeys(int(seed) for seed in seeds) if seed not in forgotten]
+		if not seeds:
+			return
+
+		self._append({"stage": stage, "seed": seed, "forget": True} for seed in seeds)
+
+		self._completed.get(stage, set()).difference_update(seeds)
+		forgotten.update(seeds)
+
+	def _append(self, items):
+		self.root_directory.mkdir(parents=True, exist_ok=True)
+		with open(self.path, "a") as f:
+			if self._partial_line:
+				f.write("\n")
+				self._partial_line = False
+			f.writelines(json.dumps(item) + "\n" for item in items)
+
+	def completed(self, stage, seeds):
+		'''
+		The seeds, in order, that have finished `stage`
+		'''
+		seeds = [int(seed) for seed in seeds]
+		done = self._completed.get(stage, set())
+		forgotten = self._forgotten.get(stage, set())
+
+		unknown = [seed for seed in seeds if seed not in done and seed not in forgotten]
+		if unknown and stage in self.stage_outputs:
+			self.record(stage, self._scan(unknown, self.stage_outputs[stage]))
+			done = self._completed.get(stage, set())
+
+		return [seed for seed in seeds if seed in done]
+
+	def _scan(self, seeds, output_filename):
+		'''
+		Seeds whose directory holds `output_filename`. Only the root directory is listed; the
+		contents of seed directories (which can hold thousands of images) never are.
+		'''
+		try:
+			with os.scandir(self.root_directory) as entries:
+				directories = {entry.name for entry in entries if entry.is_dir()}
+		except FileNotFoundError:
+			return []
+
+		found = []
+		for seed in seeds:
+			name = f"{seed:0{self.pad}}"
+			if name in directories and os.path.isfile(os.path.join(self.root_directory, name, output_filename)):
+				found.append(seed)
+
+		return found
+
+	def _read(self):
+		completed = {}
+		if not self.path.exists():
+			return completed
+
+		with open(self.path, "r") as f:
+			for line in f:
+				self._partial_line = not line.endswith("\n")
+				try:
+					item = json.loads(line)
+				except ValueError:
+					# A run killed mid-write can leave a partial last line
+					continue
+
+				# Lines are applied in order, so the latest of a record and a forget wins
+				if item.get("forget"):
+					completed.setdefault(item["stage"], set()).discard(item["seed"])
+					self._forgotten.setdefault(item["stage"], set()).add(item["seed"])
+				else:
+					completed.setdefault(item["stage"], set()).add(item["seed"])
+					self._forgotten.get(item["stage"], set()).discard(item["seed"])
+
+		return completed
@@ -1,82 +1,139 @@
 import numpy as np
-import scipy.stats
 
 from .Config import Config
+from .ProtocolPlan import ProtocolPlan
+from .ParameterTable import ParameterTable
 
 # Ensure each sampler behaves differently when sampling by giving them different codes
 existing_samplers_so_far = 0
 
 class Sampler(Config):
     def __init__(self, raw_config_dict):
-        self._data = raw_config_dict
+        super().__init__(raw_config_dict)
         self._random_obj = np.random.RandomState()
+        self._protocol_plans = {}
+
+        # Paths and settings of every distribution, in the order values are drawn
+        self._leaves = []
+        self._protocol_samplers = {}
+        self._compile(self._data, "")
 
         global existing_samplers_so_far
         existing_samplers_so_far += 1
 
 
     def generate(self, seed=0, sampler_id=0):
-        if seed > 0:
-            self._random_obj = np.random.RandomState(10000*seed+sampler_id)
+        table = self.generate_batch([seed], sampler_id)
+
+        return self.generate_from_row(table.row(seed))
+
+    def generate_batch(self, seeds, sampler_id=0):
+        '''
+        Sample every distribution for a whole range of seeds at once, returning a ParameterTable
+        with one row per seed. Each seed draws from its own RandomState(10000*seed+sampler_id)
+        exactly as `generate` does, so rows match the values `generate` gives for that seed.
+        '''
+        seeds = list(seeds)
+        raw = np.empty((len(seeds), len(self._leaves)))
+
+        for i, seed in enumerate(seeds):
+            if seed > 0:
+                self._random_obj = np.random.RandomState(10000*seed+sampler_id)
+
+            for j, (_, kind, params) in enumerate(self._leaves):
+                raw[i, j] = self._draw(kind, params)
+
+        # scipy.stats takes most of a second to import, and only batch sampling needs it
+        import scipy.stats
+
+        columns = {}
+        for j, (path, kind, params) in enumerate(self._leaves):
+            if kind == "truncated_normal":
+                # Truncated normals are drawn by inverse transform sampling of one uniform draw,
+                # so the (expensive) ppf can be evaluated for all seeds in one call
+                mean, sd, low, upp = params
+                columns[path] = scipy.stats.truncnorm.ppf(raw[:, j], (low - mean) / sd, (upp - mean) / sd, loc=mean, scale=sd)
+            else:
+                columns[path] = raw[:, j]
+
+        protocols = {}
+        for path, protocol_sampler in self._protocol_samplers.items():
+            protocols[path] = [self._evaluate_protocol(protocol_sampler, seed) for seed in seeds]
 
+        return ParameterTable(seeds, columns, protocols)
+
+    def generate_from_row(self, row):
+        '''
+        Build the evaluated Config for one seed from its row of a ParameterTable
+        '''
         evaluated_dict = {}
-        self._recursive_evaluate(self._data, evaluated_dict, seed)
+        self._recursive_evaluate(self._data, evaluated_dict, row, "")
 
         return Config(evaluated_dict)
 
-    def _recursive_evaluate(self, parent_dict, evaluated_dict, seed):
+    def _compile(self, parent_dict, prefix):
         for k,v in parent_dict.items():
             if isinstance(v, dict):
+                path = f"{prefix}{k}"
+
                 if k == "protocol":
-                    evaluated_dict[k] = self._evaluate_protocol(v, seed)
+                    self._protocol_samplers[path] = Sampler(v)
                     continue
 
                 distribution = v.get("distribution")
 
                 if distribution == "uniform":
-                    evaluated_dict[k] = self._evaluate_uniform(v)
+                    assert "min" in v and "max" in v, f"Configuration for {path} must have a 'min' and 'max' specified"
+                    self._leaves.append((path, "uniform", (v.get("min"), v.get("max"))))
                 elif distribution == "normal":
-                    evaluated_dict[k] = self._evaluate_normal(v)
+                    assert "mean" in v and "std" in v, f"Configuration for {path} must have a 'mean' and 'std' specified"
+                    mean, std = v.get("mean"), v.get("std")
+                    min, max = v.get("min"), v.get("max")
+
+                    if min is not None or max is not None:
+                        min = min if min is not None else -np.inf
+                        max = max if max is not None else np.inf
+                        self._leaves.append((path, "truncated_normal", (mean, std, min, max)))
+                    else:
+                        self._leaves.append((path, "normal", (mean, std)))
                 else:
-                    evaluated_dict[k] = {}
-                    self._recursive_evaluate(v, evaluated_dict[k], seed)
-            else:
-                evaluated_dict[k] = v
-
-    def _evaluate_uniform(self, generation_dict):
-        assert "min" in generation_dict and "max" in generation_dict, f"Configuration for {path} must have a 'min' and 'max' specified"
-        min, max = generation_dict.get("min"), generation_dict.get("max")
-        value = self._random_obj.uniform(min, max)
-        return value
+                    self._compile(v, f"{path}/")
 
-    def _evaluate_normal(self, generation_dict):
-        assert "mean" in generation_dict and "std" in generation_dict, f"Configuration for {path} must have a 'mean' and 'std' specified"
+    def _draw(self, kind, params):
+        if kind == "uniform":
+            return self._random_obj.uniform(*params)
+        if kind == "normal":
+            return self._random_obj.normal(*params)
 
-        mean, std = generation_dict.get("mean"), generation_dict.get("std")
-        min, max = generation_dict.get("min"), generation_dict.get("max")
+        # Uniform variate to be mapped through the truncated normal ppf
+        return self._random_obj.random_sample()
 
-        if min is not None or max is not None:
-            min = min if min is not None else -np.inf
-            max = max if max is not None else np.inf
-            value = self._evaluate_truncated_normal(mean, std, min, max)
-        else:
-            value = self._random_obj.normal(mean, std)
+    def _recursive_evaluate(self, parent_dict, evaluated_dict, row, prefix):
+        for k,v in parent_dict.items():
+            path = f"{prefix}{k}"
 
-        return value
+            if path in row:
+                evaluated_dict[k] = row[path]
+            elif isinstance(v, dict):
+                evaluated_dict[k] = {}
+                self._recursive_evaluate(v, evaluated_dict[k], row, f"{path}/")
+            else:
+                evaluated_dict[k] = v
 
-    def _evaluate_truncated_normal(self, mean, sd, low, upp):
-        stats_obj = scipy.stats.truncnorm(
-            (low - mean) / sd, (upp - mean) / sd, loc=mean, scale=sd
-        )
+    def _evaluate_protocol(self, protocol_sampler, seed):
+        # Protocols are fully determined by the seed, so compile each one only once
+        if seed > 0 and seed in self._protocol_plans:
+            return self._protocol_plans[seed]
 
-        stats_obj.random_state = self._random_obj
-        return stats_obj.rvs()
+        config = protocol_sampler.generate(seed)
+        plan = ProtocolPlan.compile(self._evaluate_protocol_instructions(config, seed))
 
-    def _evaluate_protocol(self, config, seed):
+        if seed > 0:
+            self._protocol_plans[seed] = plan
 
-        if isinstance(config, dict):
-            config = Sampler(config).generate(seed)
+        return plan
 
+    def _evaluate_protocol_instructions(self, config, seed):
         instructions = []
 
         assert len(config.get_config()) == 1, f"Exactly one operation protocol must be specified (you have specified {', '.join(config.get_config().keys())})."
@@ -0,0 +1,186 @@
+import os
+import uuid
+import tempfile
+import numpy as np
+from pathlib import Path
+from contextlib import contextmanager
+from collections.abc import Mapping
+
+try:
+	from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+	# Python < 3.8, where arrays go through memory-mapped scratch files instead
+	shared_memory = None
+
+class SharedArray(object):
+	"""Picklable handle to an array in a `multiprocessing.shared_memory` block. Only the name,
+	shape and dtype are pickled, so passing a handle between processes costs the same whatever the
+	array size.
+
+	The process that creates the block hands it over: whoever opens the handle last must `release`
+	it, which frees the memory.
+
+	Usage:
+		# In a worker
+		handle = SharedArray.copy_of(images)
+
+		# In the parent
+		with handle as images:
+			...
+	"""
+	def __init__(self, name, shape, dtype):
+		self.name = name
+		self.shape = tuple(shape)
+		self.dtype = np.dtype(dtype).str
+		self._shm = None
+
+	@classmethod
+	def copy_of(cls, array, prefix=None):
+		array = np.asarray(array)
+
+		name = f"{prefix}{uuid.uuid4().hex}" if prefix else None
+		shm = shared_memory.SharedMemory(name=name, create=True, size=max(1, array.nbytes))
+		np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+
+		# The block outlives this process (e.g. a recycled pool worker), so stop its resource
+		# tracker from unlinking it at exit. The receiving process is registered when it opens it;
+		# blocks that are never received are freed by `release_unreceived`.
+		resource_tracker.unregister(shm._name, "shared_memory")
+		shm.close()
+
+		return cls(shm.name, array.shape, array.dtype)
+
+	def open(self):
+		if self._shm is None:
+			self._shm = shared_memory.SharedMemory(name=self.name)
+
+		return np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+	def release(self):
+		'''
+		Free the shared memory. Arrays returned by `open` must not be used afterwards.
+		'''
+		if self._shm is None:
+			self._shm = shared_memory.SharedMemory(name=self.name)
+
+		try:
+			self._shm.close()
+		except BufferError:
+			# Arrays from `open` are still referenced. The memory is freed once they are gone.
+			pass
+		self._shm.unlink()
+		self._shm = None
+
+	def __getstate__(self):
+		return {"name": self.name, "shape": self.shape, "dtype": self.dtype, "_shm": None}
+
+	def __enter__(self):
+		return self.open()
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.release()
+
+class MappedArray(object):
+	"""Handle to an array in a .npy file, opened read-only as a memory map. Used for arrays already
+	on disk (e.g. streamed images.npy) and, with `delete=True`, for scratch files standing in for
+	shared memory.
+	"""
+	def __init__(self, path, delete=False):
+		self.path = str(path)
+		self.delete = delete
+
+	@classmethod
+	def copy_of(cls, array, directory=None, prefix=None):
+		path = Path(directory or tempfile.gettempdir()) / f"{prefix or 'shared-'}{uuid.uuid4().hex}.npy"
+		np.save(path, array)
+
+		return cls(path, delete=True)
+
+	def open(self):
+		return np.load(self.path, mmap_mode="r")
+
+	def release(self):
+		if self.delete and os.path.exists(self.path):
+			os.remove(self.path)
+
+	def __enter__(self):
+		return self.open()
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.release()
+
+_handle_types = (SharedArray, MappedArray)
+
+def share(value, min_bytes=2**16, scratch_directory=None, prefix=None):
+	'''
+	Replace every array of at least `min_bytes` in a (possibly nested) dict, list or tuple with a
+	handle, so the value can be returned from a worker without pickling the arrays. Smaller arrays
+	(e.g. camera matrices) are cheaper to pickle and are left as they are.
+
+	Arrays are named with `prefix` (see `shared_prefix`), so the parent can free any it never receives.
+	'''
+	if isinstance(value, np.ndarray) and value.nbytes >= min_bytes:
+		if shared_memory is not None:
+			return SharedArray.copy_of(value, prefix)
+		return MappedArray.copy_of(value, scratch_directory, prefix)
+	if isinstance(value, Mapping):
+		return {k: share(v, min_bytes, scratch_directory, prefix) for k, v in value.items()}
+	if isinstance(value, (list, tuple)):
+		return type(value)(share(v, min_bytes, scratch_directory, prefix) for v in value)
+
+	return value
+
+def shared_prefix():
+	'''
+	A name prefix unique to this run, for the workers' `share` calls
+	'''
+	return f"angiogen-{os.getpid()}-{uuid.uuid4().hex[:8]}-"
+
+def release_unreceived(prefix, scratch_directory=None):
+	'''
+	Free every array shared under `prefix` that was never received, e.g. because the consumer
+	raised, a worker was killed after sharing its result, or the run was interrupted. Call it once
+	the workers have exited.
+	'''
+	# POSIX shared memory blocks appear as files here on Linux
+	if shared_memory is not None and os.path.isdir("/dev/shm"):
+		for name in os.listdir("/dev/shm"):
+			if name.startswith(prefix):
+				try:
+					os.remove(os.path.join("/dev/shm", name))
+				except FileNotFoundError:
+					pass
+
+	for path in Path(scratch_directory or tempfile.gettempdir()).glob(f"{prefix}*.npy"):
+		try:
+			path.unlink()
+		except FileNotFoundError:
+			pass
+
+@contextmanager
+def received(value):
+	'''
+	Open every handle in a value returned by `share`, and release them all on exit.
+
+	Usage:
+		with received(result) as arrays:
+			consumer(arrays)
+	'''
+	handles = []
+
+	def open_handles(value):
+		if isinstance(value, _handle_types):
+			handles.append(value)
+			return value.open()
+		if isinstance(value, Mapping):
+			return {k: open_handles(v) for k, v in value.items()}
+		if isinstance(value, (list, tuple)):
+			return type(value)(open_handles(v) for v in value)
+
+		return value
+
+	try:
+		yield open_handles(value)
+	finally:
+		for handle in handles:
+			handle.release()
@@ -0,0 +1,404 @@
+import os
+import time
+import pickle
+import signal
+import itertools
+import collections
+import multiprocessing
+from warnings import warn
+from multiprocessing.connection import wait
+
+def _run_worker(connection, initializer, initargs):
+	'''
+	Worker process loop, running the chunks sent by the executor one at a time until sent None
+	'''
+	if initializer is not None:
+		initializer(*initargs)
+
+	while True:
+		try:
+			message = connection.recv()
+		except EOFError:
+			break
+		if message is None:
+			break
+
+		chunk_id, payload = message
+		# Lets the parent tell which chunk the worker is running, and since when
+		connection.send(("started", chunk_id, time.time()))
+
+		try:
+			func, chunk = pickle.loads(payload)
+			item = _run_chunk(func, chunk)
+		except Exception as e:
+			item = e
+
+		try:
+			connection.send(("done", chunk_id, item))
+		except Exception as e:
+			# The results couldn't be pickled
+			connection.send(("done", chunk_id, e))
+
+	connection.close()
+
+def _run_chunk(func, chunk):
+	start = time.perf_counter()
+
+	# Each task succeeds or fails on its own, so one failure doesn't lose the rest of the chunk
+	results = []
+	for args in chunk:
+		try:
+			results.append((True, func(*args)))
+		except Exception as e:
+			results.append((False, e))
+
+	return results, time.perf_counter() - start
+
+class TaskExecutor(object):
+	"""Process pool that runs `func(*task)` over a stream of tasks using only the public
+	multiprocessing API. It owns its worker processes, each with a pipe of its own, so it always
+	knows which chunk a worker is running and can kill and replace that worker on its own.
+
+	Tasks are read lazily from the iterable, a chunk at a time as workers become free (a busy worker
+	isn't sent more, so neither side can block the other on a full pipe). Chunk size adapts to
+	the measured task duration so that each chunk takes roughly `target_chunk_duration` seconds:
+	slow tasks are sent one at a time, fast ones are batched to cut IPC overhead. Given a `cost`
+	function, tasks are instead run most expensive first, so that the longest tasks do not end up
+	at the tail of the run.
+
+	Given a `memory_budget` (in bytes) and a `memory` function estimating a task's peak memory,
+	chunks are only started while the estimates of everything running fit within the budget (a
+	chunk is always started when nothing else is running). Workers are replaced after
+	`max_tasks_per_worker` tasks (chunks are cut short to fit), returning memory that fragmentation
+	would otherwise hold on to.
+
+	A task that raises is retried up to `retries` times, on its own. Given a `timeout` (in seconds
+	per task), the worker running a chunk that has overrun is killed and replaced; a single timed
+	out task counts as a failed attempt, while the tasks of a larger chunk are retried one by one
+	to find the culprit. A worker that dies (e.g. killed for running out of memory) is handled the
+	same way. Tasks that have used up their retries are passed to the `on_failure` callback of
+	`starmap` if there is one, otherwise their error is raised.
+
+	Usage:
+		with TaskExecutor(num_processes) as executor:
+			for result in tqdm(executor.starmap(func, tasks), total=len(tasks)):
+				pass
+	"""
+	def __init__(self, num_processes, initializer=None, initargs=(), target_chunk_duration=1.0, max_chunk_size=64,
+						memory_budget=None, max_tasks_per_worker=None, timeout=None, retries=0):
+		self.num_processes = num_processes
+		self.target_chunk_duration = target_chunk_duration
+		self.max_chunk_size = max_chunk_size
+		self.memory_budget = memory_budget
+		self.max_tasks_per_worker = max_tasks_per_worker
+		self.timeout = timeout
+		self.retries = retries or 0
+
+		self._initializer = initializer
+		self._initargs = initargs
+		self._task_duration = None
+
+		# Each worker's process, pipe, the ids of the chunks sent to it and not yet finished, when it
+		# started the first of them and how many tasks it has been sent
+		self._workers = [self._start_worker() for _ in range(num_processes)]
+
+	@classmethod
+	def from_config(cls, cfg, stage=None, **kwargs):
+		'''
+		Executor sized by meta/num_cpus, meta/memory_budget_gb and meta/max_tasks_per_worker, with
+		the task timeout of `stage` from meta/timeouts and the retries from meta/retries
+		'''
+		memory_budget_gb = cfg.get_config("meta/memory_budget_gb")
+
+		return cls(
+			cfg.get_config("meta/num_cpus"),
+			memory_budget=memory_budget_gb * 2**30 if memory_budget_gb else None,
+			max_tasks_per_worker=cfg.get_config("meta/max_tasks_per_worker"),
+			timeout=cfg.get_config(f"meta/timeouts/{stage}") if stage is not None else None,
+			retries=cfg.get_config("meta/retries", 0),
+			**kwargs
+		)
+
+	def starmap(self, func, tasks, cost=None, memory=None, on_failure=None):
+		'''
+		Yield `func(*task)` for every task, in order of completion.
+
+		`cost` is an optional function giving the relative cost of a task (e.g. its mesh size);
+		the tasks are then materialised and run in descending order of cost.
+
+		`memory` is an optional function estimating a task's peak memory in bytes, used with the
+		executor's `memory_budget` to decide when the next chunk can start.
+
+		`on_failure(task, reason, attempts)` is called for every task that still fails after its
+		retries, which then yields nothing. Without it, the task's error is raised.
+		'''
+		if cost is not None:
+			tasks = sorted(tasks, key=cost, reverse=True)
+		tasks = enumerate(tasks)
+
+		in_flight = {}
+		retry = collections.deque()
+		# Chunks sent to a worker that died before starting them, and the rest of chunks cut short
+		# for a worker about to be replaced, which are sent as they are
+		unstarted = collections.deque()
+		attempts = {}
+		chunk_ids = itertools.count()
+		exhausted = False
+		waiting = None
+
+		while True:
+			self._retire_workers()
+
+			while True:
+				worker = self._free_worker()
+				if worker is None:
+					break
+
+				if waiting is None:
+					if unstarted:
+						chunk = unstarted.popleft()
+					elif retry:
+						chunk = [retry.popleft()]
+					else:
+						chunk = list(itertools.islice(tasks, self.chunk_size))
+					if not chunk:
+						exhausted = True
+						break
+
+					waiting = (chunk, self._chunk_memory(chunk, memory))
+
+				chunk, chunk_memory = waiting
+				quota = self._quota(worker)
+				if len(chunk) > quota:
+					# The rest of the chunk goes to the next worker
+					unstarted.appendleft(chunk[quota:])
+					chunk = chunk[:quota]
+					chunk_memory = self._chunk_memory(chunk, memory)
+					waiting = (chunk, chunk_memory)
+
+				if not self._admit(chunk_memory, [m for _, m in in_flight.values()]):
+					break
+				waiting = None
+
+				try:
+					payload = pickle.dumps((func, [task for _, task in chunk]))
+				except Exception as e:
+					# e.g. a task that can't be pickled
+					for index, task in chunk:
+						yield from self._failed(index, task, e, attempts, retry, on_failure)
+					continue
+
+				chunk_id = next(chunk_ids)
+				worker["connection"].send((chunk_id, payload))
+				worker["chunks"].append(chunk_id)
+				worker["sent"] += len(chunk)
+				in_flight[chunk_id] = (chunk, chunk_memory)
+
+			if not in_flight:
+				if exhausted and not retry and not unstarted and waiting is None:
+					return
+				continue
+
+			ready = wait([worker["connection"] for worker in self._workers] + [worker["process"].sentinel for worker in self._workers],
+						 timeout=1. if self.timeout else None)
+
+			for worker in list(self._workers):
+				if worker["connection"] not in ready and worker["process"].sentinel not in ready:
+					continue
+
+				# A worker's messages arrive in order, so all of them are handled before its exit is
+				yield from self._collect(worker, in_flight, attempts, retry, on_failure)
+
+				if not worker["process"].is_alive():
+					worker["process"].join()
+					error = RuntimeError(f"worker exited with code {worker['process'].exitcode}")
+					yield from self._lost(worker, error, in_flight, unstarted, attempts, retry, on_failure)
+
+			if self.timeout:
+				for worker in list(self._workers):
+					# A chunk that has just finished is never taken as overdue
+					yield from self._collect(worker, in_flight, attempts, retry, on_failure)
+
+					# Only the chunk the worker has said it started can be overdue
+					if worker["started"] is None:
+						continue
+
+					chunk, _ = in_flight[worker["chunks"][0]]
+					if time.time() - worker["started"] > self.timeout * len(chunk):
+						try:
+							os.kill(worker["process"].pid, signal.SIGKILL)
+						except ProcessLookupError:
+							pass
+						worker["process"].join()
+
+						# Results sent just before the kill still count
+						yield from self._collect(worker, in_flight, attempts, retry, on_failure)
+						yield from self._lost(worker, f"timed out after {self.timeout} s", in_flight, unstarted, attempts, retry, on_failure)
+
+	def _collect(self, worker, in_flight, attempts, retry, on_failure):
+		'''
+		Yield the results of the chunks the worker has finished, keeping track of when it started
+		its current one
+		'''
+		connection = worker["connection"]
+		while True:
+			try:
+				if not connection.poll():
+					return
+				event, chunk_id, item = connection.recv()
+			except (EOFError, OSError):
+				return
+
+			if event == "started":
+				worker["started"] = item
+				continue
+
+			worker["chunks"].popleft()
+			worker["started"] = None
+
+			chunk, _ = in_flight.pop(chunk_id)
+			if isinstance(item, BaseException):
+				# The chunk itself failed, e.g. its tasks or results couldn't be pickled
+				results = [(False, item)] * len(chunk)
+			else:
+				results, elapsed = item
+				self._record_duration(elapsed, len(results))
+
+			for (index, task), (succeeded, value) in zip(chunk, results):
+				if succeeded:
+					yield value
+				else:
+					yield from self._failed(index, task, value, attempts, retry, on_failure)
+
+	def _lost(self, worker, error, in_flight, unstarted, attempts, retry, on_failure):
+		'''
+		Replace a dead worker, charging `error` to the chunk it was running
+		'''
+		self._workers[self._workers.index(worker)] = self._start_worker()
+		worker["connection"].close()
+
+		chunks = [in_flight.pop(chunk_id)[0] for chunk_id in worker["chunks"]]
+		if worker["started"] is not None:
+			chunk = chunks.pop(0)
+			if len(chunk) > 1:
+				retry.extend(chunk)
+			else:
+				index, task = chunk[0]
+				yield from self._failed(index, task, error, attempts, retry, on_failure)
+
+		unstarted.extendleft(reversed(chunks))
+
+	def _failed(self, index, task, error, attempts, retry, on_failure):
+		attempts[index] = attempts.get(index, 0) + 1
+		if attempts[index] <= self.retries:
+			retry.append((index, task))
+			return
+
+		if on_failure is None:
+			raise error if isinstance(error, BaseException) else TimeoutError(error)
+
+		reason = error if isinstance(error, str) else f"{type(error).__name__}: {error}"
+		on_failure(task, reason, attempts[index])
+
+		# A generator, so failures are handled as the caller iterates
+		yield from ()
+
+	def _start_worker(self):
+		connection, worker_connection = multiprocessing.Pipe()
+		process = multiprocessing.Process(target=_run_worker, args=(worker_connection, self._initializer, self._initargs), daemon=True)
+		process.start()
+		worker_connection.close()
+
+		return {"process": process, "connection": connection, "chunks": collections.deque(), "started": None, "sent": 0}
+
+	def _free_worker(self):
+		'''
+		An idle worker that can take another chunk, if there is one
+		'''
+		return next((worker for worker in self._workers if not worker["chunks"] and not self._worn_out(worker)), None)
+
+	def _quota(self, worker):
+		'''
+		How many more tasks the worker can be sent before it is replaced
+		'''
+		if self.max_tasks_per_worker is None:
+			return float("inf")
+
+		return self.max_tasks_per_worker - worker["sent"]
+
+	def _worn_out(self, worker):
+		return self._quota(worker) <= 0
+
+	@staticmethod
+	def _chunk_memory(chunk, memory):
+		# A worker runs its chunk one task at a time, so the chunk needs as much as its largest task
+		return max(memory(task) for _, task in chunk) if memory is not None else 0
+
+	def _retire_workers(self):
+		'''
+		Replace workers that have run their share of tasks, letting them exit normally
+		'''
+		for i, worker in enumerate(self._workers):
+			if self._worn_out(worker) and not worker["chunks"]:
+				self._stop(worker)
+				self._workers[i] = self._start_worker()
+
+	def _stop(self, worker):
+		try:
+			worker["connection"].send(None)
+		except OSError:
+			# The worker has already exited
+			pass
+
+	def _admit(self, chunk_memory, in_flight):
+		# `in_flight` holds the memory estimates of the chunks running
+		if self.memory_budget is None or not in_flight:
+			if self.memory_budget is not None and chunk_memory > self.memory_budget:
+				warn(f"A task is estimated to need {chunk_memory / 2**30:.1f} GB, over the memory budget of {self.memory_budget / 2**30:.1f} GB. Running it on its own.", RuntimeWarning)
+			return True
+
+		return sum(in_flight) + chunk_memory <= self.memory_budget
+
+	@property
+	def chunk_size(self):
+		if self._task_duration is None:
+			return 1
+		if self._task_duration == 0:
+			return self.max_chunk_size
+
+		return int(min(self.max_chunk_size, max(1, self.target_chunk_duration / self._task_duration)))
+
+	def _record_duration(self, elapsed, num_tasks):
+		task_duration = elapsed / num_tasks
+
+		# Exponential moving average, so the chunk size follows changes in task duration over the run
+		if self._task_duration is None:
+			self._task_duration = task_duration
+		else:
+			self._task_duration = 0.7 * self._task_duration + 0.3 * task_duration
+
+	def close(self):
+		'''
+		Let the workers exit once they have finished their chunks, and wait for them
+		'''
+		for worker in self._workers:
+			self._stop(worker)
+		for worker in self._workers:
+			worker["process"].join()
+			worker["connection"].close()
+
+	def terminate(self):
+		for worker in self._workers:
+			worker["process"].terminate()
+		for worker in self._workers:
+			worker["process"].join()
+			worker["connection"].close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.terminate()
@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import socket
+import resource
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+class Telemetry(object):
+	"""Per-seed, per-stage timing and resource records, appended as JSON lines to
+	<root_directory>/telemetry/<host>-<pid>.jsonl. Each process writes its own file, so pool
+	workers, ray actors and the Blender process never interleave writes.
+
+	A record holds the stage, seed, status, wall and CPU time (including finished child
+	processes such as VascuSynth), peak and current RSS, input sizes (nodes, faces, frames,
+	etc.), the bytes written, and the wall time of any named phases (e.g. render, process, write).
+
+	The peak RSS is the kernel's high-water mark, which is reset as each measured block starts
+	where possible (/proc/self/clear_refs on Linux), so a long-lived worker doesn't carry its
+	largest seed over to every later one. Records where it couldn't be reset have
+	peak_rss_per_seed set to false, and hold the peak over the process lifetime instead.
+
+	Usage:
+		with Telemetry.from_config(cfg).measure("meshes", seed, nodes=num_nodes) as record:
+			...
+			record.sizes["faces"] = len(faces)
+			record.add_output(path / "mesh.ply")
+	"""
+	directory_name = "telemetry"
+
+	# Deferred records can be written from background writer threads
+	_write_lock = threading.Lock()
+
+	def __init__(self, root_directory, enabled=True):
+		self.directory = Path(root_directory) / self.directory_name
+		self.enabled = enabled
+
+	@classmethod
+	def from_config(cls, cfg):
+		return cls(cfg.get_config("output/root_directory"), cfg.get_config("meta/telemetry", True))
+
+	@contextmanager
+	def measure(self, stage, seed, **sizes):
+		record = TelemetryRecord(stage, seed, sizes)
+
+		if not self.enabled:
+			yield record
+			return
+
+		start_time = time.time()
+		start_wall = time.perf_counter()
+		start_cpu = _cpu_time()
+		peak_reset = _reset_peak_rss()
+
+		try:
+			yield record
+		except BaseException as e:
+			record.status = f"error: {type(e).__name__}"
+			raise
+		finally:
+			record.data.update({
+				"time": start_time,
+				"wall_s": time.perf_counter() - start_wall,
+				"cpu_s": _cpu_time() - start_cpu,
+				**_memory_usage(),
+				"peak_rss_per_seed": peak_reset
+			})
+			if record.status == "ok":
+				record._hand_over(self.write)
+			else:
+				self.write(record)
+
+	def write(self, record):
+		self.directory.mkdir(parents=True, exist_ok=True)
+
+		with self._write_lock, open(self.directory / f"{socket.gethostname()}-{os.getpid()}.jsonl", "a") as f:
+			f.write(json.dumps(record.to_dict()) + "\n")
+
+	@classmethod
+	def load(cls, root_directory):
+		'''
+		Every record of a dataset, from all processes
+		'''
+		directory = Path(root_directory) / cls.directory_name
+		if not directory.exists():
+			return []
+
+		records = []
+		for path in sorted(directory.glob("*.jsonl")):
+			with open(path, "r") as f:
+				for line in f:
+					try:
+						records.append(json.loads(line))
+					except ValueError:
+						# A process killed mid-write can leave a partial last line
+						continue
+
+		return records
+
+class TelemetryRecord(object):
+	def __init__(self, stage, seed, sizes):
+		self.stage = stage
+		self.seed = int(seed)
+		self.sizes = dict(sizes)
+		self.status = "ok"
+		self.output_bytes = 0
+		self.phases = {}
+		self.data = {}
+		self.deferred = False
+		self._write = None
+		self._lock = threading.Lock()
+
+	def defer(self):
+		'''
+		Hold the record back when the measured block ends, until `finish` is called (possibly from
+		another thread), e.g. once background writes have been counted with `add_output`
+		'''
+		self.deferred = True
+
+	def finish(self):
+		with self._lock:
+			self.deferred = False
+			write, self._write = self._write, None
+
+		if write is not None:
+			write(self)
+
+	def _hand_over(self, write):
+		# Called as the measured block ends: write now, unless the record is still deferred
+		with self._lock:
+			if self.deferred:
+				self._write = write
+				return
+
+		write(self)
+
+	@contextmanager
+	def phase(self, name):
+		'''
+		Time part of the work, e.g. `with record.phase("render"):`
+		'''
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.phases[name] = self.phases.get(name, 0.) + time.perf_counter() - start
+
+	def add_output(self, path):
+		'''
+		Count the bytes of a written file, or of every file under a written directory
+		'''
+		path = str(path)
+		if os.path.isfile(path):
+			self.output_bytes += os.path.getsize(path)
+		elif os.path.isdir(path):
+			for directory, _, filenames in os.walk(path):
+				self.output_bytes += sum(os.path.getsize(os.path.join(directory, filename)) for filename in filenames)
+
+	def to_dict(self):
+		return {
+			"stage": self.stage,
+			"seed": self.seed,
+			"status": self.status,
+			"sizes": self.sizes,
+			"output_bytes": self.output_bytes,
+			"phases": self.phases,
+			"host": socket.gethostname(),
+			"pid": os.getpid(),
+			**self.data
+		}
+
+def summarise(records):
+	'''
+	{stage: {count, errors, wall/CPU totals and percentiles, peak RSS, output bytes, phase totals}}
+	'''
+	import numpy as np
+
+	by_stage = {}
+	for record in records:
+		by_stage.setdefault(record["stage"], []).append(record)
+
+	summary = {}
+	for stage, stage_records in by_stage.items():
+		wall = np.array([r["wall_s"] for r in stage_records])
+		cpu = np.array([r["cpu_s"] for r in stage_records])
+
+		summary[stage] = {
+			"count": len(stage_records),
+			"skipped": sum(r["status"] == "skipped" for r in stage_records),
+			"errors": sum(r["status"] not in ("ok", "skipped") for r in stage_records),
+			"wall_total_s": float(wall.sum()),
+			"wall_median_s": float(np.median(wall)),
+			"wall_p95_s": float(np.percentile(wall, 95)),
+			"wall_max_s": float(wall.max()),
+			"cpu_total_s": float(cpu.sum()),
+			"cpu_per_wall": float(cpu.sum() / wall.sum()) if wall.sum() > 0 else 0.,
+			"peak_rss_mb": max(r["peak_rss_mb"] for r in stage_records),
+			"output_mb": sum(r["output_bytes"] for r in stage_records) / 2**20,
+			"phases_total_s": {}
+		}
+
+		for r in stage_records:
+			for name, duration in r.get("phases", {}).items():
+				summary[stage]["phases_total_s"][name] = summary[stage]["phases_total_s"].get(name, 0.) + duration
+
+	return summary
+
+def _cpu_time():
+	# This process (all threads) plus child processes that have finished, e.g. VascuSynth
+	children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+	return time.process_time() + children.ru_utime + children.ru_stime
+
+def _reset_peak_rss():
+	'''
+	Reset this process's RSS high-water mark, returning whether it could be
+	'''
+	try:
+		with open("/proc/self/clear_refs", "w") as f:
+			f.write("5")
+	except OSError:
+		return False
+
+	return True
+
+def _memory_usage():
+	# ru_maxrss is in kilobytes on Linux. It is the high-water mark since `_reset_peak_rss`, or
+	# else the peak over the process lifetime so far. For children it is always the latter.
+	usage = {
+		"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+		"children_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+	}
+
+	try:
+		# psutil isn't available in Blender's Python
+		import psutil
+		usage["rss_mb"] = psutil.Process().memory_info().rss / 2**20
+	except ImportError:
+		pass
+
+	return usage
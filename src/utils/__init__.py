@@ -1,12 +1,9 @@
+import os
 import yaml
 from pathlib import Path
+from contextlib import contextmanager
 from .Sampler import Sampler
-try:
-	from .ImageOps import get_plugin_image_operation
-except ImportError:
-	"""
-	This import will fail when running via Blender for the generate_three_d script.
-	"""
+from .ParameterIndex import ParameterIndex
 
 def update_recursive(dict1, dict2):
 	''' Update two config dictionaries recursively.
@@ -45,7 +42,33 @@ def get_config(cfg_path, default_path):
 
 	return Sampler(config)
 
+@contextmanager
+def atomic_path(path):
+	'''
+	Temporary path to write `path` to, renamed into place once the block succeeds, so a process
+	killed mid-write never leaves a truncated file under the real name. The suffix is kept, as
+	np.save and np.savez would append their own.
+
+	Usage:
+		with atomic_path(path / "points.npz") as partial_path:
+			np.savez(partial_path, points=points)
+	'''
+	path = Path(path)
+	partial_path = path.with_name(f"{path.stem}.partial{path.suffix}")
+
+	try:
+		yield partial_path
+	except BaseException:
+		if partial_path.exists():
+			partial_path.unlink()
+		raise
+
+	os.replace(partial_path, path)
+
 def get_image_operations(cfg):
+	# Imported here so scripts and workers that don't process images (including Blender) never load it
+	from .ImageOps import get_plugin_image_operation
+
 	image_processing_config = cfg.get_config("operation/image_processing")
 
 	full_set = {}
@@ -68,7 +91,39 @@ def get_image_operations(cfg):
 
 	return full_set
 
+def write_parameter_index(cfg, overwrite=False):
+	'''
+	Sample the parameters of every seed and save them as a ParameterIndex in the output root
+	directory, unless the index there was already sampled from this config and seed range
+	'''
+	root_dir = cfg.get_config("output/root_directory")
+	seeds = range(cfg.get_config("meta/random_seeds/start"), cfg.get_config("meta/random_seeds/end") + 1)
+
+	if not overwrite:
+		index = ParameterIndex.load_current(root_dir, cfg)
+		if index is not None and len(index.seeds) == len(seeds) and index.covers(seeds):
+			return
+
+	ParameterIndex.build(cfg).save(root_dir, cfg)
+
+def get_parameter_table(cfg, seeds, overwrite=False):
+	'''
+	ParameterTable for the given seeds, read from the dataset's ParameterIndex when it was sampled
+	from this config and covers them. With `overwrite`, they are always sampled afresh.
+	'''
+	root_dir = cfg.get_config("output/root_directory")
+
+	if not overwrite:
+		index = ParameterIndex.load_current(root_dir, cfg)
+		if index is not None and index.covers(seeds):
+			return index.table
+
+	return cfg.generate_batch(seeds)
+
 __all__ = [
 	get_config,
-	get_image_operations
+	get_image_operations,
+	atomic_path,
+	write_parameter_index,
+	get_parameter_table
 ]
\ No newline at end of file